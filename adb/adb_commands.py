@@ -22,13 +22,18 @@ subprocess and a network socket.
 All timeouts are in milliseconds.
 """
 
+import binascii
+import codecs
 import cStringIO
 import os
+import pipes
 import socket
+import stat
 
 from adb import adb_protocol
 from adb import common
 from adb import filesync_protocol
+from adb import usb_exceptions
 
 # From adb.h
 CLASS = 0xFF
@@ -96,6 +101,11 @@ class AdbCommands(object):
   def GetState(self):
     return self.conn.state
 
+  @property
+  def features(self):
+    """Returns the set of features supported by the device, e.g. 'shell_v2'."""
+    return self.conn.features
+
   def Install(self, apk_path, destination_dir=None, timeout_ms=None):
     """Install an apk to the device.
 
@@ -129,12 +139,24 @@ class AdbCommands(object):
       mtime: Optional, modification time to set on the file.
       timeout_ms: Expected timeout for any part of the push.
     """
+    if not isinstance(source_file, basestring):
+      return self._Push(source_file, device_filename, mtime, timeout_ms)
+    if self.conn.can_write_file or not common.MappedFile.CanMap(source_file):
+      with open(source_file, 'rb') as f:
+        # Regular files are sent by the kernel directly from their file
+        # descriptor. The others are read as they come.
+        send_file = stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+        return self._Push(f, device_filename, mtime, timeout_ms, send_file)
+    with common.MappedFile(source_file) as mapped:
+      return self._Push(mapped, device_filename, mtime, timeout_ms)
+
+  def _Push(
+      self, datafile, device_filename, mtime, timeout_ms, send_file=False):
     connection = self.conn.Open(
         destination='sync:', timeout_ms=timeout_ms)
-    if isinstance(source_file, basestring):
-      source_file = open(source_file)
     filesync_protocol.FilesyncProtocol.Push(
-        connection, source_file, device_filename, mtime=int(mtime))
+        connection, datafile, device_filename, mtime=int(mtime),
+        send_file=send_file)
     connection.Close()
 
   def Pull(self, device_filename, dest_file=None, timeout_ms=None):
@@ -218,25 +240,273 @@ class AdbCommands(object):
     # CRLF->LF conversion manually.
     return self.Shell(cmd).replace('\r\n', '\n')
 
-  def Shell(self, command, timeout_ms=None):
-    """Run command on the device, returning the output."""
+  def Shell(self, command, timeout_ms=None, sink=None, max_size=None):
+    """Run command on the device, returning the output.
+
+    Args:
+      command: the command to run on the target.
+      timeout_ms: Maximum time to allow the command to run.
+      sink: If set, a writable file-like object or a callable that receives
+          the output as it comes, in which case None is returned.
+      max_size: If set, the output is truncated to this many bytes.
+    """
     return self.conn.Command(
-        service='shell', command=command, timeout_ms=timeout_ms)
+        service='shell', command=command, timeout_ms=timeout_ms, sink=sink,
+        max_size=max_size)
 
   def StreamingShell(self, command, timeout_ms=None):
-    """Run command on the device, yielding each line of output.
+    """Run command on the device, yielding the output as it comes.
 
     Args:
       command: the command to run on the target.
       timeout_ms: Maximum time to allow the command to run.
 
     Yields:
-      The responses from the shell command.
+      The responses from the shell command, as str chunks that are not aligned
+      on lines. Use StreamingShellLines() to get lines.
     """
     return self.conn.StreamingCommand(
         service='shell', command=command, timeout_ms=timeout_ms)
 
+  def StreamingShellLines(self, command, timeout_ms=None, decode=True):
+    """Run command on the device, yielding each line of output.
+
+    Args:
+      command: the command to run on the target.
+      timeout_ms: Maximum time to allow the command to run.
+      decode: If True, lines are decoded from utf-8 to unicode. Otherwise they
+          are yielded as str, which is faster for high rate streams.
+
+    Yields:
+      Each line of output without its line terminator, LF or CRLF.
+    """
+    return IterLines(self.StreamingShell(command, timeout_ms), decode)
+
+  def ExecOut(self, command, dest_file=None, timeout_ms=None):
+    """Run command on the device through the exec service, returning the raw
+    output.
+
+    Unlike Shell(), the command doesn't run under a PTY so the output is binary
+    safe: LF is not turned into CRLF, e.g. for 'screencap -p' or 'tar c'.
+    Requires Android 5.0 or later.
+
+    Args:
+      command: the command to run on the target.
+      dest_file: If set, a writable file-like object that receives the output
+          as it comes.
+      timeout_ms: Maximum time to allow the command to run.
+
+    Returns:
+      The output as str if dest_file is not set.
+    """
+    if dest_file is None:
+      return ''.join(self.StreamingExecOut(command, timeout_ms))
+    for data in self.StreamingExecOut(command, timeout_ms):
+      dest_file.write(data)
+
+  def StreamingExecOut(self, command, timeout_ms=None):
+    """Run command on the device through the exec service, yielding the raw
+    output as it comes.
+
+    Args:
+      command: the command to run on the target.
+      timeout_ms: Maximum time to allow the command to run.
+
+    Yields:
+      The output of the command, as str chunks.
+    """
+    return self.conn.StreamingCommand(
+        service='exec', command=command, timeout_ms=timeout_ms)
+
+  def AbbExec(self, args, timeout_ms=None):
+    """Run a command through the Android Binder Bridge, returning the raw output.
+
+    Requires the 'abb_exec' feature. The command is sent directly to the
+    system service, e.g. ['package', 'list', 'packages'], which skips starting
+    a shell and a JVM like 'pm' does.
+
+    Args:
+      args: list of str, the first one is the service name.
+      timeout_ms: Maximum time to allow the command to run.
+
+    Returns:
+      The stdout of the command.
+    """
+    return self.conn.Command(
+        service='abb_exec', command='\0'.join(args), timeout_ms=timeout_ms)
+
+  def OpenShellSession(self, timeout_ms=None):
+    """Opens a long lived shell on the device.
+
+    Returns:
+      ShellSession.
+
+    Raises:
+      AdbCommandFailureException if the device doesn't support exec:.
+    """
+    connection = self.conn.Open(destination='exec:sh', timeout_ms=timeout_ms)
+    if not connection.remote_id:
+      # adbd refuses the services it doesn't know with CLSE(0, local_id).
+      raise usb_exceptions.AdbCommandFailureException(
+          'exec: is not supported')
+    return ShellSession(connection)
+
+  def ShellV2(self, command, stdin=None, timeout_ms=None):
+    """Run command on the device with the shell v2 protocol.
+
+    Requires the 'shell_v2' feature. The command runs without a PTY so the
+    output is not mangled.
+
+    Args:
+      command: the command to run on the target.
+      stdin: optional str to send to the command's stdin.
+      timeout_ms: Maximum time to allow the command to run.
+
+    Returns:
+      tuple(stdout, stderr, exit_code). exit_code is None if the stream was
+      closed before the command exited.
+    """
+    out = {
+        adb_protocol.ShellV2Protocol.ID_STDOUT: [],
+        adb_protocol.ShellV2Protocol.ID_STDERR: [],
+    }
+    exit_code = None
+    for packet_id, data in self.StreamingShellV2(command, stdin, timeout_ms):
+      if packet_id == adb_protocol.ShellV2Protocol.ID_EXIT:
+        exit_code = data
+      else:
+        out[packet_id].append(data)
+    return (
+        ''.join(out[adb_protocol.ShellV2Protocol.ID_STDOUT]),
+        ''.join(out[adb_protocol.ShellV2Protocol.ID_STDERR]),
+        exit_code)
+
+  def StreamingShellV2(self, command, stdin=None, timeout_ms=None):
+    """Run command on the device with the shell v2 protocol, yielding the
+    output as it comes.
+
+    Args:
+      command: the command to run on the target.
+      stdin: optional str to send to the command's stdin.
+      timeout_ms: Maximum time to allow the command to run.
+
+    Yields:
+      tuple(packet_id, data) where packet_id is ShellV2Protocol.ID_STDOUT or
+      ID_STDERR with the output as str, and finally ID_EXIT with the exit code
+      as int.
+    """
+    protocol = adb_protocol.ShellV2Protocol
+    connection = self.conn.Open(
+        destination='shell,v2,raw:%s' % command, timeout_ms=timeout_ms)
+    if stdin:
+      size = self.conn.max_packet_size - protocol.HEADER_SIZE
+      for i in xrange(0, len(stdin), size):
+        connection.Write(protocol.Pack(protocol.ID_STDIN, stdin[i:i+size]))
+    connection.Write(protocol.Pack(protocol.ID_CLOSE_STDIN))
+    for packet_id, data in protocol.Unpack(connection):
+      if packet_id == protocol.ID_EXIT:
+        yield packet_id, ord(data[0]) if data else None
+      elif packet_id in (protocol.ID_STDOUT, protocol.ID_STDERR):
+        yield packet_id, data
+
   def Logcat(self, options, timeout_ms=None):
     """Run 'shell logcat' and stream the output to stdout."""
     return self.conn.StreamingCommand(
         service='shell', command='logcat %s' % options, timeout_ms=timeout_ms)
+
+
+def IterLines(chunks, decode=True):
+  """Splits a stream of str chunks into lines.
+
+  Multibyte characters split across chunks are decoded correctly.
+
+  Args:
+    chunks: iterable of str.
+    decode: If True, lines are decoded from utf-8 to unicode.
+
+  Yields:
+    Each line without its line terminator, LF or CRLF.
+  """
+  decoder = codecs.getincrementaldecoder('utf-8')('replace') if decode else None
+  pending = u'' if decode else ''
+  for chunk in chunks:
+    if decoder:
+      chunk = decoder.decode(chunk)
+    if '\n' not in chunk:
+      pending += chunk
+      continue
+    lines = (pending + chunk).split('\n')
+    pending = lines.pop()
+    for line in lines:
+      yield line[:-1] if line.endswith('\r') else line
+  if decoder:
+    pending += decoder.decode('', final=True)
+  if pending:
+    yield pending[:-1] if pending.endswith('\r') else pending
+
+
+class ShellSession(object):
+  """A long lived shell on the device that runs commands sequentially.
+
+  Saves adbd from forking a new shell for each command. The shell doesn't run
+  under a PTY, so the output is not mangled.
+
+  Each command's output is followed by a unique marker line holding its exit
+  code. stdin of the commands is /dev/null and stderr is merged into stdout.
+  """
+  def __init__(self, connection):
+    self._connection = connection
+    self._chunks = iter(connection)
+    self._buffer = ''
+    # Whether the last Run() sent any part of its command to the device.
+    self.sent = False
+
+  def Run(self, command, marker=None):
+    """Runs command in the session.
+
+    Commands are run in the same shell so they share the current directory
+    and the environment variables. A command calling 'exit' ends the session.
+    The command is passed quoted to eval, so a syntax error or an unbalanced
+    quote fails it instead of leaving the shell waiting for the rest.
+
+    Arguments:
+      command: shell command to run.
+      marker: unique str delimiting the output, random by default.
+
+    Returns:
+      tuple(output, exit_code).
+
+    Raises:
+      AdbCommandFailureException if the session was closed. Check sent to know
+      if the command may have run.
+    """
+    self.sent = False
+    if self._connection.closed:
+      raise usb_exceptions.AdbCommandFailureException(
+          'Shell session closed before running %r' % command)
+    marker = marker or 'adb-%s' % binascii.hexlify(os.urandom(8))
+    script = "{ eval %s\n} </dev/null 2>&1; printf '\\n%s %%d\\n' $?\n" % (
+        pipes.quote(command), marker)
+    size = self._connection.max_packet_size
+    for i in xrange(0, len(script), size):
+      self.sent = True
+      self._connection.Write(script[i:i+size])
+
+    needle = '\n%s ' % marker
+    while True:
+      start = self._buffer.find(needle)
+      if start != -1:
+        end = self._buffer.find('\n', start + len(needle))
+        if end != -1:
+          out = self._buffer[:start]
+          exit_code = int(self._buffer[start + len(needle):end])
+          self._buffer = self._buffer[end+1:]
+          return out, exit_code
+      try:
+        self._buffer += self._chunks.next()
+      except StopIteration:
+        raise usb_exceptions.AdbCommandFailureException(
+            'Shell session closed while running %r' % command)
+
+  def Close(self):
+    self._connection.Close()
@@ -60,7 +60,7 @@ def Wire2ID(encoded):
 
 def _CalculateChecksum(data):
   """The checksum is just a sum of all the bytes. I swear."""
-  return sum(ord(d) for d in data) & 0xFFFFFFFF
+  return sum(bytearray(data)) & 0xFFFFFFFF
 
 
 class AuthSigner(object):
@@ -96,6 +96,8 @@ class _AdbMessageHeader(collections.namedtuple(
 
   # CNXN constants for arg0.
   VERSION = 0x01000000
+  # Data checksums are not computed nor verified.
+  VERSION_SKIP_CHECKSUM = 0x01000001
 
   # AUTH constants for arg0.
   AUTH_TOKEN = 1
@@ -107,7 +109,7 @@ class _AdbMessageHeader(collections.namedtuple(
     assert command_name in cls._VALID_IDS
     assert isinstance(arg0, int), arg0
     assert isinstance(arg1, int), arg1
-    assert isinstance(data, str), repr(data)
+    assert isinstance(data, (str, bytearray)), repr(data)
     return cls(
         ID2Wire(command_name), arg0, arg1, len(data), _CalculateChecksum(data))
 
@@ -160,6 +162,8 @@ class _AdbMessageHeader(collections.namedtuple(
     elif command_name == 'CNXN':
       if arg0 == self.VERSION:
         arg0 = 'v1'
+      elif arg0 == self.VERSION_SKIP_CHECKSUM:
+        arg0 = 'v1-skip-checksum'
       arg1 = 'pktsize:%d' % arg1
     return '%s, %s, %s' % (command_name, arg0, arg1)
 
@@ -173,30 +177,50 @@ class _AdbMessage(object):
     self.header = header
     self.data = data
 
-  def Write(self, usb, timeout_ms=None):
-    """Send this message over USB."""
+  def Write(self, usb, timeout_ms=None, pending=()):
+    """Send this message over USB.
+
+    Args:
+      usb: the handle to write to.
+      timeout_ms: Timeout in milliseconds.
+      pending: packed messages to send first. Only supported when the handle
+          supports combined writes.
+    """
     timeout_ms = usb.Timeout(timeout_ms)
-    # We can't merge these 2 writes, the device wouldn't be able to read the
-    # packet.
     try:
-      usb.BulkWrite(self.header.Packed, timeout_ms)
-      usb.BulkWrite(self.data, timeout_ms)
+      if getattr(usb, 'supports_combined_writes', False):
+        data = self.data
+        if not isinstance(data, str):
+          data = str(buffer(data))
+        usb.BulkWrite(
+            ''.join(list(pending) + [self.header.Packed, data]), timeout_ms)
+      else:
+        assert not pending, pending
+        # We can't merge these 2 writes on USB, the device wouldn't be able to
+        # read the packet.
+        usb.BulkWrite(self.header.Packed, timeout_ms)
+        usb.BulkWrite(self.data, timeout_ms)
     finally:
       self._log_msg(usb)
 
+  @property
+  def Packed(self):
+    """Returns the header and the data as a str."""
+    return self.header.Packed + str(self.data)
+
   @classmethod
-  def Read(cls, usb, timeout_ms=None):
+  def Read(cls, usb, timeout_ms=None, verify_checksum=True):
     """Reads one _AdbMessage.
 
     Returns None if it failed to read the header with a ReadFailedError.
     """
     timeout_ms = usb.Timeout(timeout_ms)
-    packet = usb.BulkRead(24, timeout_ms)
+    packet = cls._ReadExactly(usb, 24, timeout_ms)
     hdr = _AdbMessageHeader.Unpack(packet)
     if hdr.data_length:
-      data = usb.BulkRead(hdr.data_length, timeout_ms)
-      assert len(data) == hdr.data_length, (len(data), hdr.data_length)
-      actual_checksum = _CalculateChecksum(data)
+      data = cls._ReadExactly(usb, hdr.data_length, timeout_ms)
+      actual_checksum = (
+          _CalculateChecksum(data) if verify_checksum else hdr.data_checksum)
       if actual_checksum != hdr.data_checksum:
         raise InvalidResponseError(
             'Received checksum %s != %s' % (actual_checksum, hdr.data_checksum),
@@ -207,6 +231,18 @@ class _AdbMessage(object):
     msg._log_msg(usb)
     return msg
 
+  @staticmethod
+  def _ReadExactly(usb, length, timeout_ms):
+    """Reads length bytes, the device may split them in multiple transfers."""
+    data = usb.BulkRead(length, timeout_ms)
+    while len(data) < length:
+      chunk = usb.BulkRead(length - len(data), timeout_ms)
+      if not chunk:
+        raise usb_exceptions.ReadFailedError(
+            'Got %d bytes out of %d' % (len(data), length), None)
+      data += chunk
+    return data
+
   @classmethod
   def Make(cls, command_name, arg0, arg1, data):
     return cls(_AdbMessageHeader.Make(command_name, arg0, arg1, data), data)
@@ -225,21 +261,84 @@ class _AdbMessage(object):
     return self.header.str_partial()
 
 
+class ShellV2Protocol(object):
+  """Implements the framing of the shell,v2 service.
+
+  As defined in adb's shell_protocol.h, each packet is a 1 byte id, the data
+  length as a 4 bytes little-endian word then the data. It multiplexes stdin,
+  stdout, stderr and the exit code over a single ADB stream.
+  """
+  ID_STDIN = 0
+  ID_STDOUT = 1
+  ID_STDERR = 2
+  ID_EXIT = 3
+  ID_CLOSE_STDIN = 4
+  ID_WINDOW_SIZE_CHANGE = 5
+
+  HEADER_SIZE = struct.calcsize('<BI')
+
+  @staticmethod
+  def Pack(packet_id, data=''):
+    """Returns a packet in its over-the-wire format."""
+    return struct.pack('<BI', packet_id, len(data)) + data
+
+  @classmethod
+  def PackWindowSize(cls, rows, cols, x_pixels=0, y_pixels=0):
+    return cls.Pack(
+        cls.ID_WINDOW_SIZE_CHANGE,
+        '%dx%d,%dx%d' % (rows, cols, x_pixels, y_pixels))
+
+  @classmethod
+  def Unpack(cls, chunks):
+    """Yields tuple(packet_id, data) from an iterator of raw stream data.
+
+    Packets can be split across or merged in the ADB packets.
+    """
+    buf = ''
+    for chunk in chunks:
+      buf = buf + chunk if buf else chunk
+      offset = 0
+      while len(buf) - offset >= cls.HEADER_SIZE:
+        packet_id, length = struct.unpack_from('<BI', buf, offset)
+        start = offset + cls.HEADER_SIZE
+        if len(buf) - start < length:
+          break
+        yield packet_id, buf[start:start + length]
+        offset = start + length
+      buf = buf[offset:]
+    if buf:
+      _LOG.warning('Dropping truncated shell v2 packet: %r', buf[:16])
+
+
 class _AdbConnection(object):
   """One logical ADB connection to a service."""
   class _MessageQueue(object):
-    def __init__(self, manager):
+    def __init__(self, manager, connection):
       self._queue = Queue.Queue()
       self._manager = manager
+      self._connection = connection
 
     def __iter__(self):
       return self
 
+    def __enter__(self):
+      return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+      self.Cancel()
+
+    def Cancel(self):
+      """Cancels the stream, see _AdbConnection.Cancel()."""
+      self._connection.Cancel()
+
     def next(self):
       while True:
         try:
           i = self._queue.get_nowait()
         except Queue.Empty:
+          if self._connection._write_error:
+            # The device won't send more data without the lost OKAY.
+            raise self._connection._write_error
           # Will reentrantly call self._Add() via parent._OnRead()
           if not self._manager.ReadAndDispatch():
             # Failed to read from the device, the connection likely dropped.
@@ -255,6 +354,23 @@ class _AdbConnection(object):
     def _Close(self):
       self._queue.put(StopIteration())
 
+  class _ClosedQueue(object):
+    """Stands for the _MessageQueue of an already closed connection."""
+    def __iter__(self):
+      return self
+
+    def next(self):
+      raise StopIteration()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+      pass
+
+    def Cancel(self):
+      pass
+
   def __init__(self, manager, local_id, service_name):
     # ID as given by the remote device.
     self.remote_id = 0
@@ -262,8 +378,10 @@ class _AdbConnection(object):
     self.service_name = service_name
     # Self assigned local ID.
     self._local_id = local_id
-    self._yielder = self._MessageQueue(manager)
+    self._yielder = self._MessageQueue(manager, self)
     self._manager = manager
+    # WriteFailedError of a queued message of this stream sent by another one.
+    self._write_error = None
 
   @property
   def local_id(self):
@@ -273,7 +391,7 @@ class _AdbConnection(object):
   def __iter__(self):
     # If self._yielder is None, it means it has already closed. Return a fake
     # iterator with nothing in it.
-    return self._yielder or []
+    return self._yielder or self._ClosedQueue()
 
   def Make(self, command_name, data):
     return _AdbMessage.Make(command_name, self._local_id, self.remote_id, data)
@@ -281,12 +399,38 @@ class _AdbConnection(object):
   def _Write(self, command_name, data):
     assert len(data) <= self.max_packet_size, '%d > %d' % (
         len(data), self.max_packet_size)
-    self.Make(command_name, data).Write(self._manager._usb)
+    self._manager._WriteMessage(self.Make(command_name, data), self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exc_value, _traceback):
+    self.Cancel()
+
+  def Cancel(self):
+    """Closes the stream without reading the remaining data.
+
+    Sends CLSE right away and unregisters the connection. Packets still in
+    flight for this connection are dropped by the manager without being
+    acknowledged. Does nothing if the stream is already closed.
+    """
+    with self._manager._lock:
+      if not self._yielder:
+        return
+      self._yielder._Close()
+      self._yielder = None
+      self._manager._cancelled.add(self._local_id)
+      self._manager._UnregisterLocked(self._local_id)
+    try:
+      self._Write('CLSE', '')
+    except usb_exceptions.WriteFailedError as e:
+      _LOG.info('%s.Cancel(): Failed to send CLSE: %s', self.port_path, e)
 
   def Close(self):
     """User initiated stream close.
 
-    It's rare that the user needs to do this.
+    It's rare that the user needs to do this. Use Cancel() to not wait for the
+    remaining data.
     """
     try:
       self._Write('CLSE', '')
@@ -304,6 +448,11 @@ class _AdbConnection(object):
   def port_path(self):
     return self._manager.port_path
 
+  @property
+  def closed(self):
+    """True once the stream is known to be closed by either side."""
+    return not self._yielder
+
   def _HasClosed(self):
     """Must be called with the manager lock held."""
     if self._yielder:
@@ -329,10 +478,16 @@ class _AdbConnection(object):
     if cmd_name == 'OKAY':
       return
     if cmd_name == 'WRTE':
-      try:
-        self._Write('OKAY', '')
-      except usb_exceptions.WriteFailedError as e:
-        _LOG.info('%s._OnRead(): Failed to reply OKAY: %s', self.port_path, e)
+      if self._manager._combined_writes:
+        # Sent along the next write, or before the next read.
+        self._manager._QueueWrite(self, self.Make('OKAY', ''))
+      else:
+        try:
+          self._Write('OKAY', '')
+        except usb_exceptions.WriteFailedError as e:
+          _LOG.info(
+              '%s._OnRead(): Failed to reply OKAY: %s', self.port_path, e)
+          self._write_error = e
       self._yielder._Add(message)
       return
     if cmd_name == 'AUTH':
@@ -349,6 +504,23 @@ class _AdbConnection(object):
   def Write(self, data):
     self._Write('WRTE', data)
 
+  @property
+  def can_write_file(self):
+    """True if WriteFile() can be used."""
+    return self._manager.can_write_file
+
+  def WriteFile(self, prefix, fd, offset, length):
+    """Writes prefix then length bytes of the file descriptor fd at offset as a
+    single WRTE message, without reading the file in Python.
+    """
+    size = len(prefix) + length
+    assert size <= self.max_packet_size, '%d > %d' % (
+        size, self.max_packet_size)
+    # The checksum is not needed, see can_write_file.
+    header = _AdbMessageHeader(
+        ID2Wire('WRTE'), self._local_id, self.remote_id, size, 0)
+    self._manager._WriteFileMessage(header, prefix, fd, offset, length, self)
+
   def ReadUntil(self, _):
     return 'WRTE', self._yielder.next()
 
@@ -370,8 +542,23 @@ class AdbConnectionManager(object):
     self.max_packet_size = 0
     # Banner replied in CNXN packet.
     self.state = None
+    # Features advertised by the device in its banner, e.g. 'shell_v2'.
+    self.features = frozenset()
+    # Protocol version; the one proposed until the device replies. Skipping
+    # checksums is only proposed on handles that can send files directly.
+    if getattr(usb, 'supports_sendfile', False):
+      self.version = _AdbMessageHeader.VERSION_SKIP_CHECKSUM
+    else:
+      self.version = _AdbMessageHeader.VERSION
     # Multiplexed stream handling.
     self._connections = {}
+    # Local IDs of the connections cancelled but not yet closed by the device.
+    self._cancelled = set()
+    # When the handle supports it, small messages like OKAY are queued to be
+    # sent in the same write as the next message.
+    self._combined_writes = getattr(usb, 'supports_combined_writes', False)
+    self._pending_lock = threading.Lock()
+    self._pending_writes = []
     self._next_local_id = 16
 
   @classmethod
@@ -407,6 +594,17 @@ class AdbConnectionManager(object):
   def port_path(self):
     return self._usb.port_path
 
+  @property
+  def can_write_file(self):
+    """True if file content can be sent directly from a file descriptor.
+
+    This requires checksums to be skipped, since computing them would require
+    reading the data.
+    """
+    return (
+        self.version >= _AdbMessageHeader.VERSION_SKIP_CHECKSUM and
+        getattr(self._usb, 'supports_sendfile', False))
+
   def Open(self, destination, timeout_ms=None):
     """Opens a new connection to the device via an OPEN message.
 
@@ -430,12 +628,20 @@ class AdbConnectionManager(object):
     # TODO(maruel): Timeout.
     # Reads until we got the proper remote id.
     while True:
-      msg = _AdbMessage.Read(self._usb, timeout_ms)
-      if msg.header.arg1 == conn.local_id:
-        conn.remote_id = msg.header.arg0
+      self._FlushWrites()
+      msg = self._ReadMessage(timeout_ms)
+      with self._lock:
+        if self._DropCancelledLocked(msg):
+          continue
+        if msg.header.arg1 != conn.local_id:
+          # For another stream, e.g. the OKAY of a previous write.
+          other = self._connections.get(msg.header.arg1)
+          if other:
+            other._OnRead(msg)
+          continue
+      conn.remote_id = msg.header.arg0
       conn._OnRead(msg)
-      if msg.header.arg1 == conn.local_id:
-        return conn
+      return conn
 
   def Close(self):
     """Also closes the usb handle."""
@@ -462,20 +668,59 @@ class AdbConnectionManager(object):
     """
     return self.Open('%s:%s' % (service, command), timeout_ms).__iter__()
 
-  def Command(self, service, command='', timeout_ms=None):
-    return ''.join(self.StreamingCommand(service, command, timeout_ms))
+  def Command(
+      self, service, command='', timeout_ms=None, sink=None, max_size=None):
+    """Sends service:command in a new connection, returning the response.
+
+    Args:
+      service: The service on the device to talk to.
+      command: The command to send to the service.
+      timeout_ms: Timeout for USB packets, in milliseconds.
+      sink: If set, a writable file-like object or a callable that receives
+          the response as it comes instead of holding it in memory.
+      max_size: If set, the response is truncated to this many bytes. The
+          rest of the stream is cancelled.
+
+    Returns:
+      The response as str, None if sink is set.
+    """
+    chunks = self.StreamingCommand(service, command, timeout_ms)
+    if sink is None and max_size is None:
+      return ''.join(chunks)
+    out = []
+    if sink is None:
+      write = out.append
+    else:
+      write = getattr(sink, 'write', sink)
+    remaining = max_size
+    for chunk in chunks:
+      if remaining is not None:
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+      write(chunk)
+      if remaining is not None and remaining <= 0:
+        chunks.Cancel()
+        break
+    if sink is None:
+      return ''.join(out)
+    return None
 
   def ReadAndDispatch(self, timeout_ms=None):
     """Receive a response from the device."""
     with self._lock:
       try:
-        msg = _AdbMessage.Read(self._usb, timeout_ms)
+        if not self._FlushWrites():
+          # Let the caller check if the failure was for its stream.
+          return True
+        msg = self._ReadMessage(timeout_ms)
       except usb_exceptions.ReadFailedError as e:
         # adbd could be rebooting, etc. Return None to signal that this kind of
         # failure is expected.
         _LOG.info(
             '%s.ReadAndDispatch(): Masking read error %s', self.port_path, e)
         return False
+      if self._DropCancelledLocked(msg):
+        return True
       conn = self._connections.get(msg.header.arg1)
       if not conn:
         # It's likely a tored down connection from a previous ADB instance,
@@ -492,13 +737,16 @@ class AdbConnectionManager(object):
   def _Connect(self):
     """Connect to the device."""
     with self._lock:
+      # The device forgets all the streams on a new connection, so the CLSE
+      # for the cancelled ones will never come.
+      self._cancelled.clear()
       reply = None
       start = time.time()
       nb = 0
       _LOG.debug('Emptying the connection first')
       while True:
         try:
-          msg = _AdbMessage.Read(self._usb, 20)
+          msg = self._ReadMessage(20)
         except usb_exceptions.ReadFailedError:
           break
         nb += 1
@@ -515,10 +763,10 @@ class AdbConnectionManager(object):
 
       if not reply:
         msg = _AdbMessage.Make(
-            'CNXN', _AdbMessageHeader.VERSION, self.MAX_ADB_DATA,
+            'CNXN', self.version, self.MAX_ADB_DATA,
             'host::%s\0' % self._host_banner)
         msg.Write(self._usb)
-        reply = _AdbMessage.Read(self._usb)
+        reply = self._ReadMessage()
       if reply.header.command_name == 'AUTH':
         self._HandleAUTH(reply)
       else:
@@ -544,9 +792,10 @@ class AdbConnectionManager(object):
           self._rsa_keys[0].GetPublicKey() + '\0')
       msg.Write(self._usb)
       try:
-        reply = _AdbMessage.Read(self._usb, self._auth_timeout_ms)
+        reply = self._ReadMessage(self._auth_timeout_ms)
       except usb_exceptions.ReadFailedError as e:
-        if e.usb_error.value == -7:  # Timeout.
+        # usb_error is None when the handle is not backed by libusb.
+        if getattr(e.usb_error, 'value', None) == -7:  # Timeout.
           raise usb_exceptions.DeviceAuthError(
               'Accept auth key on device, then retry.')
         raise
@@ -557,9 +806,12 @@ class AdbConnectionManager(object):
     if reply.header.command_name != 'CNXN':
       raise usb_exceptions.DeviceAuthError(
           'Accept auth key on device, then retry.')
-    if reply.header.arg0 != _AdbMessageHeader.VERSION:
+    if reply.header.arg0 not in (
+        _AdbMessageHeader.VERSION, _AdbMessageHeader.VERSION_SKIP_CHECKSUM):
       raise InvalidResponseError('Unknown CNXN response', reply)
+    self.version = min(self.version, reply.header.arg0)
     self.state = reply.data
+    self.features = self._ParseFeatures(reply.data)
     self.max_packet_size = reply.header.arg1
     _LOG.debug(
         '%s._HandleCNXN(): max packet size: %d',
@@ -568,6 +820,19 @@ class AdbConnectionManager(object):
       conn._HasClosed()
     self._connections = {}
 
+  @staticmethod
+  def _ParseFeatures(banner):
+    """Returns the features listed in a CNXN banner.
+
+    The banner looks like
+    'device::ro.product.name=foo;ro.product.model=bar;features=shell_v2,cmd'.
+    """
+    props = banner.rstrip('\0').split(':', 2)[-1]
+    for prop in props.split(';'):
+      if prop.startswith('features='):
+        return frozenset(f for f in prop[len('features='):].split(',') if f)
+    return frozenset()
+
   def _HandleReplyChallenge(self, rsa_key, reply, auth_timeout_ms):
     # self._lock must be held.
     if (reply.header.arg0 != _AdbMessageHeader.AUTH_TOKEN or
@@ -578,7 +843,7 @@ class AdbConnectionManager(object):
     msg = _AdbMessage.Make(
         'AUTH', _AdbMessageHeader.AUTH_SIGNATURE, 0, rsa_key.Sign(reply.data))
     msg.Write(self._usb)
-    return _AdbMessage.Read(self._usb, auth_timeout_ms)
+    return self._ReadMessage(auth_timeout_ms)
 
   def _Unregister(self, conn_id):
     with self._lock:
@@ -587,3 +852,75 @@ class AdbConnectionManager(object):
   def _UnregisterLocked(self, conn_id):
     # self._lock must be held.
     self._connections.pop(conn_id, None)
+
+  def _QueueWrite(self, connection, message):
+    with self._pending_lock:
+      self._pending_writes.append((connection, message.Packed))
+
+  def _TakePendingWrites(self):
+    """Returns the queued (connection, packed message) and empties the queue."""
+    with self._pending_lock:
+      pending, self._pending_writes = self._pending_writes, []
+    return pending
+
+  @staticmethod
+  def _FailPendingWrites(pending, error, writer=None):
+    """Reports a failed write to the connections whose queued messages were
+    part of it, besides writer which gets the exception directly.
+    """
+    for connection, _ in pending:
+      if connection is not writer:
+        connection._write_error = error
+
+  def _WriteMessage(self, message, writer=None):
+    """Writes a message along the queued ones."""
+    pending = self._TakePendingWrites()
+    try:
+      message.Write(self._usb, pending=[packed for _, packed in pending])
+    except usb_exceptions.WriteFailedError as e:
+      self._FailPendingWrites(pending, e, writer)
+      raise
+
+  def _WriteFileMessage(self, header, prefix, fd, offset, length, writer=None):
+    """Writes a message whose data is prefix followed by a file region."""
+    pending = self._TakePendingWrites()
+    try:
+      self._usb.BulkWriteFile(
+          ''.join([packed for _, packed in pending] + [header.Packed, prefix]),
+          fd, offset, length)
+    except usb_exceptions.WriteFailedError as e:
+      self._FailPendingWrites(pending, e, writer)
+      raise
+
+  def _ReadMessage(self, timeout_ms=None):
+    """Reads one _AdbMessage, verifying the checksum if the protocol version
+    requires it.
+    """
+    return _AdbMessage.Read(
+        self._usb, timeout_ms,
+        self.version < _AdbMessageHeader.VERSION_SKIP_CHECKSUM)
+
+  def _FlushWrites(self):
+    """Writes the queued messages, must be called before a blocking read.
+
+    Returns False if it failed, in which case the connections whose messages
+    were lost get the error.
+    """
+    pending = self._TakePendingWrites()
+    if pending:
+      try:
+        self._usb.BulkWrite(''.join(packed for _, packed in pending))
+      except usb_exceptions.WriteFailedError as e:
+        _LOG.info('%s._FlushWrites(): %s', self.port_path, e)
+        self._FailPendingWrites(pending, e)
+        return False
+    return True
+
+  def _DropCancelledLocked(self, msg):
+    """Returns True if msg is for a cancelled connection and was dropped."""
+    # self._lock must be held.
+    if msg.header.arg1 not in self._cancelled:
+      return False
+    if msg.header.command_name == 'CLSE':
+      self._cancelled.discard(msg.header.arg1)
+    return True
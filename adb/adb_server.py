@@ -0,0 +1,396 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handle to reach a device through a running adb server.
+
+The adb server owns the USB devices, so using it lets other tools use the
+device at the same time instead of having to kill the server.
+
+The server talks the "smart socket" protocol on localhost:5037 as described in
+adb's SERVICES.TXT: each request is prefixed by its length as 4 hex digits and
+is replied with OKAY or FAIL. A socket switched to a device with
+host:transport:<serial> then opens one service and becomes a raw stream for
+it. AdbServerHandle translates the ADB messages sent by AdbConnectionManager
+into one such socket per stream, so the rest of the stack is unchanged.
+"""
+
+import collections
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+
+from adb import adb_protocol
+from adb import common
+from adb import usb_exceptions
+
+
+_LOG = logging.getLogger('adb.server')
+_LOG.setLevel(logging.ERROR)
+
+
+DEFAULT_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', '5037'))
+
+
+class _Stream(object):
+  """One ADB stream, backed by its own socket to the adb server."""
+
+  def __init__(self, sock, local_id, remote_id):
+    self.sock = sock
+    # ID assigned by AdbConnectionManager.
+    self.local_id = local_id
+    # ID assigned by AdbServerHandle, as adbd would.
+    self.remote_id = remote_id
+    # Set when the last WRTE sent to the host was acknowledged.
+    self.acked = threading.Event()
+    self.acked.set()
+    # Payloads of the WRTE received from the host, sent by _Writer(). None
+    # stops it.
+    self.writes = Queue.Queue()
+
+  def Close(self):
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.sock.close()
+    # Unblocks _Pump() and _Writer().
+    self.acked.set()
+    self.writes.put(None)
+
+
+class AdbServerHandle(common.Handle):
+  """Reaches a device through a running adb server.
+
+  Provides the same interface as UsbHandle; it emulates adbd's side of the ADB
+  protocol on top of the adb server.
+  """
+
+  # Maximum amount of data in a WRTE packet sent to the host.
+  MAX_DATA = 256*1024
+
+  def __init__(self, serial, timeout_ms=None, host='127.0.0.1', port=None):
+    """Initialize the handle.
+
+    Arguments:
+      serial: Android device serial as listed by 'adb devices'.
+      timeout_ms: Timeout in milliseconds for all I/O.
+      host: host running the adb server.
+      port: port of the adb server, defaults to $ANDROID_ADB_SERVER_PORT or
+          5037.
+    """
+    super(AdbServerHandle, self).__init__(serial=serial, timeout_ms=timeout_ms)
+    self._host = host
+    self._port = port or DEFAULT_PORT
+    self._features = ''
+    self._is_open = False
+    self._max_data = self.MAX_DATA
+
+    # Data written by AdbConnectionManager that is not a full message yet.
+    self._write_lock = threading.Lock()
+    self._pending = ''
+
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+    # Packed messages to be read by AdbConnectionManager.
+    self._out = collections.deque()
+    self._out_size = 0
+    # Keys are the remote ids.
+    self._streams = {}
+    self._next_id = 1
+    # Incremented when all the streams are dropped, so the ones being opened
+    # at that time are discarded.
+    self._generation = 0
+
+  @classmethod
+  def FindDevices(cls, host='127.0.0.1', port=None, timeout_ms=None):
+    """Yields an unopened AdbServerHandle for each device the adb server has
+    online.
+    """
+    handle = cls('', timeout_ms=timeout_ms, host=host, port=port)
+    for line in handle._Query('host:devices').splitlines():
+      serial, _, state = line.partition('\t')
+      if state == 'device':
+        yield cls(serial, timeout_ms=timeout_ms, host=host, port=port)
+
+  @property
+  def is_open(self):
+    return self._is_open
+
+  @property
+  def supports_combined_writes(self):
+    # Messages are parsed back from the written stream.
+    return True
+
+  def Open(self):
+    serial = self.serial_number
+    _LOG.info('Open() on %s through %s:%s', serial, self._host, self._port)
+    try:
+      self._features = self._Query('host-serial:%s:features' % serial)
+    except usb_exceptions.AdbCommandFailureException as e:
+      raise usb_exceptions.DeviceNotFoundError(
+          'Device %s not found by the adb server: %s', serial, e)
+    with self._write_lock:
+      self._pending = ''
+    with self._lock:
+      self._out.clear()
+      self._out_size = 0
+      self._is_open = True
+
+  def Close(self):
+    with self._lock:
+      self._is_open = False
+      self._generation += 1
+      streams = self._streams.values()
+      self._streams = {}
+      self._cond.notify_all()
+    for stream in streams:
+      stream.Close()
+
+  def BulkWrite(self, data, timeout_ms=None):
+    if not self._is_open:
+      raise usb_exceptions.WriteFailedError(
+          'Connection to %s closed' % self.serial_number, None)
+    with self._write_lock:
+      self._pending += data
+      while len(self._pending) >= 24:
+        header = adb_protocol._AdbMessageHeader.Unpack(self._pending[:24])
+        end = 24 + header.data_length
+        if len(self._pending) < end:
+          break
+        payload = self._pending[24:end]
+        self._pending = self._pending[end:]
+        self._OnMessage(header, payload)
+
+  def BulkRead(self, length, timeout_ms=None):
+    """Returns exactly length bytes."""
+    timeout_ms = self.Timeout(timeout_ms)
+    deadline = time.time() + timeout_ms / 1000.
+    with self._cond:
+      while self._out_size < length:
+        if not self._is_open:
+          raise usb_exceptions.ReadFailedError(
+              'Connection to %s closed' % self.serial_number, None)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise usb_exceptions.ReadFailedError(
+              'Could not receive data (timeout %sms)' % timeout_ms, None)
+        self._cond.wait(remaining)
+      out = []
+      needed = length
+      while needed:
+        chunk = self._out.popleft()
+        if len(chunk) > needed:
+          self._out.appendleft(chunk[needed:])
+          chunk = chunk[:needed]
+        out.append(chunk)
+        needed -= len(chunk)
+      self._out_size -= length
+      return ''.join(out)
+
+  def _OnMessage(self, header, data):
+    """Handles one message sent by AdbConnectionManager, like adbd would."""
+    command_name = header.command_name
+    if command_name == 'CNXN':
+      with self._lock:
+        self._generation += 1
+        streams = self._streams.values()
+        self._streams = {}
+      for stream in streams:
+        stream.Close()
+      self._max_data = min(header.arg1, self.MAX_DATA)
+      self._Queue(
+          'CNXN', adb_protocol._AdbMessageHeader.VERSION, self._max_data,
+          'device::features=%s' % self._features)
+    elif command_name == 'OPEN':
+      # Connecting to the adb server takes a few round trips; don't hold the
+      # other streams meanwhile.
+      with self._lock:
+        generation = self._generation
+      thread = threading.Thread(
+          target=self._OnOpen,
+          args=(header.arg0, data.rstrip('\0'), generation),
+          name='adb-server-%s-open' % self.serial_number)
+      thread.daemon = True
+      thread.start()
+    elif command_name == 'WRTE':
+      stream = self._streams.get(header.arg1)
+      if stream:
+        stream.writes.put(data)
+    elif command_name == 'OKAY':
+      stream = self._streams.get(header.arg1)
+      if stream:
+        stream.acked.set()
+    elif command_name == 'CLSE':
+      if self._CloseStream(self._streams.get(header.arg1)):
+        self._Queue('CLSE', header.arg1, header.arg0)
+    else:
+      _LOG.warning('%s: ignoring %s', self.serial_number, header)
+
+  def _OnOpen(self, local_id, service, generation):
+    """Opens the stream's socket, then sends the WRTE payloads to it.
+
+    Runs in its own thread so a slow or stalled stream doesn't block the
+    others.
+    """
+    try:
+      sock = self._Request('host:transport:%s' % self.serial_number)
+    except (socket.error, usb_exceptions.AdbCommandFailureException) as e:
+      _LOG.info('%s: transport failed: %s', self.serial_number, e)
+      self._Queue('CLSE', 0, local_id)
+      return
+    try:
+      self._Send(sock, service)
+    except (socket.error, usb_exceptions.AdbCommandFailureException) as e:
+      _LOG.info('%s: open(%r) failed: %s', self.serial_number, service, e)
+      sock.close()
+      self._Queue('CLSE', 0, local_id)
+      return
+    with self._lock:
+      if not self._is_open or self._generation != generation:
+        sock.close()
+        return
+      stream = _Stream(sock, local_id, self._next_id)
+      self._next_id += 1
+      self._streams[stream.remote_id] = stream
+      self._QueueLocked('OKAY', stream.remote_id, local_id)
+    thread = threading.Thread(
+        target=self._Pump, args=(stream,),
+        name='adb-server-%s-%d' % (self.serial_number, stream.remote_id))
+    thread.daemon = True
+    thread.start()
+    self._Writer(stream)
+
+  def _Writer(self, stream):
+    """Sends the WRTE payloads received from the host to the stream socket.
+
+    The socket keeps the handle's timeout, so a stream that stops reading is
+    closed instead of hanging.
+    """
+    while True:
+      data = stream.writes.get()
+      if data is None:
+        return
+      try:
+        stream.sock.sendall(data)
+      except socket.error as e:
+        _LOG.info('%s: write failed: %s', self.serial_number, e)
+        if self._CloseStream(stream):
+          self._Queue('CLSE', stream.remote_id, stream.local_id)
+        return
+      self._Queue('OKAY', stream.remote_id, stream.local_id)
+
+  def _Pump(self, stream):
+    """Forwards the data received on the stream socket as WRTE messages.
+
+    Waits for each WRTE to be acknowledged before reading more, like adbd.
+    """
+    while True:
+      try:
+        data = stream.sock.recv(self._max_data)
+      except socket.timeout:
+        # The stream is idle; the timeout is meant for the writes.
+        data = None
+      except socket.error:
+        data = ''
+      with self._lock:
+        if self._streams.get(stream.remote_id) is not stream:
+          # Closed by the host.
+          return
+        if data is None:
+          continue
+        if not data:
+          del self._streams[stream.remote_id]
+          self._QueueLocked('CLSE', stream.remote_id, stream.local_id)
+          break
+        stream.acked.clear()
+        self._QueueLocked('WRTE', stream.remote_id, stream.local_id, data)
+      stream.acked.wait()
+    stream.Close()
+
+  def _CloseStream(self, stream):
+    """Unregisters and closes a stream. Returns False if it was not open."""
+    if not stream:
+      return False
+    with self._lock:
+      if self._streams.pop(stream.remote_id, None) is not stream:
+        return False
+    stream.Close()
+    return True
+
+  def _Queue(self, command_name, arg0, arg1, data=''):
+    with self._lock:
+      self._QueueLocked(command_name, arg0, arg1, data)
+
+  def _QueueLocked(self, command_name, arg0, arg1, data=''):
+    # self._lock must be held.
+    msg = adb_protocol._AdbMessage.Make(command_name, arg0, arg1, data)
+    self._out.append(msg.header.Packed)
+    self._out_size += 24
+    if data:
+      self._out.append(data)
+      self._out_size += len(data)
+    self._cond.notify_all()
+
+  # Smart socket protocol.
+
+  def _Request(self, request):
+    """Connects to the adb server and sends request; returns the socket."""
+    sock = socket.create_connection(
+        (self._host, self._port), self._timeout_ms / 1000.)
+    try:
+      self._Send(sock, request)
+    except (socket.error, usb_exceptions.AdbCommandFailureException):
+      sock.close()
+      raise
+    return sock
+
+  def _Query(self, request):
+    """Sends a host request and returns the length prefixed reply."""
+    try:
+      sock = self._Request(request)
+    except socket.error as e:
+      raise usb_exceptions.ReadFailedError(
+          'Could not reach the adb server at %s:%s' % (self._host, self._port),
+          e)
+    try:
+      return self._RecvExactly(sock, int(self._RecvExactly(sock, 4), 16))
+    finally:
+      sock.close()
+
+  @classmethod
+  def _Send(cls, sock, request):
+    """Sends one request and waits for it to be accepted."""
+    sock.sendall('%04x%s' % (len(request), request))
+    status = cls._RecvExactly(sock, 4)
+    if status == 'OKAY':
+      return
+    if status == 'FAIL':
+      message = cls._RecvExactly(sock, int(cls._RecvExactly(sock, 4), 16))
+    else:
+      message = 'unexpected status %r' % status
+    raise usb_exceptions.AdbCommandFailureException(
+        '%s: %s' % (request, message))
+
+  @staticmethod
+  def _RecvExactly(sock, length):
+    out = []
+    while length:
+      data = sock.recv(length)
+      if not data:
+        raise socket.error('adb server closed the connection')
+      out.append(data)
+      length -= len(data)
+    return ''.join(out)
@@ -16,9 +16,19 @@
 Common usb browsing, and usb communication.
 """
 
+import ctypes
+import ctypes.util
+import errno
 import logging
+import math
+import mmap
+import os
+import select
 import socket
+import stat
+import sys
 import threading
+import time
 import traceback
 
 import libusb1
@@ -45,9 +55,523 @@ def InterfaceMatcher(clazz, subclass, protocol):
     for setting in device.iterSettings():
       if GetInterface(setting) == interface:
         return setting
+  # Lets UsbHandle.FindDevices() look the devices up in USB_REGISTRY's index.
+  Matcher.interface = interface
   return Matcher
 
 
+class MappedFile(object):
+  """Read-only file-like object backed by a memory mapping of a local file.
+
+  read() returns views into the mapping instead of newly allocated strings, so
+  fastboot downloads go from the page cache to BulkWrite() without a copy; adb
+  pushes still copy the data in their packet buffer. The views are ctypes
+  arrays, they support the buffer interface and len().
+
+  Only non empty regular files can be mapped, see CanMap(). The size of the
+  others, e.g. FIFOs or files in /proc and /sys, isn't known in advance so they
+  have to be read.
+
+  The mappings are shared, so flashing or pushing the same file to multiple
+  devices at once maps it only once.
+  """
+
+  # Keys is (st_dev, st_ino, st_size, st_mtime), value is [mmap, refcount].
+  _MAPPINGS = {}
+  _MAPPINGS_LOCK = threading.Lock()
+
+  def __init__(self, path):
+    st = os.stat(path)
+    self._key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    self._size = st.st_size
+    self._offset = 0
+    self._mmap = None
+    if not self._size:
+      # Empty files can't be mapped.
+      return
+    with self._MAPPINGS_LOCK:
+      entry = self._MAPPINGS.get(self._key)
+      if not entry:
+        with open(path, 'rb') as f:
+          # ACCESS_COPY is a private writable mapping. It is never written to
+          # but it is required to create ctypes views, which in turn lets usb1
+          # use the memory as is.
+          entry = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY), 0]
+        self._MAPPINGS[self._key] = entry
+      entry[1] += 1
+      self._mmap = entry[0]
+
+  @staticmethod
+  def CanMap(path):
+    """Returns True if path is a regular file with content."""
+    st = os.stat(path)
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+  def __len__(self):
+    return self._size
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def read(self, size=-1):
+    """Returns a view of up to size bytes, or '' at the end of the file."""
+    if size < 0 or size > self._size - self._offset:
+      size = self._size - self._offset
+    if size <= 0:
+      return ''
+    view = (ctypes.c_char * size).from_buffer(self._mmap, self._offset)
+    self._offset += size
+    return view
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._offset
+    elif whence == os.SEEK_END:
+      offset += self._size
+    self._offset = max(0, offset)
+
+  def tell(self):
+    return self._offset
+
+  def close(self):
+    """Releases the shared mapping.
+
+    The mapping itself is unmapped once all the views into it are freed.
+    """
+    if not self._mmap:
+      return
+    self._mmap = None
+    with self._MAPPINGS_LOCK:
+      entry = self._MAPPINGS[self._key]
+      entry[1] -= 1
+      if not entry[1]:
+        del self._MAPPINGS[self._key]
+
+
+def _LoadSendFile():
+  """Returns the best sendfile(out_fd, in_fd, offset, count) implementation
+  available, or None.
+  """
+  if hasattr(os, 'sendfile'):
+    return os.sendfile
+  # The ctypes signature below is the Linux one, with a 64 bits off_t.
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    sendfile = libc.sendfile
+  except (AttributeError, OSError, TypeError):
+    return None
+  sendfile.restype = ctypes.c_ssize_t
+  sendfile.argtypes = (
+      ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+      ctypes.c_size_t)
+  def wrapper(out_fd, in_fd, offset, count):
+    off = ctypes.c_int64(offset)
+    sent = sendfile(out_fd, in_fd, ctypes.byref(off), count)
+    if sent < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return sent
+  return wrapper
+
+
+_SENDFILE = _LoadSendFile()
+
+
+def _SendFile(sock, fd, offset, length):
+  """Sends length bytes of fd from offset over sock.
+
+  Uses the kernel sendfile() when available, else reads and writes the data.
+  """
+  end = offset + length
+  if _SENDFILE:
+    timeout = sock.gettimeout()
+    while offset < end:
+      try:
+        sent = _SENDFILE(sock.fileno(), fd, offset, end - offset)
+      except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          raise
+        # Sockets with a timeout are non-blocking, wait until writable.
+        _, writable, _ = select.select([], [sock], [], timeout)
+        if not writable:
+          raise socket.timeout('sendfile() timed out')
+        continue
+      if not sent:
+        raise socket.error('File %d is shorter than expected' % fd)
+      offset += sent
+    return
+  os.lseek(fd, offset, os.SEEK_SET)
+  while offset < end:
+    data = os.read(fd, min(end - offset, 1024*1024))
+    if not data:
+      raise socket.error('File %d is shorter than expected' % fd)
+    sock.sendall(data)
+    offset += len(data)
+
+
+class UsbRegistry(object):
+  """Process-wide libusb context that tracks devices arrival and departure.
+
+  When libusb supports hotplug, a background thread handles the events so
+  callers can wait for a device to show up instead of polling the bus. The
+  attached devices are then indexed by their port path and interfaces as they
+  arrive, so looking one up doesn't enumerate the bus.
+
+  It also indexes the serial number of the attached devices.
+
+  When a UsbPoller is attached, the events are handled by the thread calling
+  UsbPoller.poll() instead.
+  """
+
+  def __init__(self):
+    # Reentrant since the hotplug callback is called for the devices already
+    # attached while registering it.
+    self._lock = threading.RLock()
+    self._cond = threading.Condition(self._lock)
+    self._context = None
+    self._has_hotplug = False
+    # Incremented on each device arrival or departure.
+    self._generation = 0
+    # Keys is _DeviceKey(), value is (usb1.USBDevice, port path, frozenset of
+    # GetInterface() of its settings). Only maintained with hotplug support.
+    self._devices = {}
+    # Keys is the port path, value is the generation of the last arrival there.
+    self._arrivals = {}
+    self._last_arrival = 0
+    # Keys is _DeviceKey(), value is the serial number. Reading the serial
+    # number requires opening the device, so it is done once per attach.
+    self._serials = {}
+    # UsbPoller handling the events, if any.
+    self._poller = None
+    # Thread handling the events when there's no UsbPoller.
+    self._thread = None
+    # Cleared while a UsbPoller handles the events.
+    self._thread_events = threading.Event()
+    self._thread_events.set()
+
+  @property
+  def context(self):
+    """Returns the shared usb1.USBContext, initializing it as needed."""
+    with self._lock:
+      if not self._context:
+        self._context = usb1.USBContext()
+        if usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+          # Enumerates the devices already attached to seed the index.
+          self._context.hotplugRegisterCallback(
+              self._OnHotplug, flags=usb1.HOTPLUG_ENUMERATE)
+          self._StartThread()
+          self._has_hotplug = True
+      return self._context
+
+  @property
+  def has_hotplug(self):
+    return self._has_hotplug
+
+  @property
+  def polled(self):
+    """True if a UsbPoller handles the libusb events."""
+    return bool(self._poller)
+
+  @property
+  def generation(self):
+    """Returns an opaque value to pass to WaitForChange()."""
+    with self._lock:
+      return self._generation
+
+  def WaitForChange(self, generation, timeout, poll=0.1):
+    """Waits for a device to arrive or leave since generation was retrieved.
+
+    Without hotplug support, sleeps for poll seconds instead.
+
+    Returns:
+      True if the bus may have changed.
+    """
+    # Initializes the context, which determines the hotplug support.
+    _ = self.context
+    if not self._has_hotplug:
+      time.sleep(min(poll, timeout))
+      return True
+    deadline = time.time() + timeout
+    with self._cond:
+      while self._generation == generation:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+      return True
+
+  def WaitForArrival(self, generation, timeout, port_path=None, poll=0.1):
+    """Waits for a device to be attached since generation was retrieved.
+
+    Unlike WaitForChange(), departures don't wake the caller up, nor arrivals
+    at another port when port_path is set, as a tuple or in its '1/2/3' form.
+    Without hotplug support, sleeps for poll seconds instead.
+
+    Returns:
+      True if such a device may have arrived.
+    """
+    _ = self.context
+    if not self._has_hotplug:
+      time.sleep(min(poll, timeout))
+      return True
+    deadline = time.time() + timeout
+    with self._cond:
+      while True:
+        if port_path:
+          last = self._arrivals.get(UsbHandle._ParsePortPath(port_path), 0)
+        else:
+          last = self._last_arrival
+        if last > generation:
+          return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+
+  def GetDevices(self, interface=None, port_path=None):
+    """Returns the attached usb1.USBDevice.
+
+    With hotplug support they come from the index, else the bus is enumerated.
+
+    Arguments:
+      interface: if set, only the devices with a setting whose GetInterface()
+          is interface are returned. Only used to narrow the index, callers
+          still have to match the settings.
+      port_path: if set, only the device at this port path is returned, as a
+          tuple or in its '1/2/3' form.
+    """
+    ctx = self.context
+    if not self._has_hotplug:
+      devices = ctx.getDeviceList(skip_on_error=True)
+      self.Prune(devices)
+      entries = [(d, _PortPath(d), None) for d in devices]
+    else:
+      with self._lock:
+        entries = self._devices.values()
+    if port_path:
+      port_path = UsbHandle._ParsePortPath(port_path)
+    out = []
+    for device, device_port_path, interfaces in entries:
+      if port_path and device_port_path != port_path:
+        continue
+      if interface and interfaces is not None and interface not in interfaces:
+        continue
+      out.append(device)
+    return out
+
+  def GetSerial(self, device):
+    """Returns the serial number of an usb1.USBDevice, reading it only once
+    per attach.
+    """
+    key = _DeviceKey(device)
+    with self._lock:
+      serial = self._serials.get(key)
+    if serial is None:
+      serial = device.getSerialNumber()
+      with self._lock:
+        self._serials[key] = serial
+    return serial
+
+  def Prune(self, devices):
+    """Forgets the serial numbers of the devices not in the list."""
+    keys = set(_DeviceKey(d) for d in devices)
+    with self._lock:
+      for key in self._serials.keys():
+        if key not in keys:
+          del self._serials[key]
+
+  def _OnHotplug(self, _context, device, event):
+    # Called on the event thread. It must not do synchronous libusb calls;
+    # usb1 already loaded the descriptors of arriving devices.
+    key = _DeviceKey(device)
+    with self._cond:
+      self._generation += 1
+      if event == usb1.HOTPLUG_EVENT_DEVICE_LEFT:
+        self._serials.pop(key, None)
+        self._devices.pop(key, None)
+      else:
+        port_path = _PortPath(device)
+        try:
+          interfaces = frozenset(
+              GetInterface(s) for s in device.iterSettings())
+        except libusb1.USBError as e:
+          _LOG.info('UsbRegistry._OnHotplug(%s): %s', port_path, e)
+          interfaces = frozenset()
+        self._devices[key] = (device, port_path, interfaces)
+        self._arrivals[port_path] = self._generation
+        self._last_arrival = self._generation
+      self._cond.notify_all()
+    # Keep the callback registered.
+    return False
+
+  def _SetPoller(self, poller):
+    with self._lock:
+      assert not (poller and self._poller), 'Only one UsbPoller at a time'
+      self._poller = poller
+    if poller:
+      self._thread_events.clear()
+    else:
+      # The transfers started while polled have no thread of their own, so
+      # the events must be handled even without hotplug support.
+      with self._lock:
+        self._StartThread()
+      self._thread_events.set()
+
+  def _StartThread(self):
+    # self._lock must be held.
+    if not self._thread:
+      self._thread = threading.Thread(target=self._Run, name='usb-events')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _Run(self):
+    while True:
+      self._thread_events.wait()
+      try:
+        self._context.handleEventsTimeout(1.)
+      except libusb1.USBError as e:
+        _LOG.info('UsbRegistry._Run(): %s', e)
+
+
+def _DeviceKey(device):
+  """Returns the key identifying an attached usb1.USBDevice.
+
+  It is made of the bus and port chain, which is stable, and the address, which
+  changes each time the device is enumerated.
+  """
+  try:
+    ports = tuple(device.getPortNumberList())
+  except libusb1.USBError:
+    ports = ()
+  return (device.getBusNumber(), ports, device.getDeviceAddress())
+
+
+def _PortPath(device):
+  """Returns the port path of an usb1.USBDevice: its bus and hub port chain.
+
+  Unlike the device address, it stays the same when the device is reenumerated,
+  e.g. on reboot. Falls back to the address when the port chain is unknown.
+  """
+  bus, ports, address = _DeviceKey(device)
+  return (bus,) + ports if ports else (bus, address)
+
+
+# The process-wide USB context.
+USB_REGISTRY = UsbRegistry()
+
+
+class UsbPoller(object):
+  """Services the libusb events from a select.poll() or select.epoll() loop.
+
+  The libusb file descriptors are registered on the poll object next to the
+  caller's ones. poll() handles the USB events and only returns the events of
+  the other file descriptors, so a single thread can service the asynchronous
+  transfers of all the devices and sockets:
+
+    poller = common.UsbPoller(select.epoll())
+    poller.register(sock.fileno(), select.EPOLLIN)
+    while True:
+      for fd, events in poller.poll(timeout):
+        ...
+
+  While it exists, USB_REGISTRY and the handles whose asynchronous transfers
+  are started afterward do not use a background thread to handle the events.
+  BulkRead() and BulkWrite() then block until poll() is called, so they must
+  not be called from the polling thread. Once closed, a USB_REGISTRY thread
+  handles the events of these handles.
+  """
+
+  def __init__(self, poller, registry=None):
+    """Attaches to the registry context.
+
+    Arguments:
+      poller: select.poll() or select.epoll() instance.
+      registry: UsbRegistry to service, defaults to USB_REGISTRY.
+    """
+    self._registry = registry or USB_REGISTRY
+    self._context = self._registry.context
+    self._poller = poller
+    # select.poll() takes milliseconds, select.epoll() seconds.
+    self._timeout_in_ms = not (
+        hasattr(select, 'epoll') and isinstance(poller, select.epoll))
+    self._lock = threading.Lock()
+    self._usb_fds = set()
+    self._registry._SetPoller(self)
+    self._context.setPollFDNotifiers(self._OnAdded, self._OnRemoved)
+    for fd, events in self._context.getPollFDList():
+      self._OnAdded(fd, events)
+
+  def register(self, fd, events):
+    """Registers a file descriptor not related to USB."""
+    with self._lock:
+      if fd in self._usb_fds:
+        raise ValueError('%d is a libusb file descriptor' % fd)
+    self._poller.register(fd, events)
+
+  def modify(self, fd, events):
+    self._poller.modify(fd, events)
+
+  def unregister(self, fd):
+    with self._lock:
+      if fd in self._usb_fds:
+        raise ValueError('%d is a libusb file descriptor' % fd)
+    self._poller.unregister(fd)
+
+  def poll(self, timeout=None):
+    """Waits for events and handles the USB ones.
+
+    Arguments:
+      timeout: maximum wait in seconds, None to wait forever.
+
+    Returns:
+      list of (fd, events) for the file descriptors registered by the caller.
+    """
+    usb_timeout = self._context.getNextTimeout()
+    if usb_timeout is not None and (timeout is None or usb_timeout < timeout):
+      timeout = usb_timeout
+    if timeout is None:
+      timeout = -1
+    elif self._timeout_in_ms:
+      timeout = int(math.ceil(timeout * 1000))
+    events = self._poller.poll(timeout)
+    with self._lock:
+      usb_fds = frozenset(self._usb_fds)
+    out = [(fd, e) for fd, e in events if fd not in usb_fds]
+    if len(out) != len(events) or not events:
+      # A libusb file descriptor is ready or a libusb timeout expired.
+      try:
+        self._context.handleEventsTimeout(0)
+      except libusb1.USBError as e:
+        _LOG.info('UsbPoller.poll(): %s', e)
+    return out
+
+  def Close(self):
+    """Detaches from the context; a registry thread takes over."""
+    self._context.setPollFDNotifiers(None, None)
+    with self._lock:
+      usb_fds, self._usb_fds = self._usb_fds, set()
+    for fd in usb_fds:
+      self._poller.unregister(fd)
+    self._registry._SetPoller(None)
+
+  def _OnAdded(self, fd, events, _user_data=None):
+    with self._lock:
+      self._usb_fds.add(fd)
+    self._poller.register(fd, events)
+
+  def _OnRemoved(self, fd, _user_data=None):
+    with self._lock:
+      if fd not in self._usb_fds:
+        return
+      self._usb_fds.discard(fd)
+    self._poller.unregister(fd)
+
+
 class Handle(object):
   """Base class for a generic device communication handle."""
 
@@ -74,10 +598,37 @@ class Handle(object):
   def is_local(self):
     return True
 
+  @property
+  def supports_combined_writes(self):
+    """True if multiple ADB messages can be sent in a single BulkWrite()."""
+    return False
+
+  @property
+  def supports_sendfile(self):
+    """True if BulkWriteFile() is supported."""
+    return False
+
+  @property
+  def is_usb(self):
+    """True if the device is on the USB bus at port_path.
+
+    A reconnection then looks the device up on the bus again; other handles are
+    reopened as is.
+    """
+    return False
+
   @property
   def serial_number(self):
     return self._serial_number
 
+  def Wrap(self, handle):
+    """Returns handle, a new handle to the same device, the way self wraps
+    its own.
+
+    Handle wrappers override it so they still apply after a reconnection.
+    """
+    return handle
+
   def Open(self):
     raise NotImplementedError()
 
@@ -91,6 +642,210 @@ class Handle(object):
     raise NotImplementedError()
 
 
+class _AsyncTransfers(object):
+  """Keeps multiple libusb transfers in flight for a claimed interface.
+
+  A pool of IN transfers is always submitted; their data is appended to a
+  stream buffer that BulkRead() consumes. OUT transfers are queued so the bus
+  doesn't sit idle between two BulkWrite() calls. Completions are handled on a
+  background thread, or by the UsbPoller if one is attached.
+
+  The USB transfer boundaries are lost, so this is only usable for a protocol
+  where the reader knows the length of what it reads, like ADB. It is not
+  usable for fastboot.
+  """
+
+  def __init__(
+      self, context, handle, read_endpoint, write_endpoint, read_count,
+      read_size, write_count, events_thread=True):
+    self._context = context
+    self._handle = handle
+    self._read_endpoint = read_endpoint
+    self._write_endpoint = write_endpoint
+    self._cond = threading.Condition()
+    # Data received but not read yet, starting at self._offset.
+    self._stream = bytearray()
+    self._offset = 0
+    # USBError of the last failed IN or OUT transfer.
+    self._read_error = None
+    self._write_error = None
+    self._running = True
+    self._thread_stop = False
+    self._reads = []
+    self._idle_writes = []
+    self._writes = []
+    for _ in xrange(read_count):
+      transfer = handle.getTransfer()
+      transfer.setBulk(read_endpoint, read_size, self._OnRead)
+      self._reads.append(transfer)
+    for _ in xrange(write_count):
+      transfer = handle.getTransfer()
+      self._writes.append(transfer)
+      self._idle_writes.append(transfer)
+    self._thread = None
+    if events_thread:
+      self._thread = threading.Thread(
+          target=self._Run, name='usb-events')
+      self._thread.daemon = True
+      self._thread.start()
+    for transfer in self._reads:
+      transfer.submit()
+
+  def BulkRead(self, length, timeout_ms):
+    """Returns exactly length bytes."""
+    deadline = time.time() + timeout_ms / 1000. if timeout_ms else None
+    with self._cond:
+      while len(self._stream) - self._offset < length:
+        if self._read_error:
+          raise self._read_error
+        if deadline and deadline <= time.time():
+          raise usb1.USBErrorTimeout()
+        self._Wait(deadline)
+      data = str(self._stream[self._offset:self._offset+length])
+      self._offset += length
+      if self._offset > len(self._stream) / 2:
+        del self._stream[:self._offset]
+        self._offset = 0
+      return data
+
+  def BulkWrite(self, data, timeout_ms):
+    """Queues data to be sent.
+
+    str are copied so the call returns as soon as the transfer is submitted.
+    Other buffers are used in place, so the call waits for the transfer to
+    complete.
+    """
+    deadline = time.time() + timeout_ms / 1000. if timeout_ms else None
+    with self._cond:
+      while not self._idle_writes:
+        if self._write_error:
+          break
+        if deadline and deadline <= time.time():
+          raise usb1.USBErrorTimeout()
+        self._Wait(deadline)
+      if self._write_error:
+        error, self._write_error = self._write_error, None
+        raise error
+      transfer = self._idle_writes.pop()
+    transfer.setBulk(
+        self._write_endpoint, data, self._OnWrite, timeout=timeout_ms or 0)
+    transfer.submit()
+    if not isinstance(data, str):
+      with self._cond:
+        while transfer not in self._idle_writes:
+          self._cond.wait()
+        if self._write_error:
+          error, self._write_error = self._write_error, None
+          raise error
+    return len(data)
+
+  def Flush(self):
+    """Discards the data received but not read yet."""
+    with self._cond:
+      del self._stream[:]
+      self._offset = 0
+
+  def Stop(self):
+    """Cancels all the transfers and stops the event thread.
+
+    Returns once every transfer completed, so no callback can run after the
+    device handle is closed. Without an event thread, the events are handled
+    here.
+    """
+    transfers = self._reads + self._writes
+    with self._cond:
+      self._running = False
+    for transfer in transfers:
+      try:
+        if transfer.isSubmitted():
+          transfer.cancel()
+      except usb1.USBErrorNotFound:
+        pass
+    while True:
+      with self._cond:
+        if not any(t.isSubmitted() for t in transfers):
+          break
+        if self._thread:
+          # The callbacks notify once each cancellation is done.
+          self._cond.wait()
+          continue
+      try:
+        self._context.handleEventsTimeout(0.1)
+      except libusb1.USBError as e:
+        _LOG.info('_AsyncTransfers.Stop(): %s', e)
+    with self._cond:
+      self._thread_stop = True
+    if self._thread:
+      self._thread.join()
+    for transfer in transfers:
+      transfer.close()
+
+  def _Wait(self, deadline):
+    """Waits for a notification on self._cond, which must be held.
+
+    Condition.wait() with a timeout polls with sleeps of up to 50ms on python
+    2, so the deadline is enforced by a timer notifying the condition instead.
+    """
+    if not deadline:
+      self._cond.wait()
+      return
+    timer = threading.Timer(max(0., deadline - time.time()), self._Notify)
+    timer.daemon = True
+    timer.start()
+    try:
+      self._cond.wait()
+    finally:
+      timer.cancel()
+
+  def _Notify(self):
+    with self._cond:
+      self._cond.notify_all()
+
+  def _Run(self):
+    while not self._thread_stop:
+      try:
+        self._context.handleEventsTimeout(0.1)
+      except libusb1.USBError as e:
+        _LOG.info('_AsyncTransfers._Run(): %s', e)
+
+  def _OnRead(self, transfer):
+    status = transfer.getStatus()
+    with self._cond:
+      if status == libusb1.LIBUSB_TRANSFER_COMPLETED:
+        self._stream += transfer.getBuffer()[:transfer.getActualLength()]
+      elif self._running:
+        self._read_error = _TransferError(status)
+      self._cond.notify_all()
+      if not self._running or self._read_error:
+        return
+      # Resubmitted with the lock held so Stop() can't miss it.
+      try:
+        transfer.submit()
+      except usb1.USBError as e:
+        self._read_error = e
+
+  def _OnWrite(self, transfer):
+    status = transfer.getStatus()
+    with self._cond:
+      if status != libusb1.LIBUSB_TRANSFER_COMPLETED and self._running:
+        self._write_error = _TransferError(status)
+      self._idle_writes.append(transfer)
+      self._cond.notify_all()
+
+
+def _TransferError(status):
+  """Converts a libusb transfer status into an USBError."""
+  if status == libusb1.LIBUSB_TRANSFER_TIMED_OUT:
+    return usb1.USBErrorTimeout()
+  if status == libusb1.LIBUSB_TRANSFER_NO_DEVICE:
+    return usb1.USBErrorNoDevice()
+  if status == libusb1.LIBUSB_TRANSFER_STALL:
+    return usb1.USBErrorPipe()
+  if status == libusb1.LIBUSB_TRANSFER_OVERFLOW:
+    return usb1.USBErrorOverflow()
+  return usb1.USBErrorIO()
+
+
 class UsbHandle(Handle):
   """USB communication object. Not thread-safe.
 
@@ -106,7 +861,8 @@ class UsbHandle(Handle):
   _HANDLE_CACHE = {}
   _HANDLE_CACHE_LOCK = threading.Lock()
 
-  def __init__(self, device, setting, usb_info=None, timeout_ms=None):
+  def __init__(
+      self, device, setting, usb_info=None, timeout_ms=None, context=None):
     """Initialize USB Handle.
 
     Arguments:
@@ -114,12 +870,17 @@ class UsbHandle(Handle):
       setting: libusb setting with the correct endpoints to communicate with.
       usb_info: String describing the usb path/serial/device, for debugging.
       timeout_ms: Timeout in milliseconds for all I/O.
+      context: usb1.USBContext the device was found with. Needed for
+          EnableAsyncTransfers().
     """
     super(UsbHandle, self).__init__(serial=None, timeout_ms=timeout_ms)
     # Immutable.
     self._setting = setting
     self._device = device
     self._usb_info = usb_info or ''
+    self._context = context
+    # Arguments to _AsyncTransfers when enabled.
+    self._async_config = None
 
     # State.
     self._handle = None
@@ -127,6 +888,7 @@ class UsbHandle(Handle):
     self._write_endpoint = None
     self._interface_number = None
     self._max_read_packet_len = None
+    self._async = None
 
   @property
   def usb_info(self):
@@ -184,25 +946,56 @@ class UsbHandle(Handle):
       stack = ''.join(traceback.format_stack()[:-2])
       with self._HANDLE_CACHE_LOCK:
         self._HANDLE_CACHE[port_path] = (self, stack)
+      if self._async_config:
+        self._StartAsyncTransfers()
     except Exception as e:
       self.Close()
       raise
 
+  def EnableAsyncTransfers(
+      self, read_count=4, read_size=64*1024, write_count=4):
+    """Keeps multiple transfers in flight instead of one synchronous transfer
+    at a time.
+
+    Only usable for ADB, see _AsyncTransfers. It stays enabled when the handle
+    is reopened.
+
+    Arguments:
+      read_count: number of IN transfers kept submitted.
+      read_size: size of each IN transfer.
+      write_count: maximum number of OUT transfers in flight.
+    """
+    assert self._context, 'The handle must be created with a context'
+    self._async_config = (read_count, read_size, write_count)
+    if self._handle and not self._async:
+      self._StartAsyncTransfers()
+
+  def _StartAsyncTransfers(self):
+    read_count, read_size, write_count = self._async_config
+    # The UsbPoller thread handles the events of the shared context.
+    polled = USB_REGISTRY.polled and self._context is USB_REGISTRY.context
+    self._async = _AsyncTransfers(
+        self._context, self._handle, self._read_endpoint, self._write_endpoint,
+        read_count, read_size, write_count, events_thread=not polled)
+
   @property
   def is_open(self):
     return bool(self._handle)
 
+  @property
+  def is_usb(self):
+    return True
+
   @property
   def serial_number(self):
     if not self._serial_number:
-      self._serial_number = self._device.getSerialNumber()
+      self._serial_number = USB_REGISTRY.GetSerial(self._device)
     return self._serial_number
 
   @property
   def port_path(self):
     if not self._port_path:
-      self._port_path = (
-          self._device.getBusNumber(), self._device.getDeviceAddress())
+      self._port_path = _PortPath(self._device)
     return self._port_path
 
   @property
@@ -217,12 +1010,15 @@ class UsbHandle(Handle):
     if self._handle is None:
       return
     try:
+      if self._async:
+        self._async.Stop()
       if self._interface_number:
         self._handle.releaseInterface(self._interface_number)
       self._handle.close()
     except libusb1.USBError as e:
       _LOG.info('%s.Close(): USBError: %s', self.port_path_str, e)
     finally:
+      self._async = None
       self._handle = None
       self._read_endpoint = None
       self._write_endpoint = None
@@ -230,11 +1026,16 @@ class UsbHandle(Handle):
       self._max_read_packet_len = None
 
   def FlushBuffers(self):
+    if self._async:
+      time.sleep(0.01)
+      self._async.Flush()
+      return
     while True:
       try:
         self.BulkRead(self._max_read_packet_len, timeout_ms=10)
       except usb_exceptions.ReadFailedError as e:
-        if e.usb_error.value == libusb1.LIBUSB_ERROR_TIMEOUT:
+        if (getattr(e.usb_error, 'value', None) ==
+            libusb1.LIBUSB_ERROR_TIMEOUT):
           break
         raise
 
@@ -244,6 +1045,8 @@ class UsbHandle(Handle):
           'This handle has been closed, probably due to another being opened.',
           None)
     try:
+      if self._async:
+        return self._async.BulkWrite(data, self.Timeout(timeout_ms))
       return self._handle.bulkWrite(
           self._write_endpoint, data, timeout=self.Timeout(timeout_ms))
     except libusb1.USBError as e:
@@ -257,6 +1060,8 @@ class UsbHandle(Handle):
           'This handle has been closed, probably due to another being opened.',
           None)
     try:
+      if self._async:
+        return self._async.BulkRead(length, self.Timeout(timeout_ms))
       return self._handle.bulkRead(
           self._read_endpoint, length, timeout=self.Timeout(timeout_ms))
     except libusb1.USBError as e:
@@ -264,13 +1069,17 @@ class UsbHandle(Handle):
           'Could not receive data from %s (timeout %sms)' % (
               self.usb_info, self.Timeout(timeout_ms)), e)
 
+  @staticmethod
+  def _ParsePortPath(port_path):
+    """Converts a port path from its '1/2/3' form to a tuple."""
+    if isinstance(port_path, basestring):
+      port_path = [int(i) for i in port_path.split('/')]
+    return tuple(port_path)
+
   @classmethod
   def PortPathMatcher(cls, port_path):
     """Returns a device matcher for the given port path."""
-    if isinstance(port_path, basestring):
-      # Convert from sysfs path to port_path.
-      port_path = [int(i) for i in port_path.split('/')]
-    port_path = tuple(port_path)
+    port_path = cls._ParsePortPath(port_path)
     return lambda device: device.port_path == port_path
 
   @classmethod
@@ -290,18 +1099,21 @@ class UsbHandle(Handle):
 
   @classmethod
   def Find(cls, setting_matcher, port_path=None, serial=None, timeout_ms=None):
-    """Gets the first device that matches according to the keyword args."""
+    """Gets the first device that matches according to the keyword args.
+
+    When both port_path and serial are specified, the device must match both.
+    """
+    device_matcher = None
+    if serial:
+      device_matcher = cls.SerialMatcher(serial)
     if port_path:
-      device_matcher = cls.PortPathMatcher(port_path)
+      # Only the device at this port is considered.
       usb_info = port_path
-    elif serial:
-      device_matcher = cls.SerialMatcher(serial)
-      usb_info = serial
     else:
-      device_matcher = None
-      usb_info = 'first'
+      usb_info = serial or 'first'
     return cls.FindFirst(setting_matcher, device_matcher,
-                         usb_info=usb_info, timeout_ms=timeout_ms)
+                         usb_info=usb_info, timeout_ms=timeout_ms,
+                         port_path=port_path)
 
   @classmethod
   def FindFirst(cls, setting_matcher, device_matcher=None, **kwargs):
@@ -327,7 +1139,7 @@ class UsbHandle(Handle):
 
   @classmethod
   def FindDevices(cls, setting_matcher, device_matcher=None,
-                  usb_info='', timeout_ms=None):
+                  usb_info='', timeout_ms=None, port_path=None):
     """Find and yield the devices that match.
 
     Args:
@@ -337,17 +1149,25 @@ class UsbHandle(Handle):
         valid. None to match any device.
       usb_info: Info string describing device(s).
       timeout_ms: Default timeout of commands in milliseconds.
+      port_path: If set, only the device at this port path is considered.
 
     Yields:
       Unopened UsbHandle instances
     """
-    ctx = usb1.USBContext()
-    for device in ctx.getDeviceList(skip_on_error=True):
+    ctx = USB_REGISTRY.context
+    # Port paths are stable, look the device up directly instead of matching
+    # the settings of every device.
+    devices = USB_REGISTRY.GetDevices(
+        interface=getattr(setting_matcher, 'interface', None),
+        port_path=port_path)
+    for device in devices:
       setting = setting_matcher(device)
       if setting is None:
         continue
 
-      handle = cls(device, setting, usb_info=usb_info, timeout_ms=timeout_ms)
+      handle = cls(
+          device, setting, usb_info=usb_info, timeout_ms=timeout_ms,
+          context=ctx)
       if device_matcher is None or device_matcher(handle):
         yield handle
 
@@ -374,11 +1194,16 @@ class TcpHandle(Handle):
 
      Provides same interface as UsbHandle."""
 
-  def __init__(self, serial, timeout_ms=None):
+  # Size of the preallocated buffer reads are done into.
+  READ_BUFFER_SIZE = 256*1024
+
+  def __init__(self, serial, timeout_ms=None, rcvbuf=None, sndbuf=None):
     """Initialize the TCP Handle.
     Arguments:
       serial: Android device serial of the form host or host:port.
       timeout_ms: Timeout in milliseconds for all I/O.
+      rcvbuf: If set, the socket SO_RCVBUF size in bytes.
+      sndbuf: If set, the socket SO_SNDBUF size in bytes.
 
     Host may be an IP address or a host name.
     """
@@ -391,8 +1216,17 @@ class TcpHandle(Handle):
                                     timeout_ms=timeout_ms)
     self._host = host
     self._port = port
+    self._rcvbuf = rcvbuf
+    self._sndbuf = sndbuf
 
     self._connection = None
+    # Timeout currently set on the socket, in seconds.
+    self._socket_timeout = None
+    # Data received but not read yet is self._buffer[self._start:self._end].
+    self._buffer = bytearray(self.READ_BUFFER_SIZE)
+    self._view = memoryview(self._buffer)
+    self._start = 0
+    self._end = 0
 
   @property
   def is_open(self):
@@ -402,38 +1236,132 @@ class TcpHandle(Handle):
   def is_local(self):
     return False
 
+  @property
+  def supports_combined_writes(self):
+    # TCP is a stream so message boundaries do not matter.
+    return True
+
+  @property
+  def supports_sendfile(self):
+    return True
+
   def Open(self):
     serial = self.serial_number
     _LOG.info('Open() on connection to %s', serial)
     try:
-      self._connection = socket.create_connection((self._host, self._port))
-      self._connection.settimeout(self._timeout_ms / 1000.0)
+      self._connection = self._CreateConnection()
     except Exception as e:
       _LOG.exception('Open() on %s: Exception: %s', serial, e)
       self.Close()
       raise
 
   def Close(self):
+    self._start = self._end = 0
     if self._connection is None:
       return
     try:
       self._connection.close()
     finally:
       self._connection = None
+      self._socket_timeout = None
 
   def BulkWrite(self, data, timeout_ms=None):
     try:
-      self._connection.settimeout(self.Timeout(timeout_ms) / 1000.0)
+      self._SetTimeout(timeout_ms)
       return self._connection.sendall(data)
     except socket.timeout as e:
-      raise usb_exceptions.ReadFailedError(
+      raise usb_exceptions.WriteFailedError(
+          'Could not send data (timeout %sms)' % (self.Timeout(timeout_ms)), e)
+    except socket.error as e:
+      raise usb_exceptions.WriteFailedError(
+          'Could not send data to %s' % self.serial_number, e)
+
+  def BulkWriteFile(self, data, fd, offset, length, timeout_ms=None):
+    """Writes data, then length bytes of the file descriptor fd starting at
+    offset.
+
+    The file content is sent by the kernel with sendfile() when available.
+    """
+    try:
+      self._SetTimeout(timeout_ms)
+      self._connection.sendall(data)
+      _SendFile(self._connection, fd, offset, length)
+    except socket.timeout as e:
+      raise usb_exceptions.WriteFailedError(
           'Could not send data (timeout %sms)' % (self.Timeout(timeout_ms)), e)
+    except (socket.error, OSError) as e:
+      # sendfile() raises OSError, e.g. EPIPE when the peer went away.
+      raise usb_exceptions.WriteFailedError(
+          'Could not send data to %s' % self.serial_number, e)
 
   def BulkRead(self, length, timeout_ms=None):
+    """Returns exactly length bytes.
+
+    On timeout, the bytes received so far are kept for the next call.
+    """
+    available = self._end - self._start
+    if available >= length:
+      data = str(self._buffer[self._start:self._start+length])
+      self._start += length
+      return data
     try:
-      self._connection.settimeout(self.Timeout(timeout_ms) / 1000.0)
-      return self._connection.recv(length)
+      self._SetTimeout(timeout_ms)
+      if length > len(self._buffer):
+        # Grow the buffer so it holds the whole payload.
+        buf = bytearray(length)
+        buf[:available] = self._view[self._start:self._end]
+        self._buffer = buf
+        self._view = memoryview(buf)
+      else:
+        # Make room at the end of the buffer and read as much as possible.
+        self._buffer[:available] = self._buffer[self._start:self._end]
+      self._start = 0
+      self._end = available
+      while self._end < length:
+        self._end += self._Recv(self._view[self._end:])
+      self._start = length
+      return str(self._buffer[:length])
     except socket.timeout as e:
       raise usb_exceptions.ReadFailedError(
           'Could not receive data (timeout %sms)' % (
               self.Timeout(timeout_ms)), e)
+
+  def _Recv(self, view):
+    """Reads into view, returns the number of bytes read."""
+    size = self._connection.recv_into(view)
+    if not size:
+      raise usb_exceptions.ReadFailedError(
+          'Connection to %s closed' % self.serial_number, None)
+    return size
+
+  def _SetTimeout(self, timeout_ms):
+    """Sets the socket timeout, skipping the syscall when unchanged."""
+    timeout = self.Timeout(timeout_ms) / 1000.0
+    if timeout != self._socket_timeout:
+      self._connection.settimeout(timeout)
+      self._socket_timeout = timeout
+
+  def _CreateConnection(self):
+    """Connects to the device, setting the socket options before connecting
+    so the buffer sizes are taken into account for the TCP window.
+    """
+    error = None
+    for af, socktype, proto, _, address in socket.getaddrinfo(
+        self._host, self._port, 0, socket.SOCK_STREAM):
+      sock = socket.socket(af, socktype, proto)
+      try:
+        # The ADB header and payload are sent separately, do not wait for an
+        # ACK in between.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._rcvbuf:
+          sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        if self._sndbuf:
+          sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+        self._socket_timeout = self._timeout_ms / 1000.0
+        sock.settimeout(self._socket_timeout)
+        sock.connect(address)
+        return sock
+      except socket.error as e:
+        error = e
+        sock.close()
+    raise error or socket.error('getaddrinfo returned nothing')
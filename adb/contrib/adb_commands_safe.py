@@ -14,11 +14,17 @@
 
 """Defines AdbCommandsSafe, an exception safe version of AdbCommands."""
 
+import binascii
 import cStringIO
+import hashlib
 import inspect
 import logging
+import os
+import pipes
+import posixpath
 import socket
 import subprocess
+import threading
 import time
 
 
@@ -32,13 +38,77 @@ _LOG = logging.getLogger('adb.cmd')
 _LOG.setLevel(logging.ERROR)
 
 
-### Public API.
+class _FileSegment(object):
+  """File-like object that reads at most length bytes from a file object."""
+
+  def __init__(self, fileobj, length):
+    self._fileobj = fileobj
+    self._left = length
+
+  def read(self, size):
+    data = self._fileobj.read(min(size, self._left))
+    self._left -= len(data)
+    return data
+
+
+class _ShellOutput(object):
+  """Receives the output of a shell command as it comes.
+
+  The output is forwarded to sink, or accumulated if there is none, up to
+  max_size bytes; the rest is discarded.
+
+  With legacy set, the last bytes are held back since they hold the exit code
+  printed by AdbCommandsSafe._SHELL_SUFFIX, and CRLF are converted to LF.
+  """
+  # Longer than the exit code line, '\r\n255\r\n'.
+  _HOLDBACK = 32
+
+  def __init__(self, sink, max_size, legacy=False):
+    self._out = []
+    if sink is None:
+      self._write = self._out.append
+    else:
+      self._write = getattr(sink, 'write', sink)
+    self._left = max_size
+    self._legacy = legacy
+    self._tail = ''
+
+  def write(self, data):
+    if self._legacy:
+      data = self._tail + data
+      end = max(0, len(data) - self._HOLDBACK)
+      if end and data[end-1] == '\r':
+        # Keep CRLF together.
+        end -= 1
+      data, self._tail = data[:end].replace('\r\n', '\n'), data[end:]
+    self.Forward(data)
+
+  def Forward(self, data):
+    if self._left is not None:
+      data = data[:self._left]
+      self._left -= len(data)
+    if data:
+      self._write(data)
+
+  def PopTail(self):
+    """Returns the bytes held back, with LF line endings."""
+    tail, self._tail = self._tail, ''
+    return tail.replace('\r\n', '\n')
+
+  def Result(self):
+    """Returns the accumulated output as unicode, u'' if there is a sink."""
+    return ''.join(self._out).decode('utf-8', 'replace')
 
 
 # Make adb_commands_safe a drop-in replacement for adb_commands.
 from adb.adb_commands import DeviceIsAvailable
 
 
+# Size of the segments of PushResumable() and PullResumable(). The progress is
+# checkpointed after each segment. It must be a multiple of 1MiB.
+RESUMABLE_CHUNK_SIZE = 64*1024*1024
+
+
 def KillADB():
   """Stops the adb daemon.
 
@@ -129,9 +199,19 @@ class AdbCommandsSafe(object):
 
     # State.
     self._adb_cmd = None
+    self._session = None
+    # Serializes the commands sent to _session.
+    self._session_lock = threading.RLock()
+    # Whether the device supports exec:, None until a session was opened.
+    self._has_exec = None
     self._serial = None
     self._handle = handle
     self._port_path = '/'.join(str(p) for p in port_path) if port_path else None
+    # Handle passed by the caller. A USB device is looked up on the bus again
+    # on reconnection and the new handle is wrapped by this one, e.g. to keep
+    # injecting faults; other handles are reopened.
+    self._initial_handle = handle
+    self._is_usb = handle.is_usb if handle else True
 
   @classmethod
   def ConnectDevice(cls, port_path, **kwargs):
@@ -193,6 +273,8 @@ class AdbCommandsSafe(object):
     return self._serial or self._port_path
 
   def Close(self):
+    self._session = None
+    self._has_exec = None
     if self._adb_cmd:
       self._adb_cmd.Close()
       self._adb_cmd = None
@@ -284,12 +366,27 @@ class AdbCommandsSafe(object):
   def Push(self, localfile, dest, mtime='0'):
     """Pushes a local file to dest on the device.
 
+    localfile is a path or a file object. A file object is rewound before each
+    attempt, so it must be seekable to be retried.
+
     Returns True on success.
     """
     assert dest.startswith('/'), dest
+    offset = None
+    if not isinstance(localfile, basestring):
+      try:
+        offset = localfile.tell()
+      except (AttributeError, IOError):
+        pass
     if self._adb_cmd:
-      for _ in self._Loop():
+      for i in self._Loop():
+        if i and offset is None and not isinstance(localfile, basestring):
+          _LOG.warning(
+              '%s.Push(%s): can\'t rewind to retry', self.port_path, dest)
+          break
         try:
+          if offset is not None:
+            localfile.seek(offset)
           self._adb_cmd.Push(localfile, dest, mtime)
           return True
         except usb_exceptions.AdbCommandFailureException:
@@ -317,11 +414,175 @@ class AdbCommandsSafe(object):
             break
     return False
 
+  def PushResumable(self, localfile, dest, chunk_size=RESUMABLE_CHUNK_SIZE):
+    """Pushes a large local file to dest on the device, resuming after
+    connection resets.
+
+    Push() restarts from the beginning of the file on every retry. Instead, the
+    file is sent in segments of chunk_size; the first one is pushed as dest,
+    replacing any previous file, and the next ones are pushed to a temporary
+    file then written in place with dd. After a reset, only the segment that was
+    in flight is sent again, once the part already on the device is verified to
+    match; otherwise the push starts over.
+
+    The temporary file name is derived from the local file's path, size and
+    modification time so concurrent pushes of different files to dest don't
+    mix their segments.
+
+    Returns True on success, once the size on the device matches.
+    """
+    assert dest.startswith('/'), dest
+    assert chunk_size and not chunk_size % (1024*1024), chunk_size
+    if not self._adb_cmd:
+      return False
+    if not common.MappedFile.CanMap(localfile):
+      # Not a regular file, it can only be read once.
+      return self.Push(localfile, dest)
+    stat = os.stat(localfile)
+    size = stat.st_size
+    key = hashlib.sha1('%s\0%d\0%r' % (
+        os.path.realpath(localfile), size, stat.st_mtime)).hexdigest()
+    part = '%s.%s.part' % (dest, key[:16])
+    offset = 0
+    with common.MappedFile(localfile) as mapped:
+      while True:
+        for i in self._Loop():
+          try:
+            if i and offset and not self._IsPrefixOf(mapped, dest, offset):
+              _LOG.warning(
+                  '%s.PushResumable(%s, %s): can\'t verify the first %d bytes, '
+                  'starting over', self.port_path, localfile, dest, offset)
+              offset = 0
+            mapped.seek(offset)
+            segment = _FileSegment(mapped, chunk_size)
+            if not offset:
+              self._adb_cmd.Push(segment, dest)
+            else:
+              self._adb_cmd.Push(segment, part)
+              _, exit_code = self.ShellRaw(
+                  'dd if=%s of=%s bs=1048576 seek=%d conv=notrunc 2>/dev/null '
+                  '&& rm %s' % (
+                      pipes.quote(part), pipes.quote(dest),
+                      offset / (1024*1024), pipes.quote(part)))
+              if exit_code != 0:
+                _LOG.error(
+                    '%s.PushResumable(%s, %s): dd failed at %d',
+                    self.port_path, localfile, dest, offset)
+                return False
+            break
+          except usb_exceptions.AdbCommandFailureException:
+            return False
+          except self._ERRORS as e:
+            # offset is only advanced once its segment is confirmed on the
+            # device, so the interrupted segment is sent again in full.
+            if not self._Reset('(%s, %s): %s', localfile, dest, e):
+              return False
+        else:
+          return False
+        offset += chunk_size
+        if offset >= size:
+          break
+    remote_size = self.Stat(dest)[1]
+    if remote_size != size:
+      _LOG.error(
+          '%s.PushResumable(%s, %s): size mismatch %s != %d',
+          self.port_path, localfile, dest, remote_size, size)
+      return False
+    return True
+
+  def _IsPrefixOf(self, mapped, path, length):
+    """Returns True if the first length bytes of the file path on the device
+    match the ones of mapped.
+
+    length must be a multiple of 1MiB. Returns False if sha1sum is not
+    available on the device.
+    """
+    digest = hashlib.sha1()
+    mapped.seek(0)
+    segment = _FileSegment(mapped, length)
+    while True:
+      chunk = segment.read(1024*1024)
+      if not len(chunk):
+        break
+      digest.update(chunk)
+    out, exit_code = self.ShellRaw(
+        'dd if=%s bs=1048576 count=%d 2>/dev/null | sha1sum' % (
+            pipes.quote(path), length / (1024*1024)))
+    return bool(
+        exit_code == 0 and out and
+        out.split(None, 1)[0] == digest.hexdigest())
+
+  def PullResumable(self, remotefile, dest, chunk_size=RESUMABLE_CHUNK_SIZE):
+    """Retrieves a large file from the device to dest on the host, resuming
+    after connection resets.
+
+    The file is copied in segments of chunk_size; each one is extracted with dd
+    into a temporary file on the device then pulled and appended to dest. After
+    a reset, the transfer continues from the last segment written to dest.
+
+    Returns True on success, once the size on the host matches.
+    """
+    assert remotefile.startswith('/'), remotefile
+    assert chunk_size and not chunk_size % (1024*1024), chunk_size
+    mode, size, _ = self.Stat(remotefile)
+    if not mode:
+      return False
+    # Unique so concurrent pulls of files with the same name do not collide.
+    part = '/data/local/tmp/%s.%s.part' % (
+        posixpath.basename(remotefile), binascii.hexlify(os.urandom(8)))
+    try:
+      local_size = self._PullSegments(remotefile, dest, part, size, chunk_size)
+    finally:
+      self.Shell('rm -f %s' % pipes.quote(part))
+    if local_size is None:
+      return False
+    if local_size != size:
+      _LOG.error(
+          '%s.PullResumable(%s, %s): size mismatch %d != %d',
+          self.port_path, remotefile, dest, local_size, size)
+      return False
+    return True
+
+  def _PullSegments(self, remotefile, dest, part, size, chunk_size):
+    """Pulls remotefile to dest segment by segment through part.
+
+    Returns the size of dest, None on failure.
+    """
+    offset = 0
+    with open(dest, 'wb') as f:
+      while offset < size:
+        for _ in self._Loop():
+          try:
+            f.seek(offset)
+            f.truncate()
+            _, exit_code = self.ShellRaw(
+                'dd if=%s of=%s bs=1048576 skip=%d count=%d 2>/dev/null' % (
+                    pipes.quote(remotefile), pipes.quote(part),
+                    offset / (1024*1024), chunk_size / (1024*1024)))
+            if exit_code != 0:
+              _LOG.error(
+                  '%s.PullResumable(%s, %s): dd failed at %d',
+                  self.port_path, remotefile, dest, offset)
+              return None
+            self._adb_cmd.Pull(part, f)
+            break
+          except usb_exceptions.AdbCommandFailureException:
+            return None
+          except self._ERRORS as e:
+            if not self._Reset('(%s, %s): %s', remotefile, dest, e):
+              return None
+        else:
+          return None
+        offset += chunk_size
+      f.seek(0, os.SEEK_END)
+      return f.tell()
+
   def Reboot(self):
     """Reboots the device. Waits for it to be rebooted but not fully
     operational.
 
-    This causes the USB device to disapear momentarily and get a new port_path.
+    This causes the USB device to disapear momentarily. It keeps its port_path
+    as long as it is not plugged elsewhere.
     If the phone just booted up, this function will cause the caller to sleep.
 
     The caller will likely want to call self.Root() to switch adbd to root
@@ -377,25 +638,172 @@ class AdbCommandsSafe(object):
             break
     return False
 
-  def Shell(self, cmd):
+  def Shell(self, cmd, sink=None, max_size=None):
     """Runs a command on an Android device while swallowing exceptions.
 
     Traps all kinds of USB errors so callers do not have to handle this.
 
+    Arguments:
+      sink, max_size: see ShellRaw(). The command is not retried once output
+          was sent to sink.
+
     Returns:
       tuple(stdout, exit_code)
       - stdout is as unicode if it ran, None if an USB error occurred.
       - exit_code is set if ran.
     """
     if self._adb_cmd:
+      sent = []
+      if sink is not None:
+        write = getattr(sink, 'write', sink)
+        def forward(data):
+          sent.append(len(data))
+          write(data)
+        sink = forward
       for _ in self._Loop():
         try:
-          return self.ShellRaw(cmd)
+          return self.ShellRaw(cmd, sink, max_size)
         except self._ERRORS as e:
-          if not self._Reset('(%s): %s', cmd, e):
+          if not self._Reset('(%s): %s', cmd, e) or sent:
             break
     return None, None
 
+  def SessionShell(self, cmd):
+    """Runs a command in a long lived shell on the device.
+
+    It is much faster than Shell() for small commands since it doesn't fork a
+    new shell on each call. The session is reopened as needed, e.g. after a
+    reset. Concurrent calls are serialized. The command is not retried once
+    it was sent, since it may have run. Falls back to Shell() on devices
+    without exec:, which is remembered until the next connection.
+
+    Returns:
+      tuple(stdout, exit_code)
+      - stdout is as unicode if it ran, None if an USB error occurred.
+      - exit_code is set if ran.
+    """
+    if isinstance(cmd, unicode):
+      cmd = cmd.encode('utf-8')
+    assert isinstance(cmd, str), cmd
+    if self._adb_cmd:
+      with self._session_lock:
+        for _ in self._Loop():
+          session = None
+          try:
+            fresh = not self._session
+            if fresh:
+              if self._has_exec is False:
+                break
+              try:
+                self._session = self._adb_cmd.OpenShellSession()
+              except usb_exceptions.AdbCommandFailureException as e:
+                _LOG.info('%s.SessionShell(): %s', self.port_path, e)
+                self._has_exec = False
+                break
+              self._has_exec = True
+            session = self._session
+            out, exit_code = session.Run(cmd)
+            return out.decode('utf-8', 'replace'), exit_code
+          except usb_exceptions.AdbCommandFailureException as e:
+            # The session was closed by the device. Unless it was fresh or the
+            # command was sent, it was dead beforehand, so retry.
+            _LOG.info('%s.SessionShell(): %s', self.port_path, e)
+            self._CloseSession()
+            if fresh or session.sent:
+              return None, None
+          except self._ERRORS as e:
+            if not self._Reset('(%s): %s', cmd, e) or (
+                session and session.sent):
+              return None, None
+      if self._has_exec is False and self.IsShellOk(cmd):
+        return self.Shell(cmd)
+    return None, None
+
+  def ShellScript(self, script):
+    """Runs a shell script of any length by sending it over stdin.
+
+    Uses the shell v2 protocol when available, a shell session otherwise. The
+    script runs in a subshell, so it can't alter the session's state. Devices
+    without exec: get it as a plain Shell() command line if it fits.
+
+    Returns:
+      tuple(stdout and stderr merged as unicode, exit_code)
+      - stdout is None if an USB error occurred or the script can't be sent.
+    """
+    if isinstance(script, unicode):
+      script = script.encode('utf-8')
+    assert isinstance(script, str), script
+    if not self._adb_cmd:
+      return None, None
+    if not self._HasShellV2():
+      return self.SessionShell('(\n%s\n)' % script)
+    for _ in self._Loop():
+      try:
+        return self._ShellV2Merged('sh', script)
+      except self._ERRORS as e:
+        if not self._Reset('(): %s', e):
+          break
+    return None, None
+
+  def PackageManager(self, args):
+    """Runs a package manager command, e.g. ['list', 'packages'].
+
+    Talks directly to the package service through abb_exec when supported,
+    else 'cmd package' on devices with the cmd feature, else 'pm'. The fast
+    paths skip the JVM startup that 'pm' incurs but don't return the exit
+    code.
+
+    Returns:
+      tuple(stdout, exit_code)
+      - stdout is as unicode if it ran, None if an USB error occurred.
+      - exit_code is None if not available.
+    """
+    args = [a.encode('utf-8') if isinstance(a, unicode) else a for a in args]
+    if not self._adb_cmd:
+      return None, None
+    if 'abb_exec' in self._adb_cmd.features:
+      for _ in self._Loop():
+        try:
+          out = self._adb_cmd.AbbExec(['package'] + args)
+          return out.decode('utf-8', 'replace'), None
+        except self._ERRORS as e:
+          if not self._Reset('(%s): %s', args, e):
+            break
+      return None, None
+    quoted = ' '.join(pipes.quote(a) for a in args)
+    if 'cmd' in self._adb_cmd.features:
+      out = self.ExecOut('cmd package ' + quoted)
+      if out is None:
+        return None, None
+      return out.decode('utf-8', 'replace'), None
+    return self.Shell('pm ' + quoted)
+
+  def ExecOut(self, cmd, dest=None):
+    """Runs a command without a PTY and returns its raw output.
+
+    Arguments:
+    - cmd: command to run.
+    - dest: if set, a writable file-like object that receives the output. Since
+          the output can't be rewound, it isn't retried on failure.
+
+    Returns:
+      The output as str, True if dest was set, None on failure.
+    """
+    if isinstance(cmd, unicode):
+      cmd = cmd.encode('utf-8')
+    assert isinstance(cmd, str), cmd
+    if self._adb_cmd:
+      for _ in self._Loop():
+        try:
+          if dest is None:
+            return self._adb_cmd.ExecOut(cmd)
+          self._adb_cmd.ExecOut(cmd, dest)
+          return True
+        except self._ERRORS as e:
+          if dest is not None or not self._Reset('(%s): %s', cmd, e):
+            break
+    return None
+
   def IsShellOk(self, cmd):
     """Returns True if the shell command can be sent."""
     if isinstance(cmd, unicode):
@@ -403,18 +811,29 @@ class AdbCommandsSafe(object):
     assert isinstance(cmd, str), cmd
     if not self._adb_cmd:
       return True
-    cmd_size = len(cmd + self._SHELL_SUFFIX)
-    pkt_size = self.max_packet_size - len('shell:')
+    if self._HasShellV2():
+      cmd_size = len(cmd)
+      pkt_size = self.max_packet_size - len('shell,v2,raw:')
+    else:
+      cmd_size = len(cmd + self._SHELL_SUFFIX)
+      pkt_size = self.max_packet_size - len('shell:')
     # Has to keep one byte for trailing nul byte.
     return cmd_size < pkt_size
 
-  def ShellRaw(self, cmd):
+  def ShellRaw(self, cmd, sink=None, max_size=None):
     """Runs a command on an Android device.
 
     It is expected that the user quote cmd properly.
 
     It fails if cmd is too long.
 
+    Arguments:
+      cmd: command to run.
+      sink: if set, a writable file-like object or a callable that receives
+          the output as str as it comes, in which case stdout is u''.
+      max_size: if set, the output is truncated to this many bytes. The rest
+          is read and discarded so the exit code is still returned.
+
     Returns:
       tuple(stdout, exit_code)
       - stdout is as unicode if it ran, None if an USB error occurred.
@@ -425,17 +844,19 @@ class AdbCommandsSafe(object):
     assert isinstance(cmd, str), cmd
     if not self._adb_cmd:
       return None, None
-    # The adb protocol doesn't return the exit code, so embed it inside the
-    # command.
     assert self.IsShellOk(cmd), 'Command is too long: %r' % cmd
-    out = self._adb_cmd.Shell(cmd + self._SHELL_SUFFIX).decode(
-        'utf-8', 'replace')
+    if self._HasShellV2():
+      return self._ShellV2Merged(cmd, sink=sink, max_size=max_size)
+
+    # The legacy protocol doesn't return the exit code, so embed it inside the
+    # command. adb shell uses CRLF EOL. Only God Knows Why.
+    output = _ShellOutput(sink, max_size, legacy=True)
+    self._adb_cmd.Shell(cmd + self._SHELL_SUFFIX, sink=output.write)
+    out = output.PopTail()
     # Protect against & or other bash conditional execution that wouldn't make
     # the 'echo $?' command to run.
     if not out:
-      return out, None
-    # adb shell uses CRLF EOL. Only God Knows Why.
-    out = out.replace('\r\n', '\n')
+      return output.Result(), None
     # TODO(maruel): Remove and handle if this is ever trapped.
     assert out[-1] == '\n', out
     # Strip the last line to extract the exit code.
@@ -449,13 +870,15 @@ class AdbCommandsSafe(object):
         parts[0] += '\n' + parts[1]
     else:
       parts[0] = out
-    return parts[0], exit_code
+    output.Forward(parts[0])
+    return output.Result(), exit_code
 
   def StreamingShell(self, cmd):
     """Streams the output from shell.
 
     Yields output as str. The exit code and exceptions are lost. If the device
-    context is invalid, the command is silently dropped.
+    context is invalid, the command is silently dropped. If the generator is
+    closed before the end, the stream is cancelled.
     """
     if isinstance(cmd, unicode):
       cmd = cmd.encode('utf-8')
@@ -463,12 +886,21 @@ class AdbCommandsSafe(object):
     assert self.IsShellOk(cmd), 'Command is too long: %r' % cmd
     if self._adb_cmd:
       try:
-        for out in self._adb_cmd.StreamingShell(cmd):
-          yield out
+        with self._adb_cmd.StreamingShell(cmd) as stream:
+          for out in stream:
+            yield out
       except self._ERRORS as e:
         # Do not try to reset the USB context, just exit.
         _LOG.info('%s.StreamingShell(): %s', self.port_path, e)
 
+  def StreamingShellLines(self, cmd, decode=True):
+    """Streams the output from shell, line by line.
+
+    Yields each line without its line terminator, as unicode if decode is True,
+    else as str. Same limitations as StreamingShell().
+    """
+    return adb_commands.IterLines(self.StreamingShell(cmd), decode)
+
   def Root(self):
     """If adbd on the device is not root, ask it to restart as root.
 
@@ -529,6 +961,39 @@ class AdbCommandsSafe(object):
 
   # Protected methods.
 
+  def _HasShellV2(self):
+    """Returns True if the device supports the shell v2 protocol, which returns
+    the exit code natively.
+    """
+    return 'shell_v2' in self._adb_cmd.features
+
+  def _CloseSession(self):
+    with self._session_lock:
+      session, self._session = self._session, None
+    if session:
+      try:
+        session.Close()
+      except self._ERRORS as e:
+        _LOG.info('%s._CloseSession(): %s', self.port_path, e)
+
+  def _ShellV2Merged(self, cmd, stdin=None, sink=None, max_size=None):
+    """Runs a command with the shell v2 protocol.
+
+    stdout and stderr are merged in the order they are received, like a PTY
+    would. sink and max_size are as in ShellRaw().
+
+    Returns:
+      tuple(stdout as unicode, exit_code)
+    """
+    output = _ShellOutput(sink, max_size)
+    exit_code = None
+    for packet_id, data in self._adb_cmd.StreamingShellV2(cmd, stdin):
+      if packet_id == adb_protocol.ShellV2Protocol.ID_EXIT:
+        exit_code = data
+      else:
+        output.write(data)
+    return output.Result(), exit_code
+
   def _Reboot(self):
     """Reboots the phone."""
     i = 0
@@ -599,8 +1064,8 @@ class AdbCommandsSafe(object):
   def _Unroot(self):
     """Reduces adbd from root to shell user context (uid 2000).
 
-    Doing so has the effect of having the device switch USB port. As such, the
-    device has to be found back by the serial number, not by self.port_path
+    Doing so has the effect of having the device reenumerate. As such, the
+    device serial number is checked when finding it back at self.port_path.
     """
     assert self._serial
     i = 0
@@ -639,31 +1104,42 @@ class AdbCommandsSafe(object):
   def _Find(self, use_serial):
     """Initializes self._handle from self.port_path.
 
-    The handle is left unopened.
+    The handle is left unopened. A handle not on USB, e.g. TCP or through the
+    adb server, is reused as is.
     """
     assert not self._handle
     assert not self._adb_cmd
-    # TODO(maruel): Add support for TCP/IP communication.
+    if not self._is_usb:
+      self._handle = self._initial_handle
+      return True
     try:
       if self.port_path:
         previous_port_path = self._port_path
         if use_serial:
           assert self._serial
-          self._handle = common.UsbHandle.Find(
-              adb_commands.DeviceIsAvailable, serial=self._serial,
-              timeout_ms=self._default_timeout_ms)
+          try:
+            # The port path survives reenumerations, so the device is normally
+            # still there; only read the serial number of this one.
+            self._handle = common.UsbHandle.Find(
+                adb_commands.DeviceIsAvailable, port_path=self.port_path,
+                serial=self._serial, timeout_ms=self._default_timeout_ms)
+          except usb_exceptions.DeviceNotFoundError:
+            # The device was moved to another port.
+            self._handle = common.UsbHandle.Find(
+                adb_commands.DeviceIsAvailable, serial=self._serial,
+                timeout_ms=self._default_timeout_ms)
           # Update the new found port path.
           self._port_path = self._handle.port_path_str
         else:
           self._handle = common.UsbHandle.Find(
               adb_commands.DeviceIsAvailable, port_path=self.port_path,
               timeout_ms=self._default_timeout_ms)
+        if self._initial_handle:
+          self._handle = self._initial_handle.Wrap(self._handle)
         _LOG.info(
             '%s._Find(%s) %s = %s',
             previous_port_path, use_serial, self._serial,
             self.port_path if self._handle else 'None')
-      else:
-        self._handle = common.TcpHandle(self._serial)
     except (common.usb1.USBError, usb_exceptions.DeviceNotFoundError) as e:
       _LOG.debug(
           '%s._Find(%s) %s : %s', self.port_path, use_serial, self._serial, e)
@@ -681,10 +1157,26 @@ class AdbCommandsSafe(object):
     _LOG.debug(
         '%s._WaitUntilFound(%s)',
         self.port_path, self.serial if use_serial else use_serial)
-    i = 0
-    for i in self._Loop(timeout=timeout):
+    # Wake up as soon as a device shows up at the port path, or anywhere when
+    # it may have moved, instead of polling when hotplug is supported.
+    port_path = None if use_serial else self.port_path
+    timeout = (timeout or self._lost_timeout_ms) / 1000.
+    start = time.time()
+    for i in xrange(self._tries):
+      generation = common.USB_REGISTRY.generation
       if self._Find(use_serial=use_serial):
         return True
+      remaining = timeout - (time.time() - start)
+      if remaining <= 0:
+        break
+      if self._is_usb:
+        # Poll periodically anyway as the interface may show up after the
+        # device.
+        common.USB_REGISTRY.WaitForArrival(
+            generation, min(remaining, 1.), port_path=port_path,
+            poll=self._sleep)
+      else:
+        time.sleep(min(remaining, self._sleep))
     # Enumerate the devices present to help.
     def fn(h):
       try:
@@ -821,9 +1313,9 @@ class AdbCommandsSafe(object):
     """Disconnects and reconnect.
 
     Arguments:
-    - use_serial: If True, search the device by the serial number instead of the
-        port number. This is necessary when downgrading adbd from root to user
-        context.
+    - use_serial: If True, ensure the device found has the same serial number,
+        looking elsewhere on the bus if it is not at its port path anymore. This
+        is necessary when downgrading adbd from root to user context.
 
     Returns True on success.
     """
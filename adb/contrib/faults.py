@@ -0,0 +1,210 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Handle wrapper injecting latency and faults, to reproduce slow or flaky
+connections on demand.
+
+  handle = faults.FaultyHandle(
+      common.UsbHandle.Find(...), seed=1,
+      read_latency=faults.Exponential(0.002), bandwidth=1024*1024,
+      read_error_rate=0.001)
+  device = high.HighDevice.Connect(handle, ...)
+
+All the random decisions are drawn from a single random.Random seeded by the
+caller so a run can be reproduced.
+"""
+
+import collections
+import random
+import threading
+import time
+
+from adb import common
+from adb import usb_exceptions
+
+
+# Latency distributions. Each returns a function that draws a delay in seconds
+# from a random.Random instance.
+
+
+def Constant(seconds):
+  return lambda rng: seconds
+
+
+def Uniform(low, high):
+  return lambda rng: rng.uniform(low, high)
+
+
+def Exponential(mean):
+  return lambda rng: rng.expovariate(1. / mean)
+
+
+def Normal(mean, stddev):
+  """Normal distribution, clamped at 0."""
+  return lambda rng: max(0., rng.normalvariate(mean, stddev))
+
+
+class FaultyHandle(common.Handle):
+  """Wraps a common.Handle to inject latency and faults in each BulkRead() and
+  BulkWrite() call.
+
+  Injected errors are raised instead of doing the call, so no data is lost or
+  duplicated on the wrapped handle. Short reads return a part of the data read;
+  the rest is returned by the next BulkRead() calls, like a device splitting its
+  reply in multiple transfers.
+
+  Handles can be wrapped multiple times to combine different settings.
+  """
+
+  def __init__(
+      self, handle, seed=None, read_latency=None, write_latency=None,
+      bandwidth=None, short_read_rate=0., read_error_rate=0.,
+      write_error_rate=0.):
+    """Initializes the wrapper.
+
+    Arguments:
+      handle: common.Handle to wrap.
+      seed: seed of the random decisions; None uses the system entropy.
+      read_latency: function returning the delay to add to each BulkRead()
+          call, e.g. Exponential(0.001).
+      write_latency: same for BulkWrite().
+      bandwidth: if set, maximum throughput in bytes/s in each direction.
+      short_read_rate: probability for a BulkRead() to return less than asked.
+      read_error_rate: probability for a BulkRead() to raise ReadFailedError.
+      write_error_rate: probability for a BulkWrite() to raise
+          WriteFailedError.
+    """
+    super(FaultyHandle, self).__init__()
+    self._handle = handle
+    self._rng = random.Random(seed)
+    self._rng_lock = threading.Lock()
+    self._read_latency = read_latency
+    self._write_latency = write_latency
+    self._bandwidth = bandwidth
+    self._short_read_rate = short_read_rate
+    self._read_error_rate = read_error_rate
+    self._write_error_rate = write_error_rate
+    # Data read from the wrapped handle but not returned yet.
+    self._leftover = ''
+    # Number of injected faults per kind and the total injected delay.
+    self.stats = collections.Counter()
+
+  def Timeout(self, timeout_ms):
+    return self._handle.Timeout(timeout_ms)
+
+  @property
+  def port_path(self):
+    return self._handle.port_path
+
+  @property
+  def is_local(self):
+    return self._handle.is_local
+
+  @property
+  def is_open(self):
+    return self._handle.is_open
+
+  @property
+  def supports_combined_writes(self):
+    return self._handle.supports_combined_writes
+
+  @property
+  def supports_sendfile(self):
+    return self._handle.supports_sendfile
+
+  @property
+  def is_usb(self):
+    return self._handle.is_usb
+
+  @property
+  def port_path_str(self):
+    return self._handle.port_path_str
+
+  @property
+  def serial_number(self):
+    return self._handle.serial_number
+
+  def Wrap(self, handle):
+    """Wraps the new handle found on a reconnection, keeping the random state
+    and the stats.
+    """
+    self._handle = self._handle.Wrap(handle)
+    self._leftover = ''
+    return self
+
+  def Open(self):
+    self._leftover = ''
+    self._handle.Open()
+
+  def Close(self):
+    self._leftover = ''
+    self._handle.Close()
+
+  def FlushBuffers(self):
+    self._leftover = ''
+    flush = getattr(self._handle, 'FlushBuffers', None)
+    if flush:
+      flush()
+
+  def BulkWrite(self, data, timeout_ms=None):
+    self._Delay(self._write_latency, len(data))
+    if self._Draw(self._write_error_rate):
+      self.stats['write_errors'] += 1
+      raise usb_exceptions.WriteFailedError(
+          'Injected write failure', common.usb1.USBErrorTimeout())
+    return self._handle.BulkWrite(data, timeout_ms)
+
+  def BulkWriteFile(self, data, fd, offset, length, timeout_ms=None):
+    self._Delay(self._write_latency, len(data) + length)
+    if self._Draw(self._write_error_rate):
+      self.stats['write_errors'] += 1
+      raise usb_exceptions.WriteFailedError(
+          'Injected write failure', common.usb1.USBErrorTimeout())
+    return self._handle.BulkWriteFile(data, fd, offset, length, timeout_ms)
+
+  def BulkRead(self, length, timeout_ms=None):
+    self._Delay(self._read_latency, length)
+    if self._Draw(self._read_error_rate):
+      self.stats['read_errors'] += 1
+      raise usb_exceptions.ReadFailedError(
+          'Injected read failure', common.usb1.USBErrorTimeout())
+    if self._leftover:
+      data, self._leftover = self._leftover[:length], self._leftover[length:]
+    else:
+      data = self._handle.BulkRead(length, timeout_ms)
+    if len(data) > 1 and self._Draw(self._short_read_rate):
+      self.stats['short_reads'] += 1
+      with self._rng_lock:
+        size = self._rng.randint(1, len(data) - 1)
+      data, self._leftover = data[:size], data[size:] + self._leftover
+    return data
+
+  def _Draw(self, rate):
+    """Returns True with the probability rate."""
+    if not rate:
+      return False
+    with self._rng_lock:
+      return self._rng.random() < rate
+
+  def _Delay(self, latency, size):
+    """Sleeps for the latency drawn plus the transfer time of size bytes."""
+    delay = 0.
+    if latency:
+      with self._rng_lock:
+        delay = latency(self._rng)
+    if self._bandwidth:
+      delay += float(size) / self._bandwidth
+    if delay > 0:
+      self.stats['delay'] += delay
+      time.sleep(delay)
@@ -20,6 +20,7 @@ protocol.
 """
 
 import collections
+import hashlib
 import logging
 import os
 import pipes
@@ -27,10 +28,12 @@ import posixpath
 import random
 import re
 import string
+import tempfile
 import threading
 import time
 
 
+from adb import adb_server
 from adb import common
 from adb import sign_pythonrsa
 from adb.contrib import adb_commands_safe
@@ -59,35 +62,220 @@ class _PerDeviceCache(object):
 
   def __init__(self):
     self._lock = threading.Lock()
-    # Keys is usb path, value is a _Cache.Device.
+    # Keys is _Key(device), value is a _Cache.Device.
     self._per_device = {}
 
+  @staticmethod
+  def _Key(device):
+    # The port path is stable across reboots; the serial number catches a
+    # different device plugged in the same port and the boot id a reboot,
+    # which may have been to reflash it.
+    return (device.port_path, device.serial, _ReadBootId(device))
+
   def get(self, device):
+    key = self._Key(device)
     with self._lock:
-      return self._per_device.get(device.port_path)
+      return self._per_device.get(key)
 
   def set(self, device, cache):
+    key = self._Key(device)
+    if not key[2]:
+      # It couldn't be told apart from the next boot's.
+      return
     with self._lock:
-      self._per_device[device.port_path] = cache
+      self._per_device[key] = cache
 
   def trim(self, devices):
-    """Removes any stale cache for any device that is not found anymore.
+    """Removes the cache of the devices that are not found anymore or that
+    rebooted since.
 
     So if a device is disconnected, reflashed then reconnected, the cache isn't
     invalid.
     """
-    device_keys = {d.port_path: d for d in devices}
+    device_keys = {self._Key(d): d for d in devices}
     with self._lock:
-      for port_path in self._per_device.keys():
-        dev = device_keys.get(port_path)
+      for key in self._per_device.keys():
+        dev = device_keys.get(key)
         if not dev or not dev.is_valid:
-          del self._per_device[port_path]
+          del self._per_device[key]
 
 
 # Global cache of per device cache.
 _PER_DEVICE_CACHE = _PerDeviceCache()
 
 
+class _ContentIndex(object):
+  """Remembers the blobs known to be in each device's content-addressed store,
+  thread-safe.
+
+  It is keyed by the device serial and not the port path, so it survives the
+  device being reenumerated or moved to another USB port. The blobs are only
+  trusted for the boot id they were seen in, since a wipe or a reflash
+  reboots the device.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Keys is the device serial, value is tuple(boot_id, set of blob paths on
+    # the device).
+    self._per_serial = {}
+
+  def has(self, serial, boot_id, blob):
+    with self._lock:
+      known_boot_id, blobs = self._per_serial.get(serial, (None, ()))
+      return known_boot_id == boot_id and blob in blobs
+
+  def add(self, serial, boot_id, blob):
+    with self._lock:
+      known_boot_id, blobs = self._per_serial.get(serial, (None, None))
+      if known_boot_id != boot_id:
+        blobs = set()
+        self._per_serial[serial] = (boot_id, blobs)
+      blobs.add(blob)
+
+  def discard(self, serial, blob):
+    with self._lock:
+      self._per_serial.get(serial, (None, set()))[1].discard(blob)
+
+
+# Global index of the blobs pushed in the content-addressed store of each
+# device.
+_CONTENT_INDEX = _ContentIndex()
+
+
+class _BootScopedCache(object):
+  """Memoizes device queries whose answer can't change until the next boot,
+  thread-safe.
+
+  Entries are keyed by the device serial and its boot id, so a reboot makes all
+  the previous entries unreachable; they are eventually evicted in LRU order.
+  """
+
+  def __init__(self, max_entries, boot_id_ttl):
+    self._lock = threading.Lock()
+    self._max_entries = max_entries
+    self._boot_id_ttl = boot_id_ttl
+    # Keys is (serial, boot_id, name, args), value is (expiration, value).
+    # Expiration is None for entries valid until the next boot.
+    self._entries = collections.OrderedDict()
+    # Keys is the device serial, value is (boot_id, time it was last read).
+    self._boot_ids = {}
+
+  def get_boot_id(self, serial):
+    """Returns the last known boot id if it was read recently enough."""
+    with self._lock:
+      boot_id, when = self._boot_ids.get(serial, (None, 0))
+      if time.time() - when < self._boot_id_ttl:
+        return boot_id
+      return None
+
+  def set_boot_id(self, serial, boot_id):
+    with self._lock:
+      self._boot_ids[serial] = (boot_id, time.time())
+
+  def get(self, key):
+    """Returns tuple(found, value)."""
+    with self._lock:
+      item = self._entries.pop(key, None)
+      if not item:
+        return False, None
+      if item[0] is not None and item[0] < time.time():
+        return False, None
+      # Move it back as the most recently used.
+      self._entries[key] = item
+      return True, item[1]
+
+  def set(self, key, value, ttl):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + ttl if ttl else None, value)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def invalidate(self, serial, name=None):
+    """Forgets the entries of a device, optionally only for one method.
+
+    When name is None, the boot id is forgotten too.
+    """
+    with self._lock:
+      for key in self._entries.keys():
+        if key[0] == serial and name in (None, key[2]):
+          del self._entries[key]
+      if name is None:
+        self._boot_ids.pop(serial, None)
+
+
+# Global cache of the boot-scoped device queries.
+_BOOT_CACHE = _BootScopedCache(max_entries=4096, boot_id_ttl=5.)
+
+
+def _ReadBootId(device):
+  """Returns the boot id of an AdbCommandsSafe or HighDevice, re-read at most
+  every few seconds.
+  """
+  boot_id = _BOOT_CACHE.get_boot_id(device.serial)
+  if not boot_id:
+    boot_id = (device.PullContent('/proc/sys/kernel/random/boot_id') or
+               '').strip()
+    if boot_id:
+      _BOOT_CACHE.set_boot_id(device.serial, boot_id)
+  return boot_id or None
+
+# dumpsys services whose output doesn't change until the next boot.
+_MEMOIZED_DUMPSYS = frozenset(['iphonesubinfo'])
+
+
+# Parses the lines '[key]: [value]' output by getprop. Values can span multiple
+# lines.
+_GETPROP_RE = re.compile(r'^\[([^\]]+)\]: \[(.*?)\]$', re.MULTILINE|re.DOTALL)
+
+
+def _HashFile(path):
+  """Returns the hex SHA-256 digest of a local file."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1024*1024)
+      if not chunk:
+        break
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _HashBlocks(path, block_size):
+  """Returns the list of hex SHA-1 digests of each block of a local file."""
+  out = []
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(block_size)
+      if not chunk:
+        break
+      out.append(hashlib.sha1(chunk).hexdigest())
+  return out
+
+
+def _HashFilesInBackground(paths):
+  """Starts hashing local files in a background thread.
+
+  Returns a function that waits for the hashing to complete and returns a dict
+  of path to hex SHA-256 digest. Files that couldn't be read are not included.
+  """
+  out = {}
+  def run():
+    for path in paths:
+      try:
+        out[path] = _HashFile(path)
+      except IOError:
+        pass
+  thread = threading.Thread(target=run, name='HashFiles')
+  thread.daemon = True
+  thread.start()
+  def wait():
+    thread.join()
+    return out
+  return wait
+
+
 def _ParcelToList(lines):
   """Parses 'service call' output."""
   out = []
@@ -108,6 +296,18 @@ def _ParcelToList(lines):
   return out
 
 
+def _PackageManagerSucceeded(out, exit_code):
+  """Returns True if a package manager command succeeded.
+
+  The exit code is not available on the fast paths so rely on the output,
+  whose last line is 'Success' on success.
+  """
+  if exit_code is not None:
+    return exit_code == 0
+  lines = (out or '').strip().splitlines()
+  return bool(lines) and lines[-1].strip() == 'Success'
+
+
 def _InitCache(device):
   """Primes data known to be fetched soon right away that is static for the
   lifetime of the device.
@@ -206,6 +406,20 @@ KNOWN_CPU_SCALING_GOVERNOR_VALUES = (
 )
 
 
+# Default directory on the device holding the content-addressed store used by
+# HighDevice.PushDeduplicated().
+DEFAULT_CAS_DIR = '/data/local/tmp/.cas'
+
+
+# Default block size used by HighDevice.PushDelta().
+DEFAULT_DELTA_BLOCK_SIZE = 1024*1024
+
+
+# Duration in seconds HighDevice.GetProps() keeps its snapshot of the system
+# properties.
+PROPS_TTL = 1.
+
+
 # DeviceCache is static information about a device that it preemptively
 # initialized and that cannot change without formatting the device.
 DeviceCache = collections.namedtuple(
@@ -261,7 +475,6 @@ def _ConnectFromHandles(handles, as_root=False, **kwargs):
   def fn(handle):
     device = HighDevice.Connect(handle, **kwargs)
     if as_root and device.cache.has_su and not device.IsRoot():
-      # This updates the port path of the device thus clears its cache.
       device.Root()
     return device
 
@@ -335,6 +548,41 @@ def GetRemoteDevices(banner, endpoints, default_timeout_ms, auth_timeout_ms,
                              as_root=as_root)
 
 
+def GetServerDevices(banner, default_timeout_ms, auth_timeout_ms,
+                     on_error=None, as_root=False):
+  """Returns the list of devices available through the local adb server.
+
+  Unlike GetLocalDevices(), the adb server keeps ownership of the USB devices so
+  it doesn't have to be killed and other tools can keep using the devices.
+
+  Caller MUST call CloseDevices(devices) on the return value or call .Close() on
+  each element to close the handles.
+
+  Arguments:
+  - banner: authentication banner associated with the RSA keys. It's better to
+        use a constant.
+  - default_timeout_ms: default I/O operation timeout.
+  - auth_timeout_ms: timeout for the user to accept the public key.
+  - on_error: callback when an internal failure occurs.
+  - as_root: if True, restarts adbd as root if possible.
+
+  Returns one of:
+    - list of HighDevice instances.
+    - None if adb is unavailable.
+  """
+  with _ADB_KEYS_LOCK:
+    if not _ADB_KEYS:
+      return []
+  # Create unopened handles for all the devices known by the server.
+  handles = list(
+      adb_server.AdbServerHandle.FindDevices(timeout_ms=default_timeout_ms))
+
+  return _ConnectFromHandles(handles, banner=banner,
+                             default_timeout_ms=default_timeout_ms,
+                             auth_timeout_ms=auth_timeout_ms, on_error=on_error,
+                             as_root=as_root)
+
+
 def CloseDevices(devices):
   """Closes all devices opened by GetDevices()."""
   for device in devices or []:
@@ -399,6 +647,9 @@ class HighDevice(object):
   def Close(self):
     self._device.Close()
 
+  def ExecOut(self, *args, **kwargs):
+    return self._device.ExecOut(*args, **kwargs)
+
   def GetUptime(self):
     """Returns the device's uptime in second."""
     return self._device.GetUptime()
@@ -421,12 +672,32 @@ class HighDevice(object):
   def PushContent(self, *args, **kwargs):
     return self._device.PushContent(*args, **kwargs)
 
+  def PullResumable(self, remotefile, dest, **kwargs):
+    """Pulls a large file, resuming after connection resets, then verifies its
+    hash.
+    """
+    return self.PullChecked(
+        [(remotefile, dest)], skip_identical=False,
+        pull=lambda r, l: self._device.PullResumable(r, l, **kwargs))
+
+  def PushResumable(self, localfile, dest, **kwargs):
+    """Pushes a large file, resuming after connection resets, then verifies its
+    hash.
+    """
+    return self.PushChecked(
+        [(localfile, dest)], skip_identical=False,
+        push=lambda l, d: self._device.PushResumable(l, d, **kwargs))
+
+  def PackageManager(self, args):
+    return self._device.PackageManager(args)
+
   def Reboot(self):
     """Reboots the phone then Waits for the device to come back.
 
     adbd running on the phone will likely not be in Root(), so the caller should
     call Root() right afterward if desired.
     """
+    _BOOT_CACHE.invalidate(self.serial)
     if not self._device.Reboot():
       return False
     return self.WaitUntilFullyBooted()
@@ -435,25 +706,48 @@ class HighDevice(object):
     return self._device.Remount()
 
   def Root(self):
+    _BOOT_CACHE.invalidate(self.serial)
     return self._device.Root()
 
-  def Shell(self, cmd):
-    """Automatically uses WrappedShell() when necessary."""
+  def Shell(self, cmd, sink=None, max_size=None):
+    """Automatically uses WrappedShell() when necessary.
+
+    sink and max_size are as in AdbCommandsSafe.ShellRaw().
+    """
     if self._device.IsShellOk(cmd):
-      return self._device.Shell(cmd)
-    else:
-      return self.WrappedShell([cmd])
+      return self._device.Shell(cmd, sink=sink, max_size=max_size)
+    result = self.WrappedShell([cmd])
+    if not result or not result[0] or (sink is None and max_size is None):
+      return result
+    out = result[0].encode('utf-8')[:max_size]
+    if sink is not None:
+      getattr(sink, 'write', sink)(out)
+      out = ''
+    return out.decode('utf-8', 'replace'), result[1]
 
   def ShellRaw(self, cmd):
     return self._device.ShellRaw(cmd)
 
+  def SessionShell(self, cmd):
+    """Runs a command in a long lived shell, which is faster than Shell() for
+    small commands.
+
+    Returns:
+      tuple(stdout, exit_code)
+    """
+    return self._device.SessionShell(cmd)
+
   def StreamingShell(self, cmd):
     return self._device.StreamingShell(cmd)
 
+  def StreamingShellLines(self, cmd, decode=True):
+    return self._device.StreamingShellLines(cmd, decode)
+
   def Stat(self, dest):
     return self._device.Stat(dest)
 
   def Unroot(self):
+    _BOOT_CACHE.invalidate(self.serial)
     return self._device.Unroot()
 
   def __repr__(self):
@@ -651,6 +945,9 @@ class HighDevice(object):
 
   def GetIMEI(self):
     """Returns the phone's IMEI."""
+    return self._Memoize('GetIMEI', (), None, self._GetIMEI)
+
+  def _GetIMEI(self):
     # Android <5.0.
     out = self.Dumpsys('iphonesubinfo')
     if out:
@@ -705,7 +1002,7 @@ class HighDevice(object):
 
   def GetPackages(self):
     """Returns the list of packages installed."""
-    out, _ = self.Shell('pm list packages')
+    out, _ = self.PackageManager(['list', 'packages'])
     if not out:
       return None
     return [l.split(':', 1)[1] for l in out.strip().splitlines() if ':' in l]
@@ -717,25 +1014,283 @@ class HighDevice(object):
     dest = posixpath.join(destdir, os.path.basename(apk))
     if not self.Push(apk, dest):
       return False
-    cmd = 'pm install -r %s' % pipes.quote(dest)
-    out, exit_code = self.Shell(cmd)
-    if not exit_code:
+    _BOOT_CACHE.invalidate(self.serial, 'GetApplicationPath')
+    out, exit_code = self.PackageManager(['install', '-r', dest])
+    if _PackageManagerSucceeded(out, exit_code):
       return True
-    _LOG.info('%s: %s', cmd, out)
+    _LOG.info('install %s: %s', dest, out)
+    return False
+
+  def PushDeduplicated(self, localfile, dest, cas_dir=DEFAULT_CAS_DIR,
+                       link=False):
+    """Pushes a local file to dest through a content-addressed store on the
+    device.
+
+    The content is pushed once in cas_dir, named after its SHA-256 digest on the
+    host. Pushing the same content again, to any path, is then a copy on the
+    device. Blobs known to be present are remembered per device serial and
+    boot id so the store is not even queried. Like a push, the parent
+    directory of dest is created as needed.
+
+    Arguments:
+    - localfile: path of the file on the host.
+    - dest: path of the file on the device.
+    - cas_dir: directory on the device holding the blobs.
+    - link: if True, dest is made a symlink to the blob instead of a copy. This
+          is faster but dest must then never be modified in place.
+
+    Returns True on success.
+    """
+    blob = posixpath.join(cas_dir, _HashFile(localfile))
+    quoted_blob = pipes.quote(blob)
+    cmd = 'mkdir -p %s && ' % pipes.quote(posixpath.dirname(dest) or '.')
+    if link:
+      # ln succeeds even if the blob is gone, leaving a dangling symlink.
+      cmd = '[ -f %s ] && %sln -sf' % (quoted_blob, cmd)
+    else:
+      cmd += 'cp'
+    # Without a boot id, the index can't be trusted.
+    boot_id = self._GetBootId()
+    for _ in xrange(2):
+      if not boot_id or not _CONTENT_INDEX.has(self.serial, boot_id, blob):
+        mode, size, _ = self.Stat(blob)
+        if not mode or size != os.stat(localfile).st_size:
+          # Push to a temporary name so an interrupted push never leaves a
+          # truncated blob under its final name. adbd creates cas_dir as needed.
+          tmp = blob + '.tmp'
+          if not self.Push(localfile, tmp):
+            return False
+          if self.Shell(
+              'mv %s %s' % (pipes.quote(tmp), quoted_blob))[1] != 0:
+            return False
+        if boot_id:
+          _CONTENT_INDEX.add(self.serial, boot_id, blob)
+      out, exit_code = self.Shell(
+          '%s %s %s' % (cmd, quoted_blob, pipes.quote(dest)))
+      if exit_code == 0:
+        return True
+      # The blob may have vanished behind our back, e.g. the device was wiped.
+      # Forget about it and try again once, which will push it.
+      _LOG.info('%s.PushDeduplicated(): %s', self.port_path, out)
+      _CONTENT_INDEX.discard(self.serial, blob)
     return False
 
+  def GetFileHashes(self, paths):
+    """Returns the SHA-256 of files on the device.
+
+    All the files are hashed with a single shell command.
+
+    Returns one of:
+    - dict of path to hex SHA-256 digest. Files that couldn't be read are not
+      included.
+    - None if sha256sum is not available on the device.
+    """
+    if not paths:
+      return {}
+    out, exit_code = self.Shell(
+        'sha256sum %s 2>/dev/null' % ' '.join(pipes.quote(p) for p in paths))
+    # sha256sum exits with 1 when at least one of the files couldn't be read.
+    if out is None or exit_code not in (0, 1):
+      return None
+    hashes = {}
+    for line in out.splitlines():
+      parts = line.split(None, 1)
+      if len(parts) == 2 and re.match(r'^[0-9a-f]{64}$', parts[0]):
+        hashes[parts[1]] = parts[0]
+    return hashes
+
+  def PushChecked(self, items, skip_identical=True, verify=True, push=None):
+    """Pushes local files to the device, using hashes to skip and check them.
+
+    The files are hashed on the device and on the host in parallel. The device
+    side is hashed with one shell command for all the files, both before and
+    after the transfer.
+
+    Arguments:
+    - items: list of tuple(localfile, dest).
+    - skip_identical: if True, files with the same content on the device are
+          not pushed.
+    - verify: if True, the content on the device is verified after the push.
+    - push: function used to push each file, defaults to self.Push.
+
+    Returns True on success.
+    """
+    push = push or self.Push
+    dests = [dest for _, dest in items]
+    local_hashes = _HashFilesInBackground([l for l, _ in items])
+    remote_hashes = {}
+    if skip_identical:
+      remote_hashes = self.GetFileHashes(dests) or {}
+    local_hashes = local_hashes()
+    pushed = []
+    for localfile, dest in items:
+      if local_hashes.get(localfile) and (
+          remote_hashes.get(dest) == local_hashes[localfile]):
+        continue
+      if not push(localfile, dest):
+        return False
+      pushed.append((localfile, dest))
+    if not verify or not pushed:
+      return True
+    remote_hashes = self.GetFileHashes([d for _, d in pushed])
+    if remote_hashes is None:
+      _LOG.warning(
+          '%s.PushChecked(): sha256sum is not available, can\'t verify',
+          self.port_path)
+      return True
+    for localfile, dest in pushed:
+      if remote_hashes.get(dest) != local_hashes.get(localfile):
+        _LOG.error('%s.PushChecked(): %s is corrupted', self.port_path, dest)
+        return False
+    return True
+
+  def PullChecked(self, items, skip_identical=True, verify=True, pull=None):
+    """Pulls files from the device, using hashes to skip and check them.
+
+    This is the mirror of PushChecked().
+
+    Arguments:
+    - items: list of tuple(remotefile, localfile).
+    - skip_identical: if True, local files that already have the same content
+          as on the device are not pulled.
+    - verify: if True, the local content is verified after the pull.
+    - pull: function used to pull each file, defaults to self.Pull.
+
+    Returns True on success.
+    """
+    pull = pull or self.Pull
+    local_hashes = _HashFilesInBackground(
+        [l for _, l in items if os.path.isfile(l)] if skip_identical else [])
+    remote_hashes = {}
+    if skip_identical or verify:
+      remote_hashes = self.GetFileHashes([r for r, _ in items])
+    local_hashes = local_hashes()
+    pulled = []
+    for remotefile, localfile in items:
+      if remote_hashes and remote_hashes.get(remotefile) and (
+          local_hashes.get(localfile) == remote_hashes[remotefile]):
+        continue
+      if not pull(remotefile, localfile):
+        return False
+      pulled.append((remotefile, localfile))
+    if not verify or not pulled:
+      return True
+    if remote_hashes is None:
+      _LOG.warning(
+          '%s.PullChecked(): sha256sum is not available, can\'t verify',
+          self.port_path)
+      return True
+    local_hashes = _HashFilesInBackground([l for _, l in pulled])()
+    for remotefile, localfile in pulled:
+      if local_hashes.get(localfile) != remote_hashes.get(remotefile):
+        _LOG.error(
+            '%s.PullChecked(): %s is corrupted', self.port_path, localfile)
+        return False
+    return True
+
+  def PushDelta(self, localfile, dest, block_size=DEFAULT_DELTA_BLOCK_SIZE,
+                max_changed_ratio=0.5):
+    """Pushes a local file over an older version of it on the device, only
+    sending the blocks that changed.
+
+    Blocks are hashed on the host and on the device, the latter with a single
+    shell command. The changed blocks are pushed as one patch file that is
+    written in place with dd, then the whole file is verified.
+
+    Falls back to a full push when dest doesn't exist, when more than
+    max_changed_ratio of the blocks changed or when the tools are missing on the
+    device.
+
+    Returns True on success.
+    """
+    size = os.stat(localfile).st_size
+    mode, remote_size, _ = self.Stat(dest)
+    if not mode:
+      return self.Push(localfile, dest)
+
+    local_blocks = []
+    def run():
+      local_blocks.extend(_HashBlocks(localfile, block_size))
+    thread = threading.Thread(target=run, name='HashBlocks')
+    thread.daemon = True
+    thread.start()
+    # Only the blocks present on both sides can be compared.
+    nb_remote = (min(size, remote_size) + block_size - 1) / block_size
+    remote_blocks = []
+    if nb_remote:
+      out, exit_code = self.Shell(
+          'i=0; while [ $i -lt %d ]; do '
+            'dd if=%s bs=%d skip=$i count=1 2>/dev/null | sha1sum; '
+            'i=$((i+1)); '
+          'done' % (nb_remote, pipes.quote(dest), block_size))
+      if exit_code == 0 and out:
+        remote_blocks = [l.split(None, 1)[0] for l in out.splitlines() if l]
+    thread.join()
+    if len(remote_blocks) != nb_remote or not all(
+        re.match(r'^[0-9a-f]{40}$', b) for b in remote_blocks):
+      _LOG.info(
+          '%s.PushDelta(): can\'t hash blocks on the device, doing a full push',
+          self.port_path)
+      return self.Push(localfile, dest)
+
+    changed = [
+      i for i, digest in enumerate(local_blocks)
+      if i >= nb_remote or remote_blocks[i] != digest
+    ]
+    if len(changed) > max_changed_ratio * len(local_blocks):
+      return self.Push(localfile, dest)
+
+    patch = dest + '.delta'
+    quoted_patch = pipes.quote(patch)
+    if changed:
+      with tempfile.TemporaryFile() as tmp:
+        with open(localfile, 'rb') as f:
+          for i in changed:
+            f.seek(i * block_size)
+            tmp.write(f.read(block_size))
+        tmp.seek(0)
+        if not self.Push(tmp, patch):
+          return False
+    cmds = [
+      'dd if=%s of=%s bs=%d skip=%d seek=%d count=1 conv=notrunc 2>/dev/null' %
+      (quoted_patch, pipes.quote(dest), block_size, j, i)
+      for j, i in enumerate(changed)
+    ]
+    if remote_size > size:
+      cmds.append(
+          'dd if=/dev/null of=%s bs=1 seek=%d count=0 2>/dev/null' %
+          (pipes.quote(dest), size))
+    if cmds:
+      _, exit_code = self.Shell(' && '.join(cmds))
+      if changed:
+        self.Shell('rm -f %s' % quoted_patch)
+      if exit_code != 0:
+        return self.Push(localfile, dest)
+
+    if self.GetFileHashes([dest]) != {dest: _HashFile(localfile)}:
+      _LOG.warning(
+          '%s.PushDelta(): %s differs after patching, doing a full push',
+          self.port_path, dest)
+      return self.Push(localfile, dest)
+    return True
+
   def UninstallAPK(self, package):
     """Uninstalls the package."""
-    cmd = 'pm uninstall %s' % pipes.quote(package)
-    out, exit_code = self.Shell(cmd)
-    if not exit_code:
+    _BOOT_CACHE.invalidate(self.serial, 'GetApplicationPath')
+    out, exit_code = self.PackageManager(['uninstall', package])
+    if _PackageManagerSucceeded(out, exit_code):
       return True
-    _LOG.info('%s: %s', cmd, out)
+    _LOG.info('uninstall %s: %s', package, out)
     return False
 
   def GetApplicationPath(self, package):
     # TODO(maruel): Test.
-    out, _ = self.Shell('pm path %s' % pipes.quote(package))
+    return self._Memoize(
+        'GetApplicationPath', (package,), 60.,
+        lambda: self._GetApplicationPath(package))
+
+  def _GetApplicationPath(self, package):
+    out, _ = self.PackageManager(['path', package])
     return out.strip().split(':', 1)[1] if out else out
 
   def WaitForDevice(self, timeout=180):
@@ -772,19 +1327,25 @@ class HighDevice(object):
       return False
 
     # Wait for the internal sys.boot_completed bit to be set. This is the place
-    # where most time is spent.
+    # where most time is spent. Only query the needed property while polling,
+    # the full dump is much larger.
     while True:
+      out, exit_code = self.SessionShell('getprop init.svc.bootanim')
+      bootanim = out.strip() if exit_code == 0 and out else None
       if (time.time() - start) > timeout:
         _LOG.warning(
             '%s.WaitUntilFullyBooted() didn\'t get init.svc.bootanim in time: '
             '%r',
-            self.port_path, self.GetProp('init.svc.bootanim'))
+            self.port_path, bootanim)
         return False
       # sys.boot_completed can't be relyed on. It fires too early or worse can
       # be completely missing on some kernels (e.g. Manta).
-      if self.GetProp('init.svc.bootanim') == 'stopped':
+      if bootanim == 'stopped':
         break
       time.sleep(0.1)
+    # The properties changed during the boot; take a fresh snapshot for the
+    # GetProp() calls that follow.
+    self.GetProps(refresh=True)
 
     # Then the slowest part of all.
     while True:
@@ -794,7 +1355,7 @@ class HighDevice(object):
             'time',
             self.port_path)
         return False
-      out, _ = self.Shell('pm path')
+      out, _ = self.SessionShell('pm path')
       if out == 'Error: no package specified\n':
         # It's up!
         break
@@ -854,16 +1415,23 @@ class HighDevice(object):
         return name
 
   def WrappedShell(self, commands):
-    """Creates a temporary shell script, runs it then return the data.
+    """Runs commands as a shell script then return the data.
 
     This is needed when:
     - the expected command is more than ~500 characters
     - the expected output is more than 32k characters
 
+    The script is streamed over stdin of a single shell so nothing is left on
+    the device. Falls back to a temporary file on devices predating the exec
+    service.
+
     Returns:
       tuple(stdout and stderr merged, exit_code).
     """
     content = ''.join(l + '\n' for l in commands)
+    out, exit_code = self._device.ShellScript(content)
+    if out is not None:
+      return out, exit_code
     script = self.Mkstemp(content, suffix='.sh')
     if not script:
       return False
@@ -881,23 +1449,81 @@ class HighDevice(object):
       self.Shell('rm %s' % script)
 
   def GetProp(self, prop):
-    out, exit_code = self.Shell('getprop %s' % pipes.quote(prop))
-    if exit_code != 0:
+    # Read-only properties are set once during boot.
+    if prop.startswith('ro.'):
+      return self._Memoize(
+          'GetProp', (prop,), None, lambda: self._GetProp(prop))
+    return self._GetProp(prop)
+
+  def _GetProp(self, prop):
+    props = self.GetProps()
+    if props is None:
+      return None
+    return props.get(prop, u'')
+
+  def GetProps(self, refresh=False):
+    """Returns all the system properties as a dict.
+
+    The snapshot is kept for PROPS_TTL seconds, so reading many properties in a
+    row costs a single round trip. The returned dict is shared and must not be
+    modified.
+
+    Arguments:
+    - refresh: if True, ignores the snapshot currently held.
+    """
+    if refresh:
+      _BOOT_CACHE.invalidate(self.serial, 'GetProps')
+    return self._Memoize('GetProps', (), PROPS_TTL, self._GetProps)
+
+  def _GetProps(self):
+    out, exit_code = self.SessionShell('getprop')
+    if exit_code != 0 or out is None:
       return None
-    return out.rstrip()
+    return dict(_GETPROP_RE.findall(out))
 
-  def Dumpsys(self, arg):
+  def Dumpsys(self, arg, sink=None, max_size=None):
     """dumpsys is a native android tool that returns inconsistent semi
     structured data.
 
     It acts as a directory service but each service return their data without
     any real format, and will happily return failure.
+
+    sink and max_size are as in Shell(), for services with a large output.
     """
-    out, exit_code = self.Shell('dumpsys ' + arg)
+    if arg in _MEMOIZED_DUMPSYS and sink is None and max_size is None:
+      return self._Memoize('Dumpsys', (arg,), None, lambda: self._Dumpsys(arg))
+    return self._Dumpsys(arg, sink, max_size)
+
+  def _Dumpsys(self, arg, sink=None, max_size=None):
+    out, exit_code = self.Shell('dumpsys ' + arg, sink=sink, max_size=max_size)
     if exit_code != 0 or out.startswith('Can\'t find service: '):
       return None
     return out
 
+  def _GetBootId(self):
+    """Returns the device's boot id, re-read at most every few seconds."""
+    return _ReadBootId(self)
+
+  def _Memoize(self, name, args, ttl, fn):
+    """Returns the memoized result of fn() for the device's current boot.
+
+    Arguments:
+    - name, args: identify the query.
+    - ttl: duration in seconds the result is valid, None to keep it until the
+          next boot.
+    - fn: callable doing the query. None results are not memoized.
+    """
+    boot_id = self._GetBootId()
+    if not boot_id:
+      return fn()
+    key = (self.serial, boot_id, name, args)
+    found, value = _BOOT_CACHE.get(key)
+    if not found:
+      value = fn()
+      if value is not None:
+        _BOOT_CACHE.set(key, value, ttl)
+    return value
+
   @classmethod
   def _Connect(cls, constructor, **kwargs):
     """Called by either ConnectDevice or Connect."""
@@ -280,8 +280,18 @@ class FastbootCommands(object):
       Response to a download request, normally nothing.
     """
     if isinstance(source_file, basestring):
-      source_len = os.stat(source_file).st_size
-      source_file = open(source_file)
+      if common.MappedFile.CanMap(source_file):
+        # Map the file so the data goes straight from the page cache to the USB
+        # device.
+        with common.MappedFile(source_file) as mapped:
+          return self.Download(
+              mapped, source_len=len(mapped), info_cb=info_cb,
+              progress_callback=progress_callback)
+      # FIFOs and the like are read in memory below.
+      with open(source_file, 'rb') as f:
+        return self.Download(
+            f, source_len=source_len, info_cb=info_cb,
+            progress_callback=progress_callback)
 
     if source_len == 0:
       # Fall back to storing it all in memory :(
@@ -18,6 +18,8 @@ host side.
 """
 
 import collections
+import os
+import socket
 import stat
 import struct
 import time
@@ -87,7 +89,7 @@ class FilesyncProtocol(object):
 
   @classmethod
   def Push(cls, connection, datafile, filename,
-           st_mode=DEFAULT_PUSH_MODE, mtime=0):
+           st_mode=DEFAULT_PUSH_MODE, mtime=0, send_file=False):
     """Push a file-like object to the device.
 
     Args:
@@ -96,6 +98,8 @@ class FilesyncProtocol(object):
       filename: Filename to push to
       st_mode: stat mode for filename
       mtime: modification time
+      send_file: if True, datafile is a regular file whose content can be sent
+          from its file descriptor when the connection supports it.
 
     Raises:
       PushFailedError: Raised on push failure.
@@ -108,11 +112,14 @@ class FilesyncProtocol(object):
     cnxn = FileSyncConnection(connection, '<2I')
     cnxn.Send('SEND', fileinfo)
 
-    while True:
-      data = datafile.read(cls.SYNC_DATA_MAX)
-      if not data:
-        break
-      cnxn.Send('DATA', data)
+    if send_file and getattr(connection, 'can_write_file', False):
+      cnxn.SendFile(datafile, cls.SYNC_DATA_MAX)
+    else:
+      while True:
+        data = datafile.read(cls.SYNC_DATA_MAX)
+        if not data:
+          break
+        cnxn.Send('DATA', data)
 
     if mtime == 0:
       mtime = int(time.time())
@@ -143,7 +150,7 @@ class FileSyncConnection(object):
     self.adb = adb_connection
 
     # Sending
-    self.send_buffer = ''
+    self.send_buffer = bytearray()
     self.send_header_len = struct.calcsize('<2I')
 
     # Receiving
@@ -154,18 +161,50 @@ class FileSyncConnection(object):
   def Send(self, command_id, data='', size=0):
     """Send/buffer FileSync packets.
 
-    Packets are buffered and only flushed when this connection is read from. All
-    messages have a response from the device, so this will always get flushed.
+    Packets are buffered and only flushed when this connection is read from or
+    when there's enough data buffered to fill an ADB packet. All messages have a
+    response from the device, so this will always get flushed.
 
     Args:
       command_id: Command to send.
-      data: Optional data to send, must set data or size.
+      data: Optional data to send, must set data or size. Can be a str or any
+          object supporting the buffer interface.
       size: Optionally override size from len(data).
     """
     if data:
       size = len(data)
-    header = struct.pack('<2I', adb_protocol.ID2Wire(command_id), size)
-    self.send_buffer += header + data
+    self.send_buffer += struct.pack(
+        '<2I', adb_protocol.ID2Wire(command_id), size)
+    self.send_buffer += data
+    if len(self.send_buffer) >= self.adb.max_packet_size:
+      self._Flush(full_packets_only=True)
+
+  def SendFile(self, datafile, chunk_size):
+    """Sends the rest of a file as DATA packets, one per ADB packet.
+
+    The file content is sent directly from its file descriptor, without going
+    through Python.
+
+    Args:
+      datafile: file object with a fileno().
+      chunk_size: maximum size of a DATA packet.
+    """
+    self._Flush()
+    fd = datafile.fileno()
+    offset = datafile.tell()
+    end = os.fstat(fd).st_size
+    chunk_size = min(
+        chunk_size, self.adb.max_packet_size - self.send_header_len)
+    while offset < end:
+      size = min(chunk_size, end - offset)
+      header = struct.pack('<2I', adb_protocol.ID2Wire('DATA'), size)
+      try:
+        self.adb.WriteFile(header, fd, offset, size)
+      except (libusb1.USBError, socket.error, OSError) as e:
+        raise usb_exceptions.WriteFailedError(
+            'Could not write %d bytes at %d' % (size, offset), e)
+      offset += size
+    datafile.seek(end)
 
   def Read(self, expected_ids):
     """Read ADB messages and return FileSync packets."""
@@ -202,15 +241,20 @@ class FileSyncConnection(object):
       if cmd_id in finish_ids:
         break
 
-  def _Flush(self):
-    while self.send_buffer:
-      chunk = self.send_buffer[:self.adb.max_packet_size]
+  def _Flush(self, full_packets_only=False):
+    max_size = self.adb.max_packet_size
+    buf = self.send_buffer
+    end = len(buf)
+    if full_packets_only:
+      end -= end % max_size
+    self.send_buffer = buf[end:]
+    for i in xrange(0, end, max_size):
+      chunk = buf[i:i + max_size]
       try:
         self.adb.Write(chunk)
       except libusb1.USBError as e:
-        self.send_buffer = ''
+        self.send_buffer = bytearray()
         raise usb_exceptions.WriteFailedError('Could not write %r' % chunk, e)
-      self.send_buffer = self.send_buffer[self.adb.max_packet_size:]
 
   def _ReadBuffered(self, size):
     # Ensure recv buffer has enough data.
@@ -47,7 +47,8 @@ class LibusbWrappingError(CommonUsbError):
   """Wraps libusb1 errors while keeping its original usefulness.
 
   Attributes:
-    usb_error: Instance of libusb1.USBError
+    usb_error: Instance of libusb1.USBError, the socket.error for TCP handles,
+        or None when the handle returned no data without an error.
   """
 
   def __init__(self, msg, usb_error):
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for adb.contrib.adb_commands_safe."""
+
+import cStringIO
+import hashlib
+import os
+import shlex
+import shutil
+import tempfile
+import unittest
+
+from adb import adb_protocol
+from adb import common
+from adb import usb_exceptions
+from adb.contrib import adb_commands_safe
+
+
+MB = 1024*1024
+
+
+class FakeConn(object):
+  max_packet_size = 4096
+
+
+class FakeSession(object):
+  """Mimics adb_commands.ShellSession."""
+
+  def __init__(self, outputs):
+    self._outputs = outputs
+    self.closed = False
+    # If set, the device closed the session.
+    self.dead = False
+    # Exception raised once the command was sent.
+    self.fail_after_send = None
+    self.sent = False
+    self.runs = []
+
+  def Run(self, command):
+    self.sent = False
+    if self.dead:
+      raise usb_exceptions.AdbCommandFailureException('closed')
+    self.sent = True
+    self.runs.append(command)
+    if self.fail_after_send:
+      raise self.fail_after_send
+    return self._outputs[command], 0
+
+  def Close(self):
+    self.closed = True
+
+
+class FakeAdbCommands(object):
+  """Implements the AdbCommands calls used by AdbCommandsSafe on top of an in
+  memory file system.
+  """
+
+  def __init__(self, features=()):
+    self.features = frozenset(features)
+    self.conn = FakeConn()
+    # Keys are the file paths on the device, values are their content.
+    self.files = {}
+    # Number of calls before the push or pull that is interrupted midway.
+    self.fail_push = None
+    self.fail_pull = None
+    self.shell_cmds = []
+    # Output of the commands run by Shell() other than dd and rm.
+    self.shell_outputs = {}
+    # Output of the commands run in sessions, None if exec: is not supported.
+    self.session_outputs = {}
+    self.sessions = []
+    self.session_opens = 0
+    self.abb_calls = []
+    self.exec_cmds = []
+    # (cmd, stdin) of the StreamingShellV2() calls.
+    self.v2_calls = []
+    # Number of calls before the shell v2 command that is interrupted.
+    self.fail_v2 = None
+
+  def Close(self):
+    pass
+
+  def Stat(self, path):
+    if path not in self.files:
+      return 0, 0, 0
+    return 0100644, len(self.files[path]), 0
+
+  def Push(self, source_file, device_filename, mtime='0'):
+    # pylint: disable=unused-argument
+    fail = self.fail_push == 0
+    if self.fail_push is not None:
+      self.fail_push -= 1
+    data = []
+    while True:
+      chunk = source_file.read(64*1024)
+      if not chunk:
+        break
+      # MappedFile returns ctypes views.
+      data.append(buffer(chunk)[:])
+      if fail and len(data) == 4:
+        raise usb_exceptions.WriteFailedError(
+            'Injected write failure', common.usb1.USBErrorTimeout())
+    self.files[device_filename] = ''.join(data)
+
+  def Pull(self, device_filename, dest_file=None):
+    fail = self.fail_pull == 0
+    if self.fail_pull is not None:
+      self.fail_pull -= 1
+    data = self.files[device_filename]
+    if fail:
+      dest_file.write(data[:len(data)/2])
+      raise usb_exceptions.ReadFailedError(
+          'Injected read failure', common.usb1.USBErrorTimeout())
+    dest_file.write(data)
+
+  def AbbExec(self, args):
+    self.abb_calls.append(args)
+    return 'abb:%s\n' % ' '.join(args)
+
+  def ExecOut(self, cmd, dest=None):
+    assert dest is None
+    self.exec_cmds.append(cmd)
+    return 'exec:%s\n' % cmd
+
+  def StreamingShellV2(self, cmd, stdin=None):
+    fail = self.fail_v2 == 0
+    if self.fail_v2 is not None:
+      self.fail_v2 -= 1
+    self.v2_calls.append((cmd, stdin))
+    yield adb_protocol.ShellV2Protocol.ID_STDOUT, 'out\n'
+    if fail:
+      raise usb_exceptions.ReadFailedError(
+          'Injected read failure', common.usb1.USBErrorTimeout())
+    yield adb_protocol.ShellV2Protocol.ID_STDERR, 'err\n'
+    yield adb_protocol.ShellV2Protocol.ID_STDOUT, 'done\n'
+    yield adb_protocol.ShellV2Protocol.ID_EXIT, 3
+
+  def OpenShellSession(self):
+    self.session_opens += 1
+    if self.session_outputs is None:
+      raise usb_exceptions.AdbCommandFailureException('exec: is not supported')
+    self.sessions.append(FakeSession(self.session_outputs))
+    return self.sessions[-1]
+
+  def Shell(self, cmd, sink=None):
+    suffix = adb_commands_safe.AdbCommandsSafe._SHELL_SUFFIX
+    assert cmd.endswith(suffix), cmd
+    cmd = cmd[:-len(suffix)]
+    self.shell_cmds.append(cmd)
+    if cmd in self.shell_outputs:
+      out = self.shell_outputs[cmd] + '\n0\n'
+    else:
+      exit_code = 0
+      stdout = []
+      for args in ' '.join(shlex.split(cmd)).split(' && '):
+        exit_code = self._Run(args.split(), stdout)
+        if exit_code:
+          break
+      out = ''.join(stdout) + '\n%d\n' % exit_code
+    if sink is None:
+      return out
+    # Like adbd, send it in small packets.
+    for i in xrange(0, len(out), 7):
+      sink(out[i:i+7])
+    return None
+
+  def _Run(self, args, stdout):
+    if '|' in args:
+      # Only 'dd ... | sha1sum' is supported.
+      assert args[-2:] == ['|', 'sha1sum'], args
+      data = []
+      exit_code = self._Run(args[:-2], data)
+      if not exit_code:
+        stdout.append(hashlib.sha1(''.join(data)).hexdigest() + '  -\n')
+      return exit_code
+    if args[0] == 'rm':
+      for path in args[1:]:
+        if path != '-f':
+          self.files.pop(path, None)
+      return 0
+    assert args[0] == 'dd', args
+    opts = dict(a.split('=', 1) for a in args[1:] if '=' in a)
+    if opts['if'] not in self.files:
+      return 1
+    bs = int(opts['bs'])
+    data = self.files[opts['if']]
+    skip = int(opts.get('skip', 0)) * bs
+    data = data[skip:]
+    if 'count' in opts:
+      data = data[:int(opts['count']) * bs]
+    if 'of' not in opts:
+      stdout.append(data)
+      return 0
+    seek = int(opts.get('seek', 0)) * bs
+    dst = self.files.get(opts['of'], '').ljust(seek, '\0')
+    tail = dst[seek+len(data):] if opts.get('conv') == 'notrunc' else ''
+    self.files[opts['of']] = dst[:seek] + data + tail
+    return 0
+
+
+class AdbCommandsSafeTest(unittest.TestCase):
+
+  def setUp(self):
+    super(AdbCommandsSafeTest, self).setUp()
+    self.tmp = tempfile.mkdtemp(prefix='adb_commands_safe_test')
+    self.cmd = FakeAdbCommands()
+    self.errors = []
+    self.safe = adb_commands_safe.AdbCommandsSafe(
+        handle=None, banner='test', rsa_keys=[], on_error=self.errors.append,
+        port_path=(1, 2))
+    # pylint: disable=protected-access
+    self.safe._adb_cmd = self.cmd
+    self.safe._sleep = 0
+    self.safe._Reconnect = self._Reconnect
+
+  def tearDown(self):
+    try:
+      shutil.rmtree(self.tmp)
+    finally:
+      super(AdbCommandsSafeTest, self).tearDown()
+
+  def _Reconnect(self, use_serial, timeout=None):
+    # pylint: disable=unused-argument
+    self.safe._adb_cmd = self.cmd
+    return True
+
+  @staticmethod
+  def _Content(size):
+    # Not periodic, so a segment written at the wrong offset is caught.
+    return ''.join('%07d\n' % i for i in xrange(size / 8))
+
+  def _Push(self, content):
+    path = os.path.join(self.tmp, 'src')
+    with open(path, 'wb') as f:
+      f.write(content)
+    return self.safe.PushResumable(path, '/data/dst', chunk_size=MB)
+
+  def testPushResumable(self):
+    content = self._Content(3*MB + MB/2)
+    self.assertTrue(self._Push(content))
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+    self.assertEqual([], self.errors)
+
+  def testPushResumableResetMidSegment(self):
+    content = self._Content(3*MB + MB/2)
+    # The third segment is interrupted.
+    self.cmd.fail_push = 2
+    self.assertTrue(self._Push(content))
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+    self.assertEqual(1, len(self.errors))
+
+  def testPushResumableResetFirstSegmentOverLargerFile(self):
+    # A stale larger file on the device must not be mistaken for progress.
+    self.cmd.files['/data/dst'] = 'x' * (5*MB)
+    content = self._Content(3*MB + MB/2)
+    self.cmd.fail_push = 0
+    self.assertTrue(self._Push(content))
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+    self.assertEqual(1, len(self.errors))
+
+  def testPushResumablePartName(self):
+    content = self._Content(2*MB)
+    self.assertTrue(self._Push(content))
+    part = [c for c in self.cmd.shell_cmds if c.startswith('dd ')][0]
+    part = part.split()[1][len('if='):]
+    self.assertTrue(part.startswith('/data/dst.'), part)
+    self.assertTrue(part.endswith('.part'), part)
+    # Another source gets its own temporary file.
+    self.cmd.shell_cmds = []
+    path = os.path.join(self.tmp, 'other')
+    with open(path, 'wb') as f:
+      f.write(content)
+    self.assertTrue(
+        self.safe.PushResumable(path, '/data/dst', chunk_size=MB))
+    other = [c for c in self.cmd.shell_cmds if c.startswith('dd ')][0]
+    self.assertNotEqual(part, other.split()[1][len('if='):])
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+
+  def testPushResumableResetPrefixChanged(self):
+    content = self._Content(3*MB + MB/2)
+    self.cmd.fail_push = 2
+    def reconnect(use_serial, timeout=None):
+      # Another push replaced dest meanwhile.
+      self.cmd.files['/data/dst'] = 'x' * (2*MB)
+      return self._Reconnect(use_serial, timeout)
+    self.safe._Reconnect = reconnect
+    self.assertTrue(self._Push(content))
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+    self.assertEqual(1, len(self.errors))
+    # The push started over once the mismatch was found, so the second
+    # segment was written twice.
+    self.assertEqual(1, sum(
+        1 for c in self.cmd.shell_cmds if c.startswith('dd if=/data/dst ')))
+    self.assertEqual(4, sum(
+        1 for c in self.cmd.shell_cmds if ' of=/data/dst ' in c))
+
+  def testPushFileObjectReset(self):
+    content = self._Content(MB)
+    self.cmd.fail_push = 0
+    self.assertTrue(
+        self.safe.Push(cStringIO.StringIO(content), '/data/dst'))
+    # The retry starts from the beginning of the file object.
+    self.assertEqual({'/data/dst': content}, self.cmd.files)
+    self.assertEqual(1, len(self.errors))
+
+  def testPullResumableResetMidSegment(self):
+    content = self._Content(3*MB + MB/2)
+    self.cmd.files['/data/src'] = content
+    self.cmd.fail_pull = 1
+    dest = os.path.join(self.tmp, 'dst')
+    self.assertTrue(
+        self.safe.PullResumable('/data/src', dest, chunk_size=MB))
+    with open(dest, 'rb') as f:
+      self.assertEqual(content, f.read())
+    self.assertEqual({'/data/src': content}, self.cmd.files)
+    self.assertEqual(1, len(self.errors))
+
+  def testPullResumableUniquePart(self):
+    self.cmd.files['/data/src'] = 'hello'
+    dest = os.path.join(self.tmp, 'dst')
+    self.assertTrue(self.safe.PullResumable('/data/src', dest, chunk_size=MB))
+    self.assertTrue(self.safe.PullResumable('/data/src', dest, chunk_size=MB))
+    parts = [c.split()[2] for c in self.cmd.shell_cmds if c.startswith('dd ')]
+    self.assertEqual(2, len(parts))
+    self.assertNotEqual(parts[0], parts[1])
+
+  def testWaitUntilFoundTries(self):
+    # pylint: disable=protected-access
+    finds = []
+    def find(use_serial):
+      finds.append(use_serial)
+      return False
+    arrivals = []
+    def wait_for_arrival(*args, **kwargs):
+      arrivals.append((args, kwargs))
+      return True
+    old_wait = common.USB_REGISTRY.WaitForArrival
+    common.USB_REGISTRY.WaitForArrival = wait_for_arrival
+    old_find = common.UsbHandle.FindDevicesSafe
+    common.UsbHandle.FindDevicesSafe = staticmethod(lambda *_, **_kw: [])
+    try:
+      self.safe._handle = None
+      self.safe._Find = find
+      self.safe._tries = 3
+      # A device flapping elsewhere doesn't make it try forever.
+      self.assertFalse(self.safe._WaitUntilFound(False, timeout=60000))
+      self.assertEqual([False] * 3, finds)
+      self.assertEqual(3, len(arrivals))
+      # A TCP handle doesn't wait on the USB bus.
+      self.safe._is_usb = False
+      self.assertFalse(self.safe._WaitUntilFound(False, timeout=60000))
+      self.assertEqual([False] * 6, finds)
+      self.assertEqual(3, len(arrivals))
+    finally:
+      common.USB_REGISTRY.WaitForArrival = old_wait
+      common.UsbHandle.FindDevicesSafe = old_find
+
+  def testSessionShell(self):
+    self.cmd.session_outputs['ls'] = 'a\n'
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.assertEqual(1, self.cmd.session_opens)
+    self.assertEqual([], self.cmd.shell_cmds)
+
+  def testSessionShellNoExec(self):
+    self.cmd.session_outputs = None
+    self.cmd.shell_outputs['ls'] = 'a\n'
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    # The refusal is remembered.
+    self.assertEqual(1, self.cmd.session_opens)
+    self.assertEqual(['ls', 'ls'], self.cmd.shell_cmds)
+
+  def testSessionShellClosed(self):
+    self.cmd.session_outputs['ls'] = 'a\n'
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.cmd.sessions[0].dead = True
+    # The dead session is closed and the command sent in a new one.
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.assertEqual(2, len(self.cmd.sessions))
+    self.assertTrue(self.cmd.sessions[0].closed)
+    self.assertFalse(self.cmd.sessions[1].closed)
+
+  def testSessionShellClosedAfterSend(self):
+    self.cmd.session_outputs['ls'] = 'a\n'
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.cmd.sessions[0].fail_after_send = (
+        usb_exceptions.AdbCommandFailureException('closed'))
+    # The command may have run, so it is not sent again.
+    self.assertEqual((None, None), self.safe.SessionShell('ls'))
+    self.assertEqual(1, len(self.cmd.sessions))
+    self.assertEqual(['ls', 'ls'], self.cmd.sessions[0].runs)
+    self.assertTrue(self.cmd.sessions[0].closed)
+
+  def testSessionShellReadFailureAfterSend(self):
+    self.cmd.session_outputs['ls'] = 'a\n'
+    self.assertEqual((u'a\n', 0), self.safe.SessionShell('ls'))
+    self.cmd.sessions[0].fail_after_send = usb_exceptions.ReadFailedError(
+        'Injected read failure', common.usb1.USBErrorTimeout())
+    self.assertEqual((None, None), self.safe.SessionShell('ls'))
+    self.assertEqual(['ls', 'ls'], self.cmd.sessions[0].runs)
+
+  def testShellSink(self):
+    content = ''.join('line %d\r\n' % i for i in xrange(20))
+    self.cmd.shell_outputs['cat f'] = content
+    sink = cStringIO.StringIO()
+    self.assertEqual((u'', 0), self.safe.Shell('cat f', sink=sink))
+    # The exit code is not forwarded and CRLF are converted, even when split
+    # across packets.
+    self.assertEqual(content.replace('\r\n', '\n'), sink.getvalue())
+
+  def testShellMaxSize(self):
+    self.cmd.shell_outputs['cat f'] = 'a' * 100
+    self.assertEqual((u'a' * 10, 0), self.safe.Shell('cat f', max_size=10))
+    self.cmd.shell_outputs['cat f'] = 'abc'
+    self.assertEqual((u'abc', 0), self.safe.Shell('cat f', max_size=10))
+
+  def testShellSinkV2(self):
+    self.cmd.features = frozenset(['shell_v2'])
+    out = []
+    self.assertEqual((u'', 3), self.safe.Shell('ls', sink=out.append))
+    self.assertEqual(['out\n', 'err\n', 'done\n'], out)
+    self.assertEqual(
+        (u'out\ne', 3), self.safe.Shell('ls', max_size=5))
+
+  def testShellSinkNoRetry(self):
+    self.cmd.features = frozenset(['shell_v2'])
+    self.cmd.fail_v2 = 0
+    out = []
+    # The output already sent can't be taken back.
+    self.assertEqual((None, None), self.safe.Shell('ls', sink=out.append))
+    self.assertEqual(['out\n'], out)
+    self.assertEqual(1, len(self.cmd.v2_calls))
+    self.assertEqual(1, len(self.errors))
+
+  def testShellScriptV2(self):
+    self.cmd.features = frozenset(['shell_v2'])
+    self.assertEqual(
+        (u'out\nerr\ndone\n', 3), self.safe.ShellScript(u'echo hi\nexit 3'))
+    self.assertEqual([('sh', 'echo hi\nexit 3')], self.cmd.v2_calls)
+    self.assertEqual(0, self.cmd.session_opens)
+    self.assertEqual([], self.errors)
+
+  def testShellScriptV2Reset(self):
+    self.cmd.features = frozenset(['shell_v2'])
+    self.cmd.fail_v2 = 0
+    # The partial output of the interrupted run is discarded.
+    self.assertEqual(
+        (u'out\nerr\ndone\n', 3), self.safe.ShellScript('echo hi'))
+    self.assertEqual(2, len(self.cmd.v2_calls))
+    self.assertEqual(1, len(self.errors))
+
+  def testShellScriptSession(self):
+    self.cmd.session_outputs['(\necho hi\n)'] = 'hi\n'
+    self.assertEqual((u'hi\n', 0), self.safe.ShellScript('echo hi'))
+    self.assertEqual([], self.cmd.v2_calls)
+    self.assertEqual(1, self.cmd.session_opens)
+
+  def testShellScriptNoMethod(self):
+    self.cmd.session_outputs = None
+    self.cmd.shell_outputs['(\necho a\necho b\n)'] = 'a\nb\n'
+    # A short script is sent as a command line.
+    self.assertEqual(
+        (u'a\nb\n', 0), self.safe.ShellScript('echo a\necho b'))
+    # A long one can't be.
+    self.assertEqual((None, None), self.safe.ShellScript('echo a\n' * 1000))
+    self.assertEqual(['(\necho a\necho b\n)'], self.cmd.shell_cmds)
+
+  def testPackageManagerAbbExec(self):
+    self.cmd.features = frozenset(['abb_exec', 'cmd', 'shell_v2'])
+    self.assertEqual(
+        (u'abb:package list packages\n', None),
+        self.safe.PackageManager(['list', 'packages']))
+    self.assertEqual([['package', 'list', 'packages']], self.cmd.abb_calls)
+
+  def testPackageManagerCmd(self):
+    # shell_v2 alone doesn't mean 'cmd' is available.
+    self.cmd.features = frozenset(['cmd'])
+    self.assertEqual(
+        (u'exec:cmd package list packages\n', None),
+        self.safe.PackageManager(['list', 'packages']))
+    self.assertEqual(['cmd package list packages'], self.cmd.exec_cmds)
+
+  def testPackageManagerPm(self):
+    self.cmd.shell_outputs['pm uninstall \'a b\''] = 'Success\n'
+    self.assertEqual(
+        (u'Success\n', 0), self.safe.PackageManager(['uninstall', 'a b']))
+    self.assertEqual([], self.cmd.exec_cmds)
+    self.assertEqual([], self.cmd.abb_calls)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for adb.adb_server."""
+
+import socket
+import threading
+import time
+import unittest
+
+from adb import adb_commands
+from adb import adb_server
+from adb import usb_exceptions
+
+
+SERIAL = 'emulator-5554'
+BIG = 'x' * (600*1024)
+
+
+class FakeServer(object):
+  """Implements enough of the adb server smart socket protocol for the tests.
+
+  Services are run by a device with the serial SERIAL.
+  """
+
+  def __init__(self):
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(5)
+    self.port = self.sock.getsockname()[1]
+    self.services = []
+    thread = threading.Thread(target=self._Accept)
+    thread.daemon = True
+    thread.start()
+
+  def Close(self):
+    self.sock.close()
+
+  def _Accept(self):
+    while True:
+      try:
+        conn, _ = self.sock.accept()
+      except socket.error:
+        return
+      thread = threading.Thread(target=self._Serve, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+  def _Serve(self, conn):
+    try:
+      request = self._Read(conn)
+      if request == 'host:devices':
+        self._Reply(conn, '%s\tdevice\nother\toffline\n' % SERIAL)
+      elif request == 'host-serial:%s:features' % SERIAL:
+        self._Reply(conn, 'cmd,stat_v2')
+      elif request == 'host:transport:%s' % SERIAL:
+        conn.sendall('OKAY')
+        self._Run(conn, self._Read(conn))
+      else:
+        self._Fail(conn, 'device \'%s\' not found' % request.split(':')[-1])
+    finally:
+      conn.close()
+
+  def _Run(self, conn, service):
+    self.services.append(service)
+    if service == 'shell:echo hi':
+      conn.sendall('OKAY')
+      conn.sendall('hi\n')
+    elif service == 'shell:big':
+      conn.sendall('OKAY')
+      conn.sendall(BIG)
+    elif service == 'exec:echo hi':
+      conn.sendall('OKAY')
+      conn.sendall('hi\n')
+    elif service == 'exec:stall':
+      # Never reads what is sent.
+      conn.sendall('OKAY')
+      time.sleep(5)
+    elif service == 'exec:cat':
+      conn.sendall('OKAY')
+      while True:
+        data = conn.recv(4096)
+        if not data:
+          break
+        conn.sendall(data)
+    else:
+      self._Fail(conn, 'closed')
+
+  @staticmethod
+  def _Read(conn):
+    length = int(conn.recv(4), 16)
+    data = ''
+    while len(data) < length:
+      data += conn.recv(length - len(data))
+    return data
+
+  @staticmethod
+  def _Reply(conn, data):
+    conn.sendall('OKAY%04x%s' % (len(data), data))
+
+  @staticmethod
+  def _Fail(conn, message):
+    conn.sendall('FAIL%04x%s' % (len(message), message))
+
+
+class AdbServerHandleTest(unittest.TestCase):
+
+  def setUp(self):
+    super(AdbServerHandleTest, self).setUp()
+    self.server = FakeServer()
+    self.cmd = None
+
+  def tearDown(self):
+    try:
+      if self.cmd:
+        self.cmd.Close()
+      self.server.Close()
+    finally:
+      super(AdbServerHandleTest, self).tearDown()
+
+  def _Handle(self, serial=SERIAL):
+    return adb_server.AdbServerHandle(
+        serial, timeout_ms=1000, port=self.server.port)
+
+  def _Connect(self):
+    handle = self._Handle()
+    handle.Open()
+    self.cmd = adb_commands.AdbCommands.Connect(
+        handle, banner='test', rsa_keys=[], auth_timeout_ms=100)
+    return self.cmd
+
+  def testFindDevices(self):
+    handles = list(
+        adb_server.AdbServerHandle.FindDevices(port=self.server.port))
+    self.assertEqual([SERIAL], [h.serial_number for h in handles])
+
+  def testNotFound(self):
+    with self.assertRaises(usb_exceptions.DeviceNotFoundError):
+      self._Handle(serial='unknown').Open()
+
+  def testShell(self):
+    cmd = self._Connect()
+    self.assertEqual(frozenset(['cmd', 'stat_v2']), cmd.conn.features)
+    self.assertEqual('hi\n', cmd.Shell('echo hi'))
+    # The flow control splits the output in multiple messages.
+    self.assertEqual(BIG, cmd.Shell('big'))
+    self.assertEqual(['shell:echo hi', 'shell:big'], self.server.services)
+
+  def testStream(self):
+    cmd = self._Connect()
+    conn = cmd.conn.Open('exec:cat')
+    conn.Write('hello')
+    self.assertEqual('hello', conn.ReadUntil('WRTE')[1])
+    conn.Close()
+
+  def testStalledStream(self):
+    cmd = self._Connect()
+    conn = cmd.conn.Open('exec:stall')
+    # More than what the socket buffers hold.
+    for _ in xrange(128):
+      conn.Write('x' * (64*1024))
+    start = time.time()
+    # The other streams are not blocked.
+    self.assertEqual('hi\n', cmd.Shell('echo hi'))
+    self.assertLess(time.time() - start, 0.5)
+    # The stalled stream is closed after the handle's timeout.
+    self.assertEqual([], list(conn))
+    self.assertLess(time.time() - start, 3)
+
+  def testServiceFailure(self):
+    cmd = self._Connect()
+    self.assertEqual('', cmd.Shell('unknown'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,7 +16,9 @@
 
 import cStringIO
 import logging
+import os
 import struct
+import tempfile
 import unittest
 import sys
 
@@ -26,6 +28,7 @@ import common_mock
 
 from adb import adb_commands
 from adb import adb_protocol
+from adb import usb_exceptions
 
 
 BANNER = 'blazetest'
@@ -53,6 +56,16 @@ def _MakeWriteSyncPacket(command, data='', size=None):
   return _MakeSyncHeader(command, size or len(data)) + data
 
 
+class FakeRsaKey(object):
+
+  def Sign(self, data):
+    # pylint: disable=unused-argument
+    return 'signature'
+
+  def GetPublicKey(self):
+    return 'key'
+
+
 class BaseAdbTest(unittest.TestCase):
 
   def setUp(self):
@@ -71,6 +84,14 @@ class BaseAdbTest(unittest.TestCase):
     if command == 'WRTE':
       self._ExpectRead('OKAY', REMOTE_ID, LOCAL_ID)
 
+  def _ExpectWrites(self, *packets):
+    """WRTE packets are sent back to back, the device acknowledges them later."""
+    for packet in packets:
+      self.usb.ExpectWrite(_MakeHeader('WRTE', LOCAL_ID, REMOTE_ID, packet))
+      self.usb.ExpectWrite(packet)
+    for _ in packets:
+      self._ExpectRead('OKAY', REMOTE_ID, LOCAL_ID)
+
   def _ExpectRead(self, command, arg0, arg1, data=''):
     self.usb.ExpectRead(_MakeHeader(command, arg0, arg1, data))
     if data:
@@ -134,6 +155,248 @@ class AdbTest(BaseAdbTest):
     self.assertEqual(''.join(responses), actual)
     cmd.Close()
 
+  def testExecOut(self):
+    command = 'screencap -p'
+    responses = ['\x89PNG\r\n', '\x1a\n\x00']
+    self._ExpectCommand('exec', command, *responses)
+
+    cmd = self._Connect()
+    self.assertEqual(''.join(responses), cmd.ExecOut(command))
+    cmd.Close()
+
+  def testShellSink(self):
+    command = 'dumpsys'
+    self._ExpectConnection()
+    self._ExpectOpen('shell:%s\0' % command)
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, '0123')
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, '4567')
+    # The rest of the stream is cancelled.
+    self._ExpectWrite('CLSE', LOCAL_ID, REMOTE_ID, '')
+
+    cmd = self._Connect()
+    out = []
+    self.assertEqual(None, cmd.Shell(command, sink=out.append, max_size=6))
+    self.assertEqual(['0123', '45'], out)
+    cmd.Close()
+
+  def testShellMaxSize(self):
+    command = 'dumpsys'
+    self._ExpectConnection()
+    self._ExpectOpen('shell:%s\0' % command)
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, '0123')
+    # The rest of the stream is cancelled once the cap is reached.
+    self._ExpectWrite('CLSE', LOCAL_ID, REMOTE_ID, '')
+
+    cmd = self._Connect()
+    self.assertEqual('01', cmd.Shell(command, max_size=2))
+    cmd.Close()
+
+  def testCancelReconnect(self):
+    self._ExpectConnection()
+    self._ExpectOpen('shell:logcat\0')
+    self._ExpectWrite('CLSE', LOCAL_ID, REMOTE_ID, '')
+    self._ExpectConnection()
+
+    cmd = self._Connect()
+    with cmd.StreamingShell('logcat'):
+      pass
+    self.assertEqual(set([LOCAL_ID]), cmd.conn._cancelled)
+    # The device never sends the CLSE for the cancelled stream.
+    cmd.conn._Connect()
+    self.assertEqual(set(), cmd.conn._cancelled)
+    cmd.Close()
+
+  def testCancel(self):
+    self._ExpectConnection()
+    self._ExpectOpen('shell:logcat\0')
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, 'line1')
+    self._ExpectWrite('CLSE', LOCAL_ID, REMOTE_ID, '')
+    # In-flight packets for the cancelled stream are dropped without an OKAY.
+    self._ExpectWrite('OPEN', LOCAL_ID + 1, 0, 'shell:id\0')
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID, LOCAL_ID, 'line2'))
+    self.usb.ExpectRead('line2')
+    self._ExpectRead('CLSE', REMOTE_ID, LOCAL_ID)
+    self._ExpectRead('OKAY', REMOTE_ID + 1, LOCAL_ID + 1)
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID + 1, LOCAL_ID + 1, 'uid'))
+    self.usb.ExpectRead('uid')
+    self.usb.ExpectWrite(_MakeHeader('OKAY', LOCAL_ID + 1, REMOTE_ID + 1, ''))
+    self.usb.ExpectWrite('')
+    self._ExpectRead('CLSE', REMOTE_ID + 1, LOCAL_ID + 1)
+
+    cmd = self._Connect()
+    with cmd.StreamingShell('logcat') as stream:
+      self.assertEqual('line1', stream.next())
+    self.assertEqual('uid', cmd.Shell('id'))
+    cmd.Close()
+
+  def testCombinedWrites(self):
+    self.usb.supports_combined_writes = True
+    banner = 'host::%s\0' % BANNER
+    self.usb.ExpectWrite(
+        _MakeHeader('CNXN', 0x01000000, 256*1024, banner) + banner)
+    self._ExpectRead('CNXN', 0x01000000, 4096, 'device::\0')
+    self.usb.ExpectWrite(
+        _MakeHeader('OPEN', LOCAL_ID, 0, 'exec:cat\0') + 'exec:cat\0')
+    self._ExpectRead('OKAY', REMOTE_ID, LOCAL_ID)
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID, LOCAL_ID, 'hi'))
+    self.usb.ExpectRead('hi')
+    # The OKAY is sent along the next message.
+    self.usb.ExpectWrite(
+        _MakeHeader('OKAY', LOCAL_ID, REMOTE_ID, '') +
+        _MakeHeader('WRTE', LOCAL_ID, REMOTE_ID, 'yo') + 'yo')
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID, LOCAL_ID, '!'))
+    self.usb.ExpectRead('!')
+    # Or before the next read.
+    self.usb.ExpectWrite(_MakeHeader('OKAY', LOCAL_ID, REMOTE_ID, ''))
+    self._ExpectRead('CLSE', REMOTE_ID, LOCAL_ID)
+
+    cmd = self._Connect()
+    connection = cmd.conn.Open('exec:cat')
+    chunks = iter(connection)
+    self.assertEqual('hi', chunks.next())
+    connection.Write('yo')
+    self.assertEqual(['!'], list(chunks))
+    cmd.Close()
+
+  def testCombinedWriteFailure(self):
+    self.usb.supports_combined_writes = True
+    banner = 'host::%s\0' % BANNER
+    self.usb.ExpectWrite(
+        _MakeHeader('CNXN', 0x01000000, 256*1024, banner) + banner)
+    self._ExpectRead('CNXN', 0x01000000, 4096, 'device::\0')
+    for i, service in enumerate(('exec:cat\0', 'exec:sh\0')):
+      self.usb.ExpectWrite(
+          _MakeHeader('OPEN', LOCAL_ID + i, 0, service) + service)
+      self._ExpectRead('OKAY', REMOTE_ID + i, LOCAL_ID + i)
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID, LOCAL_ID, 'hi'))
+    self.usb.ExpectRead('hi')
+
+    cmd = self._Connect()
+    cat = cmd.conn.Open('exec:cat')
+    sh = cmd.conn.Open('exec:sh')
+    chunks = iter(cat)
+    self.assertEqual('hi', chunks.next())
+    error = usb_exceptions.WriteFailedError('Injected', None)
+    def bulk_write(*_):
+      raise error
+    self.usb.BulkWrite = bulk_write
+    # The write carrying the OKAY for cat fails; both streams are told.
+    with self.assertRaises(usb_exceptions.WriteFailedError):
+      sh.Write('ls')
+    with self.assertRaises(usb_exceptions.WriteFailedError) as e:
+      chunks.next()
+    self.assertIs(error, e.exception)
+
+  def testCombinedFlushFailure(self):
+    self.usb.supports_combined_writes = True
+    banner = 'host::%s\0' % BANNER
+    self.usb.ExpectWrite(
+        _MakeHeader('CNXN', 0x01000000, 256*1024, banner) + banner)
+    self._ExpectRead('CNXN', 0x01000000, 4096, 'device::\0')
+    self.usb.ExpectWrite(
+        _MakeHeader('OPEN', LOCAL_ID, 0, 'exec:cat\0') + 'exec:cat\0')
+    self._ExpectRead('OKAY', REMOTE_ID, LOCAL_ID)
+    self.usb.ExpectRead(_MakeHeader('WRTE', REMOTE_ID, LOCAL_ID, 'hi'))
+    self.usb.ExpectRead('hi')
+
+    cmd = self._Connect()
+    chunks = iter(cmd.conn.Open('exec:cat'))
+    self.assertEqual('hi', chunks.next())
+    def bulk_write(*_):
+      raise usb_exceptions.WriteFailedError('Injected', None)
+    self.usb.BulkWrite = bulk_write
+    # The OKAY sent before the next read is lost, the stream can't progress.
+    with self.assertRaises(usb_exceptions.WriteFailedError):
+      chunks.next()
+
+  def testAbbExec(self):
+    response = 'package:com.example\n'
+    self._ExpectCommand('abb_exec', 'package\0list\0packages', response)
+
+    cmd = self._Connect()
+    self.assertEqual(response, cmd.AbbExec(['package', 'list', 'packages']))
+    cmd.Close()
+
+  def testStreamingShellLines(self):
+    command = 'cat lines'
+    # CRLF split across packets and a multibyte character split in two.
+    responses = ['one\r', '\ntw\xc3', '\xa9\r\n\r\nlast']
+    self._ExpectCommand('shell', command, *responses)
+
+    cmd = self._Connect()
+    self.assertEqual(
+        [u'one', u'tw\xe9', u'', u'last'],
+        list(cmd.StreamingShellLines(command)))
+    cmd.Close()
+
+  def testIterLinesRaw(self):
+    self.assertEqual(
+        ['a', '\xc3\xa9', 'b'],
+        list(adb_commands.IterLines(['a\n\xc3', '\xa9\r\nb'], decode=False)))
+
+  def testShellSession(self):
+    self._ExpectConnection()
+    self._ExpectOpen('exec:sh\0')
+    self._ExpectWrite(
+        'WRTE', LOCAL_ID, REMOTE_ID,
+        "{ eval ls\n} </dev/null 2>&1; printf '\\nadb-m %d\\n' $?\n")
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, 'a\nb\n\nadb')
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, '-m 2\n')
+    # The command is quoted so an unbalanced quote doesn't hang the shell.
+    self._ExpectWrite(
+        'WRTE', LOCAL_ID, REMOTE_ID,
+        "{ eval 'echo '\"'\"'a'\n} </dev/null 2>&1; "
+        "printf '\\nadb-n %d\\n' $?\n")
+    self._ExpectRead(
+        'WRTE', REMOTE_ID, LOCAL_ID, 'sh: unmatched \'\n\nadb-n 1\n')
+
+    cmd = self._Connect()
+    session = cmd.OpenShellSession()
+    self.assertEqual(('a\nb\n', 2), session.Run('ls', marker='adb-m'))
+    self.assertEqual(
+        ('sh: unmatched \'\n', 1), session.Run('echo \'a', marker='adb-n'))
+
+  def testShellSessionClosed(self):
+    self._ExpectConnection()
+    self._ExpectOpen('exec:sh\0')
+    self._ExpectWrite(
+        'WRTE', LOCAL_ID, REMOTE_ID,
+        "{ eval ls\n} </dev/null 2>&1; printf '\\nadb-m %d\\n' $?\n")
+    self._ExpectClose()
+    cmd = self._Connect()
+    session = cmd.OpenShellSession()
+    with self.assertRaises(usb_exceptions.AdbCommandFailureException):
+      session.Run('ls', marker='adb-m')
+    self.assertTrue(session.sent)
+    # The closed stream is known, so the next command isn't sent.
+    with self.assertRaises(usb_exceptions.AdbCommandFailureException):
+      session.Run('ls', marker='adb-m')
+    self.assertFalse(session.sent)
+
+  def testShellSessionNotSupported(self):
+    self._ExpectConnection()
+    self._ExpectWrite('OPEN', LOCAL_ID, 0, 'exec:sh\0')
+    self._ExpectRead('CLSE', 0, LOCAL_ID)
+    cmd = self._Connect()
+    with self.assertRaises(usb_exceptions.AdbCommandFailureException):
+      cmd.OpenShellSession()
+
+  def testAuthNoReply(self):
+    self._ExpectWrite('CNXN', 0x01000000, 256*1024, 'host::%s\0' % BANNER)
+    token = 'x' * 20
+    self._ExpectRead(
+        'AUTH', adb_protocol._AdbMessageHeader.AUTH_TOKEN, 0, token)
+    self._ExpectWrite(
+        'AUTH', adb_protocol._AdbMessageHeader.AUTH_SIGNATURE, 0, 'signature')
+    self._ExpectRead(
+        'AUTH', adb_protocol._AdbMessageHeader.AUTH_TOKEN, 0, token)
+    self._ExpectWrite(
+        'AUTH', adb_protocol._AdbMessageHeader.AUTH_RSAPUBLICKEY, 0, 'key\0')
+    # The handle fails without a libusb error; it is propagated as is.
+    with self.assertRaises(usb_exceptions.ReadFailedError):
+      adb_commands.AdbCommands.Connect(
+          self.usb, BANNER, rsa_keys=[FakeRsaKey()], auth_timeout_ms=0)
+
   def testReboot(self):
     self._ExpectCommand('reboot', '', '')
     cmd = self._Connect()
@@ -159,6 +422,36 @@ class AdbTest(BaseAdbTest):
     cmd.Close()
 
 
+class ShellV2AdbTest(BaseAdbTest):
+
+  def _ExpectConnection(self):
+    self._ExpectWrite('CNXN', 0x01000000, 256*1024, 'host::%s\0' % BANNER)
+    self._ExpectRead(
+        'CNXN', 0x01000000, 4096,
+        'device::ro.product.name=foo;features=cmd,shell_v2\0')
+
+  def testFeatures(self):
+    self._ExpectConnection()
+    cmd = self._Connect()
+    self.assertEqual(frozenset(['cmd', 'shell_v2']), cmd.features)
+
+  def testShellV2(self):
+    pack = adb_protocol.ShellV2Protocol.Pack
+    self._ExpectConnection()
+    self._ExpectOpen('shell,v2,raw:cat\0')
+    self._ExpectWrites(pack(0, 'in'), pack(4))
+    # A packet split over two ADB packets and two packets in one ADB packet.
+    stdout = pack(1, 'out\r\n')
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, stdout[:3])
+    self._ExpectRead(
+        'WRTE', REMOTE_ID, LOCAL_ID, stdout[3:] + pack(2, 'err') + pack(1, '!'))
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, pack(3, '\x02'))
+    self._ExpectClose()
+
+    cmd = self._Connect()
+    self.assertEqual(('out\r\n!', 'err', 2), cmd.ShellV2('cat', stdin='in'))
+
+
 class FilesyncAdbTest(BaseAdbTest):
 
   def _ExpectClose(self):
@@ -193,6 +486,100 @@ class FilesyncAdbTest(BaseAdbTest):
     self._ExpectSyncCommand([''.join(send)], [data])
     self._Connect().Push(cStringIO.StringIO(filedata), '/data', mtime=mtime)
 
+  def testPushFile(self):
+    # More than a 4096 bytes packet.
+    filedata = 'SOMETHING' * 600
+    mtime = 100
+    stream = ''.join([
+        _MakeWriteSyncPacket('SEND', '/data,33272'),
+        _MakeWriteSyncPacket('DATA', filedata),
+        _MakeWriteSyncPacket('DONE', size=mtime),
+    ])
+    self._ExpectConnection()
+    self._ExpectOpen('sync:\0')
+    # Full packets are sent as soon as they are buffered.
+    self._ExpectWrites(stream[:4096], stream[4096:])
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, 'OKAY\0\0\0\0')
+    self._ExpectClose()
+
+    handle, path = tempfile.mkstemp(prefix='adb_test')
+    try:
+      os.write(handle, filedata)
+      os.close(handle)
+      self._Connect().Push(path, '/data', mtime=mtime)
+    finally:
+      os.remove(path)
+
+  def testPushSendFile(self):
+    filedata = 'SOMETHING' * 600
+    mtime = 100
+    def BulkWriteFile(data, fd, offset, length, timeout_ms=None):
+      os.lseek(fd, offset, os.SEEK_SET)
+      self.usb.BulkWrite(data + os.read(fd, length), timeout_ms)
+    self.usb.supports_sendfile = True
+    self.usb.BulkWriteFile = BulkWriteFile
+
+    skip_checksum = 0x01000001
+    self._ExpectWrite(
+        'CNXN', skip_checksum, 256*1024, 'host::%s\0' % BANNER)
+    self._ExpectRead('CNXN', skip_checksum, 4096, 'device::\0')
+    self._ExpectOpen('sync:\0')
+    send = _MakeWriteSyncPacket('SEND', '/data,33272')
+    self.usb.ExpectWrite(_MakeHeader('WRTE', LOCAL_ID, REMOTE_ID, send))
+    self.usb.ExpectWrite(send)
+    # File data is sent straight from the file, without checksum.
+    command = _ConvertCommand('WRTE')
+    for i in xrange(0, len(filedata), 4088):
+      chunk = _MakeWriteSyncPacket('DATA', filedata[i:i+4088])
+      self.usb.ExpectWrite(
+          struct.pack(
+              '<6I', command, LOCAL_ID, REMOTE_ID, len(chunk), 0,
+              command ^ 0xFFFFFFFF) + chunk)
+    done = _MakeWriteSyncPacket('DONE', size=mtime)
+    self.usb.ExpectWrite(_MakeHeader('WRTE', LOCAL_ID, REMOTE_ID, done))
+    self.usb.ExpectWrite(done)
+    for _ in xrange(4):
+      self._ExpectRead('OKAY', REMOTE_ID, LOCAL_ID)
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, 'OKAY\0\0\0\0')
+    self._ExpectClose()
+
+    handle, path = tempfile.mkstemp(prefix='adb_test')
+    try:
+      os.write(handle, filedata)
+      os.close(handle)
+      self._Connect().Push(path, '/data', mtime=mtime)
+    finally:
+      os.remove(path)
+
+  def testPushPipeSendFile(self):
+    # A pipe has a file descriptor but no size, it must be read.
+    filedata = 'SOMETHING' * 600
+    mtime = 100
+    def BulkWriteFile(data, fd, offset, length, timeout_ms=None):
+      self.fail('Unexpected BulkWriteFile()')
+    self.usb.supports_sendfile = True
+    self.usb.BulkWriteFile = BulkWriteFile
+
+    skip_checksum = 0x01000001
+    self._ExpectWrite(
+        'CNXN', skip_checksum, 256*1024, 'host::%s\0' % BANNER)
+    self._ExpectRead('CNXN', skip_checksum, 4096, 'device::\0')
+    self._ExpectOpen('sync:\0')
+    stream = ''.join([
+        _MakeWriteSyncPacket('SEND', '/data,33272'),
+        _MakeWriteSyncPacket('DATA', filedata),
+        _MakeWriteSyncPacket('DONE', size=mtime),
+    ])
+    self._ExpectWrites(stream[:4096], stream[4096:])
+    self._ExpectRead('WRTE', REMOTE_ID, LOCAL_ID, 'OKAY\0\0\0\0')
+    self._ExpectClose()
+
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, filedata)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+      self._Connect().Push(f, '/data', mtime=mtime)
+
   def testPull(self):
     filedata = "g'ddayta, govnah"
     recv = _MakeWriteSyncPacket('RECV', '/data')
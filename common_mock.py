@@ -50,6 +50,9 @@ class MockUsb(object):
               _Dotify(data)))  # pragma: no cover
 
       expected_data = self._expected_io.pop(0)[1]
+      if not isinstance(data, (str, bytearray)):
+        # Buffer views, like common.MappedFile's.
+        data = str(buffer(data))
       if expected_data != data:
         raise Failure('Mismatch:\n- expected %s\n - got %s' %
             (_Dotify(expected_data), _Dotify(data)))  # pragma: no cover
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# Copyright 2015 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for adb.common."""
+
+import select
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from adb import common
+from adb import usb_exceptions
+
+
+class TcpHandleTest(unittest.TestCase):
+
+  def setUp(self):
+    super(TcpHandleTest, self).setUp()
+    self.server = socket.socket()
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(1)
+    self.peer = None
+    self.handle = None
+
+  def tearDown(self):
+    try:
+      if self.handle:
+        self.handle.Close()
+      if self.peer:
+        self.peer.close()
+      self.server.close()
+    finally:
+      super(TcpHandleTest, self).tearDown()
+
+  def _Connect(self, **kwargs):
+    self.handle = common.TcpHandle(
+        '127.0.0.1:%d' % self.server.getsockname()[1], timeout_ms=1000,
+        **kwargs)
+    self.handle.Open()
+    self.peer, _ = self.server.accept()
+
+  def testOptions(self):
+    self._Connect(rcvbuf=65536)
+    # pylint: disable=protected-access
+    conn = self.handle._connection
+    self.assertTrue(conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+    self.assertTrue(conn.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+  def testFullReads(self):
+    self._Connect()
+    big = 'x' * (common.TcpHandle.READ_BUFFER_SIZE + 10)
+    def send():
+      for chunk in ('ab', 'cdef', 'g', big):
+        self.peer.sendall(chunk)
+    thread = threading.Thread(target=send)
+    thread.start()
+    self.assertEqual('abc', self.handle.BulkRead(3))
+    self.assertEqual('defg', self.handle.BulkRead(4))
+    self.assertEqual(big, self.handle.BulkRead(len(big)))
+    thread.join()
+
+  def testStalledRead(self):
+    self._Connect()
+    big = ''.join(chr(i % 251) for i in xrange(
+        common.TcpHandle.READ_BUFFER_SIZE + 10))
+    self.peer.sendall('ab' + big[:1000])
+    self.assertEqual('ab', self.handle.BulkRead(2))
+    # The peer stalls midway, the partial payload is kept.
+    with self.assertRaises(usb_exceptions.ReadFailedError):
+      self.handle.BulkRead(len(big), timeout_ms=50)
+    thread = threading.Thread(
+        target=self.peer.sendall, args=(big[1000:] + 'cd',))
+    thread.start()
+    self.assertEqual(big, self.handle.BulkRead(len(big)))
+    self.assertEqual('cd', self.handle.BulkRead(2))
+    thread.join()
+
+  def testWrite(self):
+    self._Connect()
+    self.handle.BulkWrite('hello')
+    self.assertEqual('hello', self.peer.recv(5))
+
+  def testWriteFile(self):
+    self._Connect()
+    with tempfile.TemporaryFile() as f:
+      f.write('0123456789')
+      f.flush()
+      self.handle.BulkWriteFile('head', f.fileno(), 2, 5)
+    self.assertEqual('head23456', self.peer.recv(9))
+
+  def testWriteFilePeerClosed(self):
+    self._Connect(sndbuf=65536)
+    self.peer.close()
+    self.peer = None
+    with tempfile.TemporaryFile() as f:
+      f.truncate(16*1024*1024)
+      f.flush()
+      with self.assertRaises(usb_exceptions.WriteFailedError):
+        # The peer resets the connection while the file is being sent.
+        for _ in xrange(4):
+          self.handle.BulkWriteFile('head', f.fileno(), 0, 4*1024*1024)
+
+  def testClosed(self):
+    self._Connect()
+    self.peer.sendall('ab')
+    self.peer.close()
+    self.peer = None
+    with self.assertRaises(usb_exceptions.ReadFailedError):
+      self.handle.BulkRead(3)
+
+  def testTimeout(self):
+    self._Connect()
+    with self.assertRaises(usb_exceptions.ReadFailedError):
+      self.handle.BulkRead(1, timeout_ms=10)
+
+
+class FakeSetting(object):
+
+  def __init__(self, interface):
+    self._interface = interface
+
+  def getClass(self):
+    return self._interface[0]
+
+  def getSubClass(self):
+    return self._interface[1]
+
+  def getProtocol(self):
+    return self._interface[2]
+
+
+class FakeUsbDevice(object):
+
+  def __init__(self, bus, ports, address, interfaces=(), serial='serial'):
+    self._bus = bus
+    self._ports = ports
+    self._address = address
+    self._interfaces = interfaces
+    self._serial = serial
+    self.serial_reads = 0
+
+  def iterSettings(self):
+    return [FakeSetting(i) for i in self._interfaces]
+
+  def getBusNumber(self):
+    return self._bus
+
+  def getPortNumberList(self):
+    return self._ports
+
+  def getDeviceAddress(self):
+    return self._address
+
+  def getSerialNumber(self):
+    self.serial_reads += 1
+    return self._serial
+
+
+class PortPathTest(unittest.TestCase):
+
+  def testPortPath(self):
+    # pylint: disable=protected-access
+    # The address is not part of the port path, it changes on reenumeration.
+    self.assertEqual((1, 2, 3), common._PortPath(FakeUsbDevice(1, [2, 3], 7)))
+    self.assertEqual((1, 2, 3), common._PortPath(FakeUsbDevice(1, [2, 3], 8)))
+    # Root hubs have no port chain.
+    self.assertEqual((1, 1), common._PortPath(FakeUsbDevice(1, [], 1)))
+
+  def testParsePortPath(self):
+    # pylint: disable=protected-access
+    self.assertEqual((1, 2, 3), common.UsbHandle._ParsePortPath('1/2/3'))
+    self.assertEqual((1, 2, 3), common.UsbHandle._ParsePortPath([1, 2, 3]))
+
+
+class UsbRegistryTest(unittest.TestCase):
+
+  ADB = (0xFF, 0x42, 0x01)
+
+  def setUp(self):
+    super(UsbRegistryTest, self).setUp()
+    # pylint: disable=protected-access
+    self.registry = common.UsbRegistry()
+    self.registry._context = object()
+    self.registry._has_hotplug = True
+
+  def _Event(self, device, left=False):
+    # pylint: disable=protected-access
+    event = common.usb1.HOTPLUG_EVENT_DEVICE_ARRIVED
+    if left:
+      event = common.usb1.HOTPLUG_EVENT_DEVICE_LEFT
+    self.registry._OnHotplug(None, device, event)
+
+  def testIndex(self):
+    adb = FakeUsbDevice(1, [2], 5, [(8, 6, 80), self.ADB])
+    other = FakeUsbDevice(1, [3], 6, [(8, 6, 80)])
+    self._Event(adb)
+    self._Event(other)
+    self.assertEqual([adb], self.registry.GetDevices(interface=self.ADB))
+    self.assertEqual([other], self.registry.GetDevices(port_path='1/3'))
+    self.assertEqual([], self.registry.GetDevices(port_path=(1, 4)))
+    self._Event(adb, left=True)
+    self.assertEqual([other], self.registry.GetDevices())
+    self.assertEqual([], self.registry.GetDevices(interface=self.ADB))
+
+  def testSerialOncePerAttach(self):
+    device = FakeUsbDevice(1, [2], 5, serial='abc')
+    self.assertEqual('abc', self.registry.GetSerial(device))
+    self.assertEqual('abc', self.registry.GetSerial(device))
+    self.assertEqual(1, device.serial_reads)
+    # Once the device left, the serial number is read again.
+    self._Event(device, left=True)
+    self.assertEqual('abc', self.registry.GetSerial(device))
+    self.assertEqual(2, device.serial_reads)
+
+  def testSerialReenumerated(self):
+    self.assertEqual(
+        'abc', self.registry.GetSerial(FakeUsbDevice(1, [2], 5, serial='abc')))
+    # Another device at the same port gets a new address.
+    other = FakeUsbDevice(1, [2], 6, serial='def')
+    self.assertEqual('def', self.registry.GetSerial(other))
+    self.assertEqual(1, other.serial_reads)
+
+  def testSerialPrune(self):
+    kept = FakeUsbDevice(1, [2], 5)
+    gone = FakeUsbDevice(1, [3], 6)
+    self.registry.GetSerial(kept)
+    self.registry.GetSerial(gone)
+    # Without hotplug, the enumeration forgets the devices not found.
+    self.registry.Prune([kept])
+    self.registry.GetSerial(kept)
+    self.registry.GetSerial(gone)
+    self.assertEqual(1, kept.serial_reads)
+    self.assertEqual(2, gone.serial_reads)
+
+  def testWaitForArrival(self):
+    generation = self.registry.generation
+    # Neither a departure nor an arrival elsewhere wake up the caller.
+    self._Event(FakeUsbDevice(1, [2], 5), left=True)
+    self._Event(FakeUsbDevice(1, [3], 6))
+    self.assertFalse(
+        self.registry.WaitForArrival(generation, 0.01, port_path='1/2'))
+    self.assertTrue(self.registry.WaitForArrival(generation, 0.01))
+    timer = threading.Timer(0.01, self._Event, (FakeUsbDevice(1, [2], 7),))
+    timer.start()
+    try:
+      self.assertTrue(
+          self.registry.WaitForArrival(generation, 10., port_path=(1, 2)))
+    finally:
+      timer.join()
+
+
+class FakeTransfer(object):
+  """Mimics usb1.USBTransfer; completed by FakeUsbContext.handleEventsTimeout().
+  """
+
+  def __init__(self, context):
+    self._context = context
+    self.submitted = False
+    self.closed = False
+    self.endpoint = None
+    self.callback = None
+    self.buffer = None
+    self.status = None
+    self.actual_length = 0
+
+  def setBulk(self, endpoint, buffer_or_len, callback=None, timeout=0):
+    # pylint: disable=unused-argument
+    self.endpoint = endpoint
+    self.callback = callback
+    if isinstance(buffer_or_len, int):
+      buffer_or_len = bytearray(buffer_or_len)
+    self.buffer = buffer_or_len
+
+  def submit(self):
+    assert not self.submitted and not self.closed
+    self.submitted = True
+    self._context.Submit(self)
+
+  def isSubmitted(self):
+    return self.submitted
+
+  def cancel(self):
+    self._context.Cancel(self)
+
+  def getStatus(self):
+    return self.status
+
+  def getBuffer(self):
+    return self.buffer
+
+  def getActualLength(self):
+    return self.actual_length
+
+  def close(self):
+    assert not self.submitted
+    self.closed = True
+
+
+class FakeUsbContext(object):
+  """Mimics both an usb1.USBContext and an usb1.USBDeviceHandle.
+
+  IN transfers are filled with the packets queued by Send(), in order. OUT
+  transfers complete immediately unless hold_writes is set.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._reads = []
+    self._writes = []
+    self._cancelled = []
+    self._incoming = []
+    self.hold_writes = False
+    self.written = []
+    self.transfers = []
+
+  def getTransfer(self):
+    transfer = FakeTransfer(self)
+    self.transfers.append(transfer)
+    return transfer
+
+  def Send(self, *packets):
+    with self._lock:
+      self._incoming.extend(packets)
+
+  def Submit(self, transfer):
+    with self._lock:
+      if transfer.endpoint & 0x80:
+        self._reads.append(transfer)
+      else:
+        self._writes.append(transfer)
+
+  def Cancel(self, transfer):
+    with self._lock:
+      self._cancelled.append(transfer)
+
+  def setPollFDNotifiers(self, added_cb=None, removed_cb=None):
+    pass
+
+  def getPollFDList(self):
+    return []
+
+  def getNextTimeout(self):
+    return None
+
+  def handleEventsTimeout(self, timeout):
+    done = []
+    with self._lock:
+      for transfer in self._cancelled:
+        if transfer in self._reads:
+          self._reads.remove(transfer)
+        if transfer in self._writes:
+          self._writes.remove(transfer)
+        done.append((transfer, common.libusb1.LIBUSB_TRANSFER_CANCELLED, 0))
+      self._cancelled = []
+      while self._incoming and self._reads:
+        transfer = self._reads.pop(0)
+        data = self._incoming.pop(0)
+        transfer.buffer[:len(data)] = data
+        done.append(
+            (transfer, common.libusb1.LIBUSB_TRANSFER_COMPLETED, len(data)))
+      if not self.hold_writes:
+        for transfer in self._writes:
+          self.written.append(buffer(transfer.buffer)[:])
+          done.append(
+              (transfer, common.libusb1.LIBUSB_TRANSFER_COMPLETED,
+               len(transfer.buffer)))
+        self._writes = []
+    for transfer, status, length in done:
+      transfer.submitted = False
+      transfer.status = status
+      transfer.actual_length = length
+      transfer.callback(transfer)
+    if not done:
+      time.sleep(min(timeout, 0.001))
+
+
+class AsyncTransfersTest(unittest.TestCase):
+
+  def setUp(self):
+    super(AsyncTransfersTest, self).setUp()
+    self.context = FakeUsbContext()
+    self.transfers = None
+
+  def tearDown(self):
+    try:
+      if self.transfers:
+        self.transfers.Stop()
+    finally:
+      super(AsyncTransfersTest, self).tearDown()
+
+  def _Start(self, events_thread=True):
+    # pylint: disable=protected-access
+    self.transfers = common._AsyncTransfers(
+        self.context, self.context, 0x81, 0x01, read_count=2, read_size=16,
+        write_count=2, events_thread=events_thread)
+    return self.transfers
+
+  def testReassembly(self):
+    transfers = self._Start()
+    # More packets than IN transfers, they are resubmitted in order.
+    self.context.Send('abc', 'defg', 'h', 'ijklm')
+    self.assertEqual('abcdefghijklm', transfers.BulkRead(13, 1000))
+
+  def testShortReads(self):
+    transfers = self._Start()
+    self.context.Send('abcdef')
+    self.assertEqual('ab', transfers.BulkRead(2, 1000))
+    self.assertEqual('cdef', transfers.BulkRead(4, 1000))
+    start = time.time()
+    with self.assertRaises(common.usb1.USBErrorTimeout):
+      transfers.BulkRead(1, 20)
+    self.assertLess(time.time() - start, 1.)
+    self.context.Send('g')
+    self.assertEqual('g', transfers.BulkRead(1, 1000))
+
+  def testWriteQueueing(self):
+    transfers = self._Start()
+    self.context.hold_writes = True
+    # str are copied, the calls return before the transfers complete.
+    self.assertEqual(1, transfers.BulkWrite('a', 1000))
+    self.assertEqual(1, transfers.BulkWrite('b', 1000))
+    with self.assertRaises(common.usb1.USBErrorTimeout):
+      transfers.BulkWrite('c', 20)
+    self.assertEqual([], self.context.written)
+    self.context.hold_writes = False
+    self.assertEqual(1, transfers.BulkWrite('c', 1000))
+    # Other buffers are used in place, the call waits for the completion.
+    self.assertEqual(1, transfers.BulkWrite(bytearray('d'), 1000))
+    self.assertEqual(['a', 'b', 'c', 'd'], self.context.written)
+
+  def testPolledThenClosed(self):
+    # pylint: disable=protected-access
+    registry = common.UsbRegistry()
+    registry._context = self.context
+    poller = common.UsbPoller(select.poll(), registry=registry)
+    transfers = self._Start(events_thread=False)
+    self.context.Send('ab')
+    poller.poll(0)
+    self.assertEqual('ab', transfers.BulkRead(2, 1000))
+    # Without hotplug support, the registry starts a thread to take over.
+    poller.Close()
+    self.context.Send('cd')
+    self.assertEqual('cd', transfers.BulkRead(2, 1000))
+
+  def _AssertStopped(self):
+    self.transfers = None
+    self.assertEqual(4, len(self.context.transfers))
+    for transfer in self.context.transfers:
+      self.assertFalse(transfer.submitted)
+      self.assertTrue(transfer.closed)
+
+  def testStop(self):
+    self._Start().Stop()
+    self._AssertStopped()
+
+  def testStopWithoutEventsThread(self):
+    # Stop() handles the events itself to complete the cancellations.
+    self._Start(events_thread=False).Stop()
+    self._AssertStopped()
+
+
+class UsbPollerTest(unittest.TestCase):
+
+  def setUp(self):
+    super(UsbPollerTest, self).setUp()
+    self.registry = common.UsbRegistry()
+    self.poller = common.UsbPoller(select.poll(), registry=self.registry)
+    self.a, self.b = socket.socketpair()
+
+  def tearDown(self):
+    try:
+      self.poller.Close()
+      self.a.close()
+      self.b.close()
+    finally:
+      super(UsbPollerTest, self).tearDown()
+
+  def testPoll(self):
+    self.assertTrue(self.registry.polled)
+    self.poller.register(self.a.fileno(), select.POLLIN)
+    self.assertEqual([], self.poller.poll(0.01))
+    self.b.sendall('x')
+    self.assertEqual([(self.a.fileno(), select.POLLIN)], self.poller.poll(1.))
+    self.a.recv(1)
+    self.assertEqual([], self.poller.poll(0))
+    self.poller.unregister(self.a.fileno())
+
+  def testUsbFds(self):
+    # pylint: disable=protected-access
+    fds = [fd for fd, _ in self.registry.context.getPollFDList()]
+    self.assertEqual(set(fds), self.poller._usb_fds)
+    with self.assertRaises(ValueError):
+      self.poller.register(fds[0], select.POLLIN)
+    self.poller.Close()
+    self.assertFalse(self.registry.polled)
+    self.assertEqual(set(), self.poller._usb_fds)
+    self.poller = common.UsbPoller(select.poll(), registry=self.registry)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -16,8 +16,10 @@
 import cStringIO
 import logging
 import os
+import shutil
 import sys
 import tempfile
+import threading
 import unittest
 
 import common_mock
@@ -132,6 +134,25 @@ class FastbootTest(unittest.TestCase):
     self.assertEqual(len(pieces), len(progresses))
     os.remove(tmp.name)
 
+  def testDownloadFifo(self):
+    # A FIFO has no size, it must be read instead of mapped.
+    raw = 'aoeuidhtnsqjkxbmwpyfgcrl'
+    tmpdir = tempfile.mkdtemp(prefix='fastboot_test')
+    try:
+      path = os.path.join(tmpdir, 'fifo')
+      os.mkfifo(path)
+      def Writer():
+        with open(path, 'wb') as f:
+          f.write(raw)
+      thread = threading.Thread(target=Writer)
+      thread.start()
+      self.ExpectDownload([raw])
+      commands = fastboot.FastbootCommands(self.usb)
+      self.assertEqual('Result', commands.Download(path))
+      thread.join()
+    finally:
+      shutil.rmtree(tmpdir)
+
   def testSimplerCommands(self):
     commands = fastboot.FastbootCommands(self.usb)
 
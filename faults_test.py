@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+
+import adb_server_test
+from adb import adb_protocol
+from adb import adb_server
+from adb import common
+from adb import usb_exceptions
+from adb.contrib import adb_commands_safe
+from adb.contrib import faults
+
+
+class StreamHandle(common.Handle):
+  """Handle reading from a str and recording the writes."""
+
+  def __init__(self, data=''):
+    super(StreamHandle, self).__init__(serial='stream', timeout_ms=100)
+    self.data = data
+    self.written = []
+
+  def Open(self):
+    pass
+
+  def Close(self):
+    pass
+
+  def BulkWrite(self, data, timeout_ms=None):
+    self.written.append(data)
+
+  def BulkRead(self, length, timeout_ms=None):
+    out, self.data = self.data[:length], self.data[length:]
+    return out
+
+
+class FaultyHandleTest(unittest.TestCase):
+
+  def _Outcomes(self, seed):
+    handle = faults.FaultyHandle(
+        StreamHandle('x' * 100), seed=seed, read_error_rate=0.5,
+        write_error_rate=0.5)
+    out = []
+    for _ in xrange(20):
+      try:
+        handle.BulkRead(1)
+        out.append('r')
+      except usb_exceptions.ReadFailedError:
+        out.append('R')
+      try:
+        handle.BulkWrite('a')
+        out.append('w')
+      except usb_exceptions.WriteFailedError:
+        out.append('W')
+    self.assertEqual(
+        out.count('R') + out.count('W'),
+        handle.stats['read_errors'] + handle.stats['write_errors'])
+    return ''.join(out)
+
+  def testSeed(self):
+    first = self._Outcomes(1)
+    self.assertEqual(first, self._Outcomes(1))
+    self.assertNotEqual(first, self._Outcomes(2))
+    self.assertTrue(set('rRwW').issubset(first), first)
+
+  def testShortReads(self):
+    data = ''.join(chr(i) for i in xrange(256))
+    handle = faults.FaultyHandle(
+        StreamHandle(data), seed=0, short_read_rate=1.)
+    out = ''
+    while len(out) < len(data):
+      chunk = handle.BulkRead(64)
+      self.assertTrue(0 < len(chunk) < 64, len(chunk))
+      out += chunk
+    self.assertEqual(data, out)
+    self.assertTrue(handle.stats['short_reads'])
+
+  def testShortReadsAdbMessage(self):
+    packed = (
+        adb_protocol._AdbMessage.Make('WRTE', 1, 2, 'hello world').Packed +
+        adb_protocol._AdbMessage.Make('OKAY', 1, 2, '').Packed)
+    handle = faults.FaultyHandle(
+        StreamHandle(packed), seed=0, short_read_rate=1.)
+    msg = adb_protocol._AdbMessage.Read(handle)
+    self.assertEqual('WRTE', msg.header.command_name)
+    self.assertEqual('hello world', msg.data)
+    msg = adb_protocol._AdbMessage.Read(handle)
+    self.assertEqual('OKAY', msg.header.command_name)
+
+  def testTruncatedAdbMessage(self):
+    packed = adb_protocol._AdbMessage.Make('WRTE', 1, 2, 'hello world').Packed
+    handle = faults.FaultyHandle(
+        StreamHandle(packed[:-3]), seed=0, short_read_rate=1.)
+    with self.assertRaises(usb_exceptions.ReadFailedError) as cm:
+      adb_protocol._AdbMessage.Read(handle)
+    self.assertIsNone(cm.exception.usb_error)
+
+  def testDelay(self):
+    inner = StreamHandle('abcd')
+    handle = faults.FaultyHandle(
+        inner, seed=0, read_latency=faults.Constant(0.001),
+        write_latency=faults.Uniform(0.001, 0.002), bandwidth=1000000)
+    self.assertEqual('abcd', handle.BulkRead(4))
+    handle.BulkWrite('x' * 1000)
+    self.assertEqual(['x' * 1000], inner.written)
+    # 1ms + 4us for the read, 1 to 2ms + 1ms for the write.
+    self.assertTrue(0.003 < handle.stats['delay'] < 0.0041,
+                    handle.stats['delay'])
+
+  def testWrap(self):
+    inner = StreamHandle()
+    handle = faults.FaultyHandle(faults.FaultyHandle(inner), seed=0)
+    self.assertEqual('stream', handle.serial_number)
+    self.assertEqual(100, handle.Timeout(None))
+    self.assertEqual(5, handle.Timeout(5))
+    self.assertFalse(handle.supports_sendfile)
+    self.assertFalse(handle.is_usb)
+    # A new handle found on reconnection is wrapped by both.
+    other = StreamHandle()
+    self.assertIs(handle, handle.Wrap(other))
+    self.assertIs(other, handle._handle._handle)
+
+
+class FaultyAdbCommandsSafeTest(unittest.TestCase):
+
+  def setUp(self):
+    super(FaultyAdbCommandsSafeTest, self).setUp()
+    self.server = adb_server_test.FakeServer()
+    self.handle = faults.FaultyHandle(
+        adb_server.AdbServerHandle(
+            adb_server_test.SERIAL, timeout_ms=1000, port=self.server.port),
+        seed=0)
+    self.errors = []
+    self.device = adb_commands_safe.AdbCommandsSafe.Connect(
+        self.handle, banner='test', rsa_keys=[], on_error=self._OnError)
+
+  def tearDown(self):
+    try:
+      self.device.Close()
+      self.server.Close()
+    finally:
+      super(FaultyAdbCommandsSafeTest, self).tearDown()
+
+  def _OnError(self, msg):
+    self.errors.append(msg)
+    # Let the reconnection go through.
+    # pylint: disable=protected-access
+    self.handle._write_error_rate = 0.
+
+  def testFaultsAfterReset(self):
+    self.assertTrue(self.device.is_valid)
+    for i in xrange(1, 3):
+      # pylint: disable=protected-access
+      self.handle._write_error_rate = 1.
+      self.assertEqual('hi\n', self.device.ExecOut('echo hi'))
+      # The faults are still injected after the reconnection.
+      self.assertEqual(i, self.handle.stats['write_errors'])
+      self.assertEqual(i, len(self.errors))
+
+
+if __name__ == '__main__':
+  unittest.main()
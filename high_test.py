@@ -13,8 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cStringIO
+import hashlib
 import logging
+import os
+import posixpath
+import shlex
 import sys
+import tempfile
 import unittest
 
 
@@ -26,14 +32,97 @@ class MockDevice(object):
     super(MockDevice, self).__init__()
     self._cmds = cmds[:]
     self.port_path = (0, 0)
+    self.serial = 'serial'
+    self.boot_id = None
+    self.is_valid = True
+
+  def PullContent(self, remotefile):
+    if remotefile == '/proc/sys/kernel/random/boot_id':
+      return self.boot_id
+    return None
+
+  def Root(self):
+    return True
 
   def IsShellOk(self, cmd):  # pylint: disable=unused-argument
     return True
 
-  def Shell(self, cmd):
+  def Shell(self, cmd, sink=None, max_size=None):
     data = self._cmds.pop(0)
     assert data[0] == cmd, (data, cmd)
-    return data[1], 0
+    out = data[1][:max_size]
+    if sink is not None:
+      sink.write(out)
+      out = ''
+    return out, 0
+
+  def SessionShell(self, cmd):
+    return self.Shell(cmd)
+
+  def ShellScript(self, script):
+    return self.Shell(script)
+
+  def PackageManager(self, args):
+    data = self._cmds.pop(0)
+    assert data[0] == args, (data, args)
+    return data[1], None
+
+
+class MockFileDevice(MockDevice):
+  """MockDevice that also records the file operations."""
+  def __init__(self, cmds, files=None):
+    super(MockFileDevice, self).__init__(cmds)
+    # Keys is the file path on the device, value is its content.
+    self.files = files or {}
+    # Directories created with mkdir.
+    self.dirs = set()
+    self.stats = []
+
+  def Shell(self, cmd, sink=None, max_size=None):
+    out, exit_code = super(MockFileDevice, self).Shell(cmd, sink, max_size)
+    # Runs the file operations it knows about.
+    for part in cmd.split(' && '):
+      args = shlex.split(part)
+      if args[0] == '[':
+        ok = args[2] in self.files
+      elif args[0] == 'mkdir':
+        self.dirs.add(args[2])
+        ok = True
+      elif args[0] == 'mv':
+        self.files[args[2]] = self.files.pop(args[1])
+        ok = True
+      elif args[0] in ('cp', 'ln'):
+        src, dst = args[-2:]
+        ok = src in self.files and posixpath.dirname(dst) in self.dirs
+        if ok:
+          self.files[dst] = self.files[src]
+      else:
+        continue
+      if not ok:
+        return out, 1
+    return out, exit_code
+
+  def Stat(self, dest):
+    self.stats.append(dest)
+    if dest not in self.files:
+      return None, None, None
+    return 0100644, len(self.files[dest]), 0
+
+  def Push(self, localfile, dest):
+    if isinstance(localfile, basestring):
+      with open(localfile, 'rb') as f:
+        self.files[dest] = f.read()
+    else:
+      self.files[dest] = localfile.read()
+    return True
+
+
+GETPROP = """[init.svc.bootanim]: [stopped]
+[persist.sys.multiline]: [first
+second]
+[ro.product.model]: [Nexus 5]
+[sys.boot_completed]: [1]
+"""
 
 
 RAW_IMEI = """Result: Parcel(
@@ -53,6 +142,274 @@ class TestAndroid(unittest.TestCase):
     self.assertEqual(
         u'355236058685894', high.HighDevice(device, cache).GetIMEI())
 
+  def test_Memoize(self):
+    device = MockDevice(
+        [
+          ('getprop', GETPROP),
+          ('getprop', GETPROP),
+        ])
+    device.boot_id = 'abc\n'
+    cache = high.DeviceCache(None, None, None, None, None)
+    high_device = high.HighDevice(device, cache)
+    high._BOOT_CACHE.invalidate(device.serial)
+    self.assertEqual('Nexus 5', high_device.GetProp('ro.product.model'))
+    self.assertEqual('1', high_device.GetProp('sys.boot_completed'))
+    self.assertEqual('', high_device.GetProp('missing'))
+    self.assertEqual(
+        'first\nsecond', high_device.GetProps()['persist.sys.multiline'])
+    # Root() invalidates the cache.
+    self.assertEqual(True, high_device.Root())
+    self.assertEqual('Nexus 5', high_device.GetProp('ro.product.model'))
+    self.assertEqual([], device._cmds)
+
+  def test_WaitUntilFullyBooted(self):
+    device = MockDevice(
+        [
+          ('getprop init.svc.bootanim', 'running\n'),
+          ('getprop init.svc.bootanim', 'stopped\n'),
+          ('getprop', GETPROP),
+          ('pm path', 'Error: no package specified\n'),
+        ])
+    device.boot_id = 'abc\n'
+    device.Stat = lambda path: (040755, 0, 0)
+    cache = high.DeviceCache(None, '/sdcard', None, None, None)
+    high_device = high.HighDevice(device, cache)
+    high._BOOT_CACHE.invalidate(device.serial)
+    self.assertEqual(True, high_device.WaitUntilFullyBooted())
+    # The snapshot taken once booted is used.
+    self.assertEqual('1', high_device.GetProp('sys.boot_completed'))
+    self.assertEqual([], device._cmds)
+
+  def test_PerDeviceCache(self):
+    device = MockDevice([])
+    per_device = high._PerDeviceCache()
+    high._BOOT_CACHE.invalidate(device.serial)
+    # Without a boot id, the cache would survive a reboot.
+    per_device.set(device, 'cache')
+    self.assertEqual(None, per_device.get(device))
+    device.boot_id = 'abc\n'
+    per_device.set(device, 'cache')
+    self.assertEqual('cache', per_device.get(device))
+    per_device.trim([device])
+    self.assertEqual('cache', per_device.get(device))
+    # Rebooted, e.g. to be reflashed.
+    device.boot_id = 'def\n'
+    high._BOOT_CACHE.invalidate(device.serial)
+    self.assertEqual(None, per_device.get(device))
+    per_device.trim([device])
+    device.boot_id = 'abc\n'
+    high._BOOT_CACHE.invalidate(device.serial)
+    self.assertEqual(None, per_device.get(device))
+
+  def test_PackageManager(self):
+    device = MockDevice(
+        [
+          (['list', 'packages'], 'package:a.b\npackage:c\n'),
+          (['uninstall', 'a.b'], 'Success\n'),
+          (['uninstall', 'c'], 'Failure [DELETE_FAILED_INTERNAL_ERROR]\n'),
+          (['uninstall', 'd'], 'Failure [Success is not an option]\n'),
+        ])
+    cache = high.DeviceCache(None, None, None, None, None)
+    high_device = high.HighDevice(device, cache)
+    self.assertEqual(['a.b', 'c'], high_device.GetPackages())
+    self.assertEqual(True, high_device.UninstallAPK('a.b'))
+    self.assertEqual(False, high_device.UninstallAPK('c'))
+    self.assertEqual(False, high_device.UninstallAPK('d'))
+
+  def test_WrappedShell(self):
+    device = MockDevice([('echo a\necho b\n', 'a\nb\n')])
+    cache = high.DeviceCache(None, None, None, None, None)
+    self.assertEqual(
+        ('a\nb\n', 0),
+        high.HighDevice(device, cache).WrappedShell(['echo a', 'echo b']))
+
+  def test_Dumpsys(self):
+    device = MockDevice(
+        [
+          ('dumpsys meminfo', 'Total RAM: 1234\n'),
+          ('dumpsys meminfo', 'Total RAM: 1234\n'),
+        ])
+    cache = high.DeviceCache(None, None, None, None, None)
+    high_device = high.HighDevice(device, cache)
+    self.assertEqual(u'Total', high_device.Dumpsys('meminfo', max_size=5))
+    sink = cStringIO.StringIO()
+    self.assertEqual(u'', high_device.Dumpsys('meminfo', sink=sink))
+    self.assertEqual('Total RAM: 1234\n', sink.getvalue())
+
+  def test_ShellWrappedSink(self):
+    device = MockDevice([('echo hello\n', 'hello\n')])
+    device.IsShellOk = lambda _cmd: False
+    cache = high.DeviceCache(None, None, None, None, None)
+    sink = cStringIO.StringIO()
+    self.assertEqual(
+        (u'', 0), high.HighDevice(device, cache).Shell(
+            'echo hello', sink=sink, max_size=3))
+    self.assertEqual('hel', sink.getvalue())
+
+  def test_PushDeduplicated(self):
+    content = 'fixture data'
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, content)
+      os.close(handle)
+      blob = '/data/local/tmp/.cas/' + high._HashFile(localfile)
+      device = MockFileDevice(
+          [
+            ('mv %s.tmp %s' % (blob, blob), ''),
+            ('mkdir -p /data/local/tmp && cp %s /data/local/tmp/a' % blob, ''),
+            # The second push only copies on the device, without even a Stat().
+            ('mkdir -p /data/local/tmp && cp %s /data/local/tmp/b' % blob, ''),
+          ])
+      device.boot_id = 'boot-dedup\n'
+      high._BOOT_CACHE.invalidate(device.serial)
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      self.assertEqual(
+          True, dev.PushDeduplicated(localfile, '/data/local/tmp/a'))
+      self.assertEqual(content, device.files[blob])
+      self.assertEqual(
+          True, dev.PushDeduplicated(localfile, '/data/local/tmp/b'))
+      self.assertEqual([], device._cmds)
+    finally:
+      os.remove(localfile)
+
+  def test_PushDeduplicatedQuoted(self):
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, 'quoted fixture data')
+      os.close(handle)
+      blob = '/data/my cas/' + high._HashFile(localfile)
+      device = MockFileDevice(
+          [
+            ('mv \'%s.tmp\' \'%s\'' % (blob, blob), ''),
+            ('mkdir -p /data/local/tmp && cp \'%s\' /data/local/tmp/a' % blob,
+             ''),
+          ])
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      self.assertEqual(
+          True,
+          dev.PushDeduplicated(
+              localfile, '/data/local/tmp/a', cas_dir='/data/my cas'))
+      self.assertEqual('quoted fixture data', device.files[blob])
+      self.assertEqual([], device._cmds)
+    finally:
+      os.remove(localfile)
+
+  def test_PushDeduplicatedLinkStale(self):
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, 'linked fixture data')
+      os.close(handle)
+      blob = '/data/local/tmp/.cas/' + high._HashFile(localfile)
+      link = '[ -f %s ] && mkdir -p /data/local/tmp && ln -sf %s %s'
+      device = MockFileDevice(
+          [
+            ('mv %s.tmp %s' % (blob, blob), ''),
+            (link % (blob, blob, '/data/local/tmp/a'), ''),
+            # The blob is gone but the index still lists it.
+            (link % (blob, blob, '/data/local/tmp/b'), ''),
+            ('mv %s.tmp %s' % (blob, blob), ''),
+            (link % (blob, blob, '/data/local/tmp/b'), ''),
+            # After a reboot, the index is not trusted anymore.
+            (link % (blob, blob, '/data/local/tmp/c'), ''),
+          ])
+      device.boot_id = 'boot-link-1\n'
+      high._BOOT_CACHE.invalidate(device.serial)
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      self.assertEqual(
+          True,
+          dev.PushDeduplicated(localfile, '/data/local/tmp/a', link=True))
+      device.files.clear()
+      self.assertEqual(
+          True,
+          dev.PushDeduplicated(localfile, '/data/local/tmp/b', link=True))
+      self.assertEqual('linked fixture data', device.files['/data/local/tmp/b'])
+      self.assertEqual([blob, blob], device.stats)
+      device.boot_id = 'boot-link-2\n'
+      high._BOOT_CACHE.invalidate(device.serial)
+      self.assertEqual(
+          True,
+          dev.PushDeduplicated(localfile, '/data/local/tmp/c', link=True))
+      self.assertEqual([blob, blob, blob], device.stats)
+      self.assertEqual([], device._cmds)
+    finally:
+      os.remove(localfile)
+
+  def test_PushDeduplicatedMissingParent(self):
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, 'nested fixture data')
+      os.close(handle)
+      blob = '/data/local/tmp/.cas/' + high._HashFile(localfile)
+      device = MockFileDevice(
+          [
+            ('mv %s.tmp %s' % (blob, blob), ''),
+            ('mkdir -p /data/new/dir && cp %s /data/new/dir/a' % blob, ''),
+          ])
+      high._BOOT_CACHE.invalidate(device.serial)
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      self.assertEqual(
+          True, dev.PushDeduplicated(localfile, '/data/new/dir/a'))
+      self.assertEqual('nested fixture data', device.files['/data/new/dir/a'])
+      self.assertEqual([], device._cmds)
+    finally:
+      os.remove(localfile)
+
+  def test_PushChecked(self):
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, 'new content')
+      os.close(handle)
+      digest = high._HashFile(localfile)
+      old = '0' * 64
+      device = MockFileDevice(
+          [
+            ('sha256sum /a /b 2>/dev/null',
+             '%s  /a\n%s  /b\n' % (digest, old)),
+            ('sha256sum /b 2>/dev/null', '%s  /b\n' % digest),
+          ])
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      # /a is already up to date so only /b is pushed.
+      self.assertEqual(
+          True, dev.PushChecked([(localfile, '/a'), (localfile, '/b')]))
+      self.assertEqual(['/b'], device.files.keys())
+    finally:
+      os.remove(localfile)
+
+  def test_PushDelta(self):
+    handle, localfile = tempfile.mkstemp(prefix='high_test')
+    try:
+      os.write(handle, 'aaaabbbbcccc')
+      os.close(handle)
+      remote = ['aaaa', 'XXXX', 'cccc', 'dd']
+      device = MockFileDevice(
+          [
+            ('i=0; while [ $i -lt 3 ]; do '
+             'dd if=/a bs=4 skip=$i count=1 2>/dev/null | sha1sum; '
+             'i=$((i+1)); done',
+             ''.join('%s  -\n' % hashlib.sha1(b).hexdigest() for b in remote[:3])),
+            ('dd if=/a.delta of=/a bs=4 skip=0 seek=1 count=1 conv=notrunc '
+             '2>/dev/null && dd if=/dev/null of=/a bs=1 seek=12 count=0 '
+             '2>/dev/null',
+             ''),
+            ('rm -f /a.delta', ''),
+            ('sha256sum /a 2>/dev/null',
+             '%s  /a\n' % high._HashFile(localfile)),
+          ],
+          files={'/a': ''.join(remote)})
+      cache = high.DeviceCache(None, None, None, None, None)
+      dev = high.HighDevice(device, cache)
+      self.assertEqual(True, dev.PushDelta(localfile, '/a', block_size=4))
+      # Only the changed block was sent.
+      self.assertEqual('bbbb', device.files['/a.delta'])
+      self.assertEqual([], device._cmds)
+    finally:
+      os.remove(localfile)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv: